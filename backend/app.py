@@ -1,23 +1,30 @@
-from flask import Flask, jsonify, send_from_directory
+from flask import jsonify, send_from_directory
 from flask_cors import CORS
 from config import Config, redis_client
 from models.database import db
 from utils.redis_client import init_redis
+from utils.metrics import init_metrics
+from utils.profiler import init_profiler
+from utils.tracing import init_tracing
+from utils.logger import configure_logging
+from utils.json_provider import ApiFlask
 from flask_jwt_extended import JWTManager
 from flask_session import Session
 import os
-import logging
 from datetime import timedelta
-import sys
 from sqlalchemy import text
 
-# Создаем приложение Flask
-app = Flask(__name__)
+# Создаем приложение Flask (с быстрым JSON-провайдером на базе orjson)
+app = ApiFlask(__name__)
 
 # Загружаем конфигурацию приложения из класса Config
 config = Config()
 app.config.from_object(config)
 
+# Настройка логирования: JSON в stdout через неблокирующую очередь, X-Request-ID
+configure_logging(app)
+app.logger.info('Application startup')
+
 # Инициализация базы данных
 # (db.init_app регистрирует SQLAlchemy с приложением Flask)
 db.init_app(app)
@@ -25,6 +32,21 @@ db.init_app(app)
 # Импортируем модели ПЕРЕД созданием таблиц
 from models.models import *
 
+def run_migration(description, statements):
+    """
+    Выполняет одну миграцию своей транзакцией: ошибка откатывает только её и не мешает следующим.
+    :param description: строка — что меняет миграция (для журнала)
+    :param statements: список SQL-выражений
+    """
+    try:
+        for statement in statements:
+            db.session.execute(text(statement))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Ошибка при миграции ({description}): {e}")
+
+
 with app.app_context():
     db.create_all()  # Создаем все таблицы в базе данных
     
@@ -112,20 +134,73 @@ with app.app_context():
             app.logger.info("Тип колонки description успешно изменен на TEXT")
         else:
             app.logger.info("Колонка description уже имеет тип TEXT или не требует изменений")
-            
+
     except Exception as e:
         app.logger.error(f"Ошибка при миграции analysis_prompt: {e}")
         db.session.rollback()
+
+    # Миграция 3: индексы для постраничного списка пользователей в админке
+    # (keyset-сортировка по (поле, id), фильтры и поиск по префиксу username/email)
+    run_migration("индексы списка пользователей", [
+        "CREATE INDEX IF NOT EXISTS ix_users_created_at_id ON users (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_organization_id_id ON users (organization_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_role_id ON users (role, id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_lower_username_prefix ON users (lower(username) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_users_lower_email_prefix ON users (lower(email) text_pattern_ops)",
+    ])
+
+    # Миграция 4: индексы для чтения истории диалога и отбора диалогов архиватором (jobs/archive_dialogs.py)
+    run_migration("индексы истории диалога и архиватора", [
+        "CREATE INDEX IF NOT EXISTS ix_messages_dialog_id_timestamp ON messages (dialog_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_dialogs_archive_candidates ON dialogs (completed_at) "
+        "WHERE status = 'completed' AND is_archived AND messages IS NULL",
+    ])
+
+    # Миграция 5: компактная стенограмма завершённого диалога вместо строк messages
+    run_migration("стенограмма диалога", [
+        "ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS transcript BYTEA",
+    ])
+
+    # Миграция 6: признак повторяемости в выданных достижениях (копия achievements.is_repeatable для частичного индекса)
+    run_migration("повторяемость выданных достижений", [
+        "ALTER TABLE user_achievements ADD COLUMN IF NOT EXISTS is_repeatable BOOLEAN NOT NULL DEFAULT FALSE",
+        "UPDATE user_achievements ua SET is_repeatable = COALESCE(a.is_repeatable, FALSE) FROM achievements a "
+        "WHERE a.id = ua.achievement_id AND ua.is_repeatable IS DISTINCT FROM COALESCE(a.is_repeatable, FALSE)",
+    ])
+    # Уникальность (user_id, achievement_id) неповторяемых достижений для массовой выдачи (INSERT ... ON CONFLICT).
+    # Накопленные повторы удаляет jobs/dedupe_user_achievements.py; пока они есть, индекс не создаётся
+    run_migration("уникальность выданных достижений (при ошибке запустите python -m jobs.dedupe_user_achievements)", [
+        "DROP INDEX IF EXISTS ux_user_achievements_user_achievement",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_user_achievements_once "
+        "ON user_achievements (user_id, achievement_id) WHERE NOT is_repeatable",
+    ])
+
+    # Миграция 7: версия промпта анализа диалога для повторного анализа (jobs/reanalysis_worker.py)
+    run_migration("версия анализа диалога", [
+        "ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS analysis_version VARCHAR(32)",
+        "ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS analyzed_at TIMESTAMP",
+    ])
+
+    # Миграция 8: число оценённых диалогов для инкрементальной средней оценки пользователя
+    run_migration("число оценённых диалогов", [
+        "ALTER TABLE user_statistics ADD COLUMN IF NOT EXISTS scored_dialogs INTEGER DEFAULT 0",
+    ])
+
+    # Миграция 9: счётчики серий и уникальных успешных сценариев (заполняются jobs/backfill_user_stats.py)
+    run_migration("счётчики серий и уникальных сценариев", [
+        f"ALTER TABLE user_statistics ADD COLUMN IF NOT EXISTS {column} INTEGER DEFAULT 0"
+        for column in ('current_streak', 'best_streak', 'unique_successful_scenarios')
+    ] + [
+        "CREATE INDEX IF NOT EXISTS ix_dialogs_user_scenario_successful ON dialogs (user_id, scenario_id) "
+        "WHERE is_successful",
+    ])
+
+    # Миграция 10: списки запрещённых слов организации и сценария для фильтра ответов ИИ
+    run_migration("списки запрещённых слов", [
+        "ALTER TABLE organizations ADD COLUMN IF NOT EXISTS forbidden_words TEXT",
+        "ALTER TABLE scenarios ADD COLUMN IF NOT EXISTS forbidden_words TEXT",
+    ])
     
-# Настройка логирования (вывод в stdout)
-app.logger.handlers.clear()
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.INFO)
-app.logger.info('Application startup')
 
 # Настройка CORS для API (разрешаем запросы с указанных доменов)
 CORS(app, resources={
@@ -136,8 +211,8 @@ CORS(app, resources={
             
         ],
         "supports_credentials": True,
-        "allow_headers": ["Content-Type", "Authorization", "X-Requested-With"],
-        "expose_headers": ["Content-Range", "X-Total-Count", "Authorization"],
+        "allow_headers": ["Content-Type", "Authorization", "X-Requested-With", "X-Profile", "X-Request-ID", "traceparent"],
+        "expose_headers": ["Content-Range", "X-Total-Count", "Authorization", "X-Profile-Id", "X-Request-ID", "traceparent"],
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         "max_age": 3600,
         "send_wildcard": False
@@ -199,6 +274,15 @@ app.config['JWT_ERROR_MESSAGE_KEY'] = 'error'  # Для единообразия
 # Инициализация Redis (для хранения сессий и кэша)
 init_redis(app)
 
+# Метрики производительности (задержки, SQL, Redis, GigaChat) и эндпоинт /metrics
+init_metrics(app)
+
+# Выборочное профилирование запросов (заголовок X-Profile: 1 от администратора или доля трафика)
+init_profiler(app)
+
+# Трассировка (спаны обработчиков, SQL, Redis, GigaChat) с выгрузкой в файл или OTLP-коллектор
+init_tracing(app)
+
 # Инициализация Flask-Session (сессии хранятся в Redis)
 Session(app)
 
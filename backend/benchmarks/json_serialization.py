@@ -0,0 +1,111 @@
+"""
+Бенчмарк сериализации ответов API: «до» (json.dumps по словарям с ручным isoformat)
+и «после» (FastJSONProvider: orjson с нативными datetime/Enum).
+
+Полезные нагрузки повторяют форму ответов эндпоинтов профиля, списка диалогов
+и списка пользователей в админке.
+
+Запуск (из каталога backend):
+    python -m benchmarks.json_serialization
+"""
+from datetime import datetime, timedelta
+import json
+import timeit
+
+from models.models import UserRole
+from utils.json_provider import dumps_bytes, orjson
+
+NOW = datetime(2025, 1, 1, 12, 0, 0, 123456)
+
+
+def _admin_users(count, raw):
+    users = []
+    for i in range(count):
+        created_at = NOW - timedelta(days=i % 365)
+        last_login = NOW - timedelta(hours=i % 48) if i % 3 else None
+        role = UserRole.ADMIN if i == 0 else UserRole.USER
+        users.append({
+            'id': i,
+            'username': f'user{i}',
+            'email': f'user{i}@example.com',
+            'role': role if raw else role.value,
+            'created_at': created_at if raw else created_at.isoformat(),
+            'last_login': last_login if raw else (last_login.isoformat() if last_login else None),
+            'is_active': True
+        })
+    return users
+
+
+def _sessions(count, raw):
+    sessions = []
+    for i in range(count):
+        started_at = NOW - timedelta(minutes=i * 7)
+        completed_at = started_at + timedelta(minutes=5) if i % 2 else None
+        sessions.append({
+            'id': i,
+            'scenario_id': i % 20,
+            'scenario_name': f'Сценарий {i % 20}',
+            'status': 'completed' if completed_at else 'active',
+            'started_at': started_at if raw else started_at.isoformat(),
+            'completed_at': completed_at if raw else (completed_at.isoformat() if completed_at else None),
+            'duration': 300,
+            'is_archived': False,
+            'last_message': {
+                'sender': 'assistant',
+                'text': 'Это просто неприемлемо! Я требую менеджера немедленно.',
+                'timestamp': started_at if raw else started_at.isoformat()
+            }
+        })
+    return {'sessions': sessions}
+
+
+def _profile(dialogs_count, raw):
+    dialogs = []
+    for i in range(dialogs_count):
+        started_at = NOW - timedelta(hours=i)
+        completed_at = started_at + timedelta(minutes=4)
+        dialogs.append({
+            'id': i,
+            'started_at': started_at if raw else started_at.isoformat(),
+            'completed_at': completed_at if raw else completed_at.isoformat(),
+            'score': None,
+            'status': 'completed',
+            'duration': 240,
+            'analysis': 'Общая оценка диалога: сотрудник сохранял спокойствие. ' * 10,
+            'scenario_name': f'Сценарий {i % 20}'
+        })
+    return {'user': {'id': 1, 'name': 'user1'}, 'dialogs': dialogs}
+
+
+PAYLOADS = {
+    'admin.get_all_users (5000)': lambda raw: _admin_users(5000, raw),
+    'chat.list_user_sessions (200)': lambda raw: _sessions(200, raw),
+    'profile.get_profile (1000 диалогов)': lambda raw: _profile(1000, raw),
+}
+
+
+def _stdlib_before(payload_factory):
+    # Как раньше: словари строятся с isoformat/.value и сериализуются стандартным json
+    return json.dumps(payload_factory(False))
+
+
+def _provider_after(payload_factory):
+    # Как сейчас: datetime/Enum передаются как есть, сериализует провайдер
+    return dumps_bytes(payload_factory(True))
+
+
+def run(number=20):
+    """
+    Печатает среднее время построения и сериализации ответа на один вызов.
+    :param number: int — количество повторов для каждого эндпоинта
+    """
+    print(f"orjson: {'доступен' if orjson is not None else 'не установлен (стандартный json)'}")
+    print(f"{'эндпоинт':40} {'до, мс':>10} {'после, мс':>10} {'ускорение':>10}")
+    for name, factory in PAYLOADS.items():
+        before = timeit.timeit(lambda: _stdlib_before(factory), number=number) / number * 1000
+        after = timeit.timeit(lambda: _provider_after(factory), number=number) / number * 1000
+        print(f"{name:40} {before:10.2f} {after:10.2f} {before / after:9.1f}x")
+
+
+if __name__ == '__main__':
+    run()
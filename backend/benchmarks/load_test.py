@@ -0,0 +1,184 @@
+"""
+Сценарный нагрузочный тест API: вход → начало сессии → N реплик → завершение → профиль.
+
+Каждый виртуальный пользователь работает в своём потоке под своей учётной записью
+bench_user_<n> (см. benchmarks/seed_data.py). По итогам печатаются p50/p95/p99,
+доля ошибок и пропускная способность по каждому эндпоинту; --json сохраняет отчёт
+для сравнения прогонов.
+
+Запуск (бэкенд направлен на benchmarks/mock_gigachat.py):
+    python -m benchmarks.load_test --base-url http://localhost:5000 --users 20 --iterations 5 --turns 6
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+USER_MESSAGES = [
+    "Добрый день! Понимаю ваше недовольство, сейчас разберёмся.",
+    "Уточните, пожалуйста, номер вашего заказа.",
+    "Я передам информацию администратору, это займёт пару минут.",
+    "Спасибо, что дождались. Всё готово.",
+]
+
+
+class Stats:
+    """
+    Потокобезопасный сборщик длительностей запросов по эндпоинтам.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, name, seconds, ok):
+        with self._lock:
+            self.durations[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+
+def percentile(values, p):
+    """
+    Перцентиль методом ближайшего ранга.
+    :param values: отсортированный список
+    :param p: float — перцентиль (0–100)
+    :return: float
+    """
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+class VirtualUser:
+    """
+    Виртуальный пользователь с собственной HTTP-сессией и JWT.
+    """
+    def __init__(self, base_url, email, password, stats, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.email = email
+        self.password = password
+        self.stats = stats
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def call(self, name, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        self.stats.add(name, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def login(self):
+        response = self.call('auth.login', 'POST', '/api/auth/login',
+                             json={'email': self.email, 'password': self.password})
+        if response is None:
+            return False
+        self.http.headers['Authorization'] = f"Bearer {response.json()['access_token']}"
+        return True
+
+    def run_session(self, scenario_id, turns):
+        response = self.call('chat.session_start', 'POST', '/api/chat/session/start',
+                             json={'scenario_id': scenario_id})
+        if response is None:
+            return
+        dialog_id = response.json().get('dialog_id')
+        for _ in range(turns):
+            self.call('chat.session_message', 'POST', f'/api/chat/session/{dialog_id}/message',
+                      json={'message': random.choice(USER_MESSAGES)},
+                      headers={'Idempotency-Key': str(uuid.uuid4())})
+        self.call('chat.session_finish', 'POST', f'/api/chat/session/{dialog_id}/finish',
+                  json={'duration': turns * 20})
+        self.call('profile.get_profile', 'GET', '/api/profile/')
+        self.call('chat.list_sessions', 'GET', '/api/chat/sessions')
+
+
+def _worker(index, args, scenario_ids, stats):
+    user = VirtualUser(args.base_url, f'{args.user_prefix}{index}@bench.local', args.password, stats, args.timeout)
+    if not user.login():
+        return
+    user.call('scenarios.user_view', 'GET', '/api/')
+    for _ in range(args.iterations):
+        user.run_session(random.choice(scenario_ids), args.turns)
+
+
+def _load_scenario_ids(args):
+    user = VirtualUser(args.base_url, f'{args.user_prefix}0@bench.local', args.password, Stats(), args.timeout)
+    if not user.login():
+        raise SystemExit('Не удалось войти под bench_user_0 — запустите benchmarks.seed_data')
+    response = user.call('scenarios.user_view', 'GET', '/api/')
+    ids = [s['id'] for s in (response.json() if response is not None else []) if s.get('is_active', True)]
+    if not ids:
+        raise SystemExit('Нет доступных сценариев')
+    return ids
+
+
+def report(stats, elapsed):
+    """
+    Печатает сводку и возвращает её в виде словаря.
+    :param stats: Stats
+    :param elapsed: float — длительность прогона, секунды
+    :return: dict
+    """
+    summary = {}
+    print(f"{'эндпоинт':24} {'запросов':>9} {'ошибок':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'RPS':>7}")
+    for name in sorted(stats.durations):
+        values = sorted(stats.durations[name])
+        row = {
+            'count': len(values),
+            'errors': stats.errors[name],
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'rps': len(values) / elapsed if elapsed else 0.0,
+        }
+        summary[name] = row
+        print(f"{name:24} {row['count']:9d} {row['errors']:7d} {row['p50_ms']:9.1f} "
+              f"{row['p95_ms']:9.1f} {row['p99_ms']:9.1f} {row['rps']:7.2f}")
+    total = sum(len(v) for v in stats.durations.values())
+    print(f"Всего запросов: {total} за {elapsed:.1f} с ({total / elapsed if elapsed else 0:.2f} RPS)")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сценарный нагрузочный тест API')
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=20, help='одновременных виртуальных пользователей')
+    parser.add_argument('--iterations', type=int, default=3, help='сессий на пользователя')
+    parser.add_argument('--turns', type=int, default=6, help='реплик пользователя в сессии')
+    parser.add_argument('--user-prefix', default='bench_user_')
+    parser.add_argument('--password', default='benchpass')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='путь для сохранения отчёта в JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    scenario_ids = _load_scenario_ids(args)
+    stats = Stats()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        futures = [pool.submit(_worker, index, args, scenario_ids, stats) for index in range(args.users)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    summary = report(stats, elapsed)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'elapsed_s': elapsed, 'endpoints': summary}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
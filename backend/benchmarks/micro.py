@@ -0,0 +1,267 @@
+"""
+Микробенчмарки «горячих» функций без обращений к БД и сети.
+
+Покрывает фильтр ответов ИИ, выбор системного промпта, сборку промпта анализа,
+расчёт прогресса достижений, сериализацию длинной истории диалога и кодек стенограммы.
+
+Результаты сохраняются в benchmarks/results/<commit>.json и сравниваются с базовым
+прогоном: если какой-либо кейс медленнее базы больше чем на --threshold, скрипт
+завершается с кодом 1 (удобно для CI).
+
+Запуск (из каталога backend):
+    python -m benchmarks.micro --save                       # замер и сохранение
+    python -m benchmarks.micro --compare benchmarks/results/baseline.json --threshold 0.15
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from routes import chat
+from services import response_filter_service
+from services.achievement_service import AchievementService
+from utils.json_provider import dumps_bytes
+from utils.transcript_codec import encode_transcript, decode_transcript
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# Минимальная длительность одного повтора, секунды (число вызовов подбирается под неё)
+MIN_REPEAT_TIME = 0.2
+REPEATS = 5
+
+
+class _MemoryRedis:
+    """Redis в памяти: выбор промпта обращается к Redis, а бенчмарк не должен зависеть от сети."""
+    def __init__(self, data=None):
+        self.data = data or {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+
+def _scenario(**overrides):
+    fields = {
+        'id': 1,
+        'name': 'Пролитое вино',
+        'description': 'Официант пролил вино на гостя ресторана во время ужина.',
+        'user_role': 'официант',
+        'ai_role': 'гость ресторана',
+        'ai_behavior': 'раздражён, требует извинений и компенсации',
+        'mood': 'злой',
+        'language': 'русском',
+        'prompt_template': None,
+        'prompt_template_id': None,
+        'organization_id': None,
+        'forbidden_words': None,
+    }
+    fields.update(overrides)
+    return SimpleNamespace(**fields)
+
+
+def _messages(count):
+    started = datetime(2025, 1, 1, 12, 0, 0)
+    return [SimpleNamespace(
+        id=i,
+        sender='user' if i % 2 else 'assistant',
+        text=('Понимаю ваше недовольство, сейчас всё уточню у администратора.' if i % 2
+              else 'Я жду уже двадцать минут, и никто ко мне не подошёл!'),
+        timestamp=started + timedelta(seconds=15 * i)
+    ) for i in range(count)]
+
+
+def case_filter_ai_response():
+    # Без обёртки с метрикой (llm_phase на role_break_reason): замеряем только сам фильтр
+    filter_fn = chat.role_break_reason.__wrapped__
+    response_filter_service.redis_client = _MemoryRedis()
+    scenario = _scenario()
+    texts = [
+        'Я жду уже двадцать минут, и никто ко мне не подошёл! Это просто неприемлемо.',
+        'Вы что, совсем слепые?! Я весь в вине из-за вашей неосторожности!',
+        'Хорошо, я подожду, но в следующий раз такого быть не должно.',
+    ] * 10
+    return lambda: [filter_fn(t, scenario) for t in texts]
+
+
+def case_filter_ai_response_large_phrase_set():
+    # Списки запрещённых слов растут вместе с организациями и шаблонами: проверяем поведение на 10-кратном объёме
+    filter_fn = chat.role_break_reason.__wrapped__
+    response_filter_service.redis_client = _MemoryRedis()
+    extra = [f'{phrase} {i}' for i in range(10) for phrase in response_filter_service.ROLE_BREAK_PHRASES]
+    scenario = _scenario(forbidden_words='\n'.join(extra))
+    text = 'Я жду уже двадцать минут, и никто ко мне не подошёл! Это просто неприемлемо. ' * 5
+    return lambda: filter_fn(text, scenario)
+
+
+def case_system_prompt_fallback():
+    scenario = _scenario()
+    chat.redis_client = _MemoryRedis()
+    return lambda: (chat.generate_system_prompt_for_start(scenario), chat.generate_system_prompt_for_continue(scenario))
+
+
+def case_system_prompt_from_scenario():
+    scenario = _scenario(prompt_template='Ты гость ресторана. Веди себя раздражённо. ' * 20)
+    chat.redis_client = _MemoryRedis()
+    return lambda: (chat.generate_system_prompt_for_start(scenario), chat.generate_system_prompt_for_continue(scenario))
+
+
+def case_analysis_prompt_default():
+    scenario = _scenario()
+    messages = _messages(60)
+    return lambda: chat.build_analysis_prompt(scenario, None, chat.build_dialog_text(messages))
+
+
+def case_analysis_prompt_template():
+    scenario = _scenario()
+    messages = _messages(60)
+    template = ('Сценарий: {scenario_description}\nСотрудник: {user_role}\nКлиент: {ai_role}\n'
+                'Диалог:\n{dialog_text}\nОтвечай на {language} языке.\n') + 'Критерии оценки. ' * 100
+    return lambda: chat.build_analysis_prompt(scenario, template, chat.build_dialog_text(messages))
+
+
+def case_achievements_progress():
+    achievements = [SimpleNamespace(
+        id=i, name=f'Достижение {i}', description='Описание', icon='icon.png', points=10,
+        requirements=json.dumps({'type': 'total_dialogs', 'value': 5 * (i + 1)}) if i % 4 else None
+    ) for i in range(200)]
+    earned = {i: SimpleNamespace(earned_at=datetime(2025, 1, 1)) for i in range(0, 200, 3)}
+    stats = SimpleNamespace(total_dialogs=120, completed_scenarios=14, successful_dialogs=40)
+    reg_date = datetime(2024, 6, 1).isoformat()
+    return lambda: AchievementService.build_achievements_progress(achievements, earned, stats, reg_date)
+
+
+def case_serialize_dialog_history():
+    messages = [{
+        'id': m.id, 'sender': m.sender, 'text': m.text, 'timestamp': m.timestamp
+    } for m in _messages(2000)]
+    payload = {'dialog_id': 1, 'status': 'completed', 'messages': messages}
+    return lambda: dumps_bytes(payload)
+
+
+def case_transcript_encode():
+    messages = _messages(60)
+    return lambda: encode_transcript(messages)
+
+
+def case_transcript_decode():
+    blob = encode_transcript(_messages(60))
+    return lambda: decode_transcript(blob)
+
+
+CASES = {
+    'filter_ai_response': case_filter_ai_response,
+    'filter_ai_response_large_phrase_set': case_filter_ai_response_large_phrase_set,
+    'system_prompt_fallback': case_system_prompt_fallback,
+    'system_prompt_from_scenario': case_system_prompt_from_scenario,
+    'analysis_prompt_default': case_analysis_prompt_default,
+    'analysis_prompt_template': case_analysis_prompt_template,
+    'achievements_progress': case_achievements_progress,
+    'serialize_dialog_history': case_serialize_dialog_history,
+    'transcript_encode': case_transcript_encode,
+    'transcript_decode': case_transcript_decode,
+}
+
+
+def measure(fn):
+    """
+    Замеряет время одного вызова: подбирает число вызовов на повтор, делает REPEATS повторов.
+    :param fn: функция без аргументов
+    :return: dict с min/median (микросекунды на вызов) и числом вызовов
+    """
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_REPEAT_TIME:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(MIN_REPEAT_TIME / elapsed * 1.2))
+
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return {'min_us': min(timings), 'median_us': statistics.median(timings), 'calls': number}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(results, baseline, threshold):
+    """
+    Сравнивает прогон с базовым и печатает изменения.
+    Сравнение идёт по минимальному времени: оно меньше всего зависит от шума машины.
+    :return: список имён кейсов с регрессией больше threshold
+    """
+    regressions = []
+    print(f"\nСравнение с {baseline.get('commit', '?')} (порог {threshold:.0%}):")
+    for name, row in results['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        if not base:
+            print(f"  {name:40} нет в базе")
+            continue
+        change = row['min_us'] / base['min_us'] - 1 if base['min_us'] else 0.0
+        mark = 'РЕГРЕССИЯ' if change > threshold else ''
+        print(f"  {name:40} {base['min_us']:10.1f} → {row['min_us']:10.1f} мкс  {change:+7.1%} {mark}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки горячих функций')
+    parser.add_argument('cases', nargs='*', help='запустить только указанные кейсы')
+    parser.add_argument('--save', action='store_true', help='сохранить результаты в benchmarks/results/<commit>.json')
+    parser.add_argument('--output', help='сохранить результаты в указанный файл')
+    parser.add_argument('--compare', help='файл базового прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.15, help='допустимое замедление (доля), по умолчанию 15%%')
+    args = parser.parse_args()
+
+    selected = args.cases or list(CASES)
+    unknown = [name for name in selected if name not in CASES]
+    if unknown:
+        parser.error(f"Неизвестные кейсы: {', '.join(unknown)}")
+
+    results = {
+        'commit': _git_commit(),
+        'created_at': datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'machine': platform.platform(),
+        'cases': {}
+    }
+    original_redis = chat.redis_client
+    try:
+        for name in selected:
+            row = measure(CASES[name]())
+            results['cases'][name] = row
+            print(f"{name:40} min {row['min_us']:10.1f} мкс  median {row['median_us']:10.1f} мкс  ({row['calls']} вызовов)")
+    finally:
+        chat.redis_client = original_redis
+
+    output = args.output or (os.path.join(RESULTS_DIR, f"{results['commit']}.json") if args.save else None)
+    if output:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
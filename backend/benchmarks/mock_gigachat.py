@@ -0,0 +1,164 @@
+"""
+Локальная заглушка GigaChat API для нагрузочных тестов.
+
+Эмулирует эндпоинты авторизации (/api/v2/oauth) и чата (/api/v1/chat/completions)
+с настраиваемой задержкой, долей ошибок и потоковой выдачей (stream=true, SSE).
+
+Запуск:
+    python -m benchmarks.mock_gigachat --port 8090 --latency-ms 800 --jitter-ms 300 --error-rate 0.02
+
+Бэкенд направляется на заглушку переменными окружения:
+    GIGACHAT_AUTH_URL=http://localhost:8090/api/v2/oauth
+    GIGACHAT_API_URL=http://localhost:8090/api/v1
+    GIGACHAT_CLIENT_ID=bench GIGACHAT_CLIENT_SECRET=bench
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import random
+import time
+import uuid
+
+# Реплики «клиента» без фраз, на которые срабатывает filter_ai_response
+CLIENT_REPLIES = [
+    "Я жду уже двадцать минут, и никто ко мне не подошёл.",
+    "Мне принесли совсем не то, что я заказывал.",
+    "Почему у вас всё так медленно? Я тороплюсь.",
+    "Хорошо, но в следующий раз я хочу, чтобы такого не было.",
+    "Ладно, посмотрим, что из этого выйдет.",
+    "Я уже второй раз сталкиваюсь с такой ситуацией у вас.",
+]
+
+ANALYSIS_REPLY = (
+    "1. **Общая оценка диалога**: сотрудник сохранял спокойствие и довёл разговор до конца.\n"
+    "2. **Сильные стороны**: вежливость, уточняющие вопросы, признание проблемы.\n"
+    "3. **Области для улучшения**: не хватило конкретики в предложенном решении.\n"
+    "4. **Рекомендации**: озвучивать сроки и следующий шаг, подводить итог разговора."
+)
+
+
+class MockConfig:
+    latency_ms = 800
+    jitter_ms = 300
+    error_rate = 0.0
+    auth_latency_ms = 50
+    chunk_delay_ms = 40
+
+
+def _pick_reply(payload):
+    # Запрос анализа диалога приходит одним сообщением с промптом анализа
+    messages = payload.get('messages') or []
+    last_text = (messages[-1].get('content') or '') if messages else ''
+    if 'анализ диалога' in last_text.lower() or 'Проанализируй' in last_text:
+        return ANALYSIS_REPLY
+    return random.choice(CLIENT_REPLIES)
+
+
+class MockGigaChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Не засоряем вывод во время прогона
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_POST(self):
+        raw = self._read_body()
+        if self.path.endswith('/oauth'):
+            time.sleep(MockConfig.auth_latency_ms / 1000)
+            self._send_json(200, {
+                'access_token': f'mock-{uuid.uuid4()}',
+                'expires_at': int(time.time() * 1000) + 1800 * 1000,
+                'expires_in': 1800
+            })
+            return
+
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'message': 'not found'})
+            return
+
+        delay = max(0.0, MockConfig.latency_ms + random.uniform(-MockConfig.jitter_ms, MockConfig.jitter_ms)) / 1000
+        if random.random() < MockConfig.error_rate:
+            time.sleep(delay / 2)
+            self._send_json(random.choice([500, 503, 429]), {'message': 'mock error'})
+            return
+
+        try:
+            payload = json.loads(raw.decode('utf-8') or '{}')
+        except ValueError:
+            self._send_json(400, {'message': 'bad json'})
+            return
+
+        reply = _pick_reply(payload)
+        if payload.get('stream'):
+            self._stream(reply, delay)
+            return
+
+        time.sleep(delay)
+        self._send_json(200, {
+            'choices': [{'message': {'role': 'assistant', 'content': reply}, 'index': 0, 'finish_reason': 'stop'}],
+            'created': int(time.time()),
+            'model': payload.get('model', 'GigaChat'),
+            'object': 'chat.completion',
+            'usage': {'prompt_tokens': 100, 'completion_tokens': len(reply) // 4, 'total_tokens': 100 + len(reply) // 4}
+        })
+
+    def _stream(self, reply, delay):
+        # Первый токен приходит после основной задержки, остальные — с интервалом chunk_delay_ms
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(delay)
+        words = reply.split(' ')
+        for i, word in enumerate(words):
+            chunk = {'choices': [{'delta': {'content': word + (' ' if i < len(words) - 1 else '')}, 'index': 0}]}
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            time.sleep(MockConfig.chunk_delay_ms / 1000)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушка GigaChat API для нагрузочных тестов')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=int, default=MockConfig.latency_ms, help='средняя задержка ответа чата')
+    parser.add_argument('--jitter-ms', type=int, default=MockConfig.jitter_ms, help='разброс задержки (±)')
+    parser.add_argument('--error-rate', type=float, default=MockConfig.error_rate, help='доля ответов с ошибкой 5xx/429')
+    parser.add_argument('--chunk-delay-ms', type=int, default=MockConfig.chunk_delay_ms, help='интервал чанков при stream=true')
+    args = parser.parse_args()
+
+    MockConfig.latency_ms = args.latency_ms
+    MockConfig.jitter_ms = args.jitter_ms
+    MockConfig.error_rate = args.error_rate
+    MockConfig.chunk_delay_ms = args.chunk_delay_ms
+
+    server = ThreadingHTTPServer((args.host, args.port), MockGigaChatHandler)
+    print(f"Заглушка GigaChat слушает {args.host}:{args.port} "
+          f"(задержка {args.latency_ms}±{args.jitter_ms} мс, ошибки {args.error_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
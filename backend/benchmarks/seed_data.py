@@ -0,0 +1,184 @@
+"""
+Наполнение Postgres данными реалистичного объёма для нагрузочных тестов.
+
+По умолчанию: 10 000 пользователей, 50 000 завершённых диалогов и 1 000 000 сообщений.
+Все пользователи получают пароль BENCH_PASSWORD и имена bench_user_<n>; их диалоги
+и сообщения удаляются флагом --purge.
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m benchmarks.seed_data --users 10000 --messages 1000000
+    python -m benchmarks.seed_data --purge
+"""
+from datetime import datetime, timedelta
+import argparse
+import random
+import time
+
+from sqlalchemy import insert, delete, select
+from werkzeug.security import generate_password_hash
+
+from app import app
+from models.database import db
+from models.models import Users, UserRole, UserStatistics, Dialog, Message, Scenario, ScenarioType
+
+BENCH_PREFIX = 'bench_user_'
+BENCH_PASSWORD = 'benchpass'
+BATCH_SIZE = 5000
+MESSAGES_PER_DIALOG = 20
+
+USER_LINES = [
+    "Добрый день! Понимаю ваше недовольство, сейчас разберёмся.",
+    "Уточните, пожалуйста, номер вашего заказа.",
+    "Я передам информацию администратору, это займёт пару минут.",
+    "Спасибо, что дождались. Всё готово.",
+]
+AI_LINES = [
+    "Я жду уже двадцать минут, и никто ко мне не подошёл.",
+    "Мне принесли совсем не то, что я заказывал.",
+    "Хорошо, но в следующий раз я хочу, чтобы такого не было.",
+]
+
+
+def _ensure_scenarios(count=10):
+    """
+    Возвращает id активных сценариев, при необходимости создаёт тестовые.
+    :param count: int — сколько сценариев нужно
+    :return: list[int]
+    """
+    ids = db.session.scalars(select(Scenario.id).where(Scenario.is_active.is_(True)).limit(count)).all()
+    if ids:
+        return list(ids)
+    rows = [{
+        'name': f'Нагрузочный сценарий {i}',
+        'description': 'Недовольный гость кафе ждёт заказ слишком долго.',
+        'category': 'bench',
+        'subcategory': 'bench',
+        'sphere': 'Кафе',
+        'situation': 'Долгое ожидание заказа',
+        'mood': 'раздражённый',
+        'user_role': 'официант',
+        'ai_role': 'гость кафе',
+        'ai_behavior': 'выражает недовольство, но готов к диалогу',
+        'prompt_template': 'Ты гость кафе. {ai_behavior}',
+        'type': ScenarioType.CAFE,
+        'is_active': True,
+    } for i in range(count)]
+    ids = db.session.scalars(insert(Scenario).returning(Scenario.id), rows).all()
+    db.session.commit()
+    return list(ids)
+
+
+def seed_users(total):
+    """
+    Создаёт пользователей и их статистику пачками.
+    :param total: int — количество пользователей
+    :return: list[int] — id созданных пользователей
+    """
+    # Хэш считается один раз: генерация на каждого пользователя заняла бы минуты
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    now = datetime.utcnow()
+    start = db.session.query(db.func.count(Users.id)).filter(Users.username.like(f'{BENCH_PREFIX}%')).scalar()
+    user_ids = []
+    for offset in range(start, start + total, BATCH_SIZE):
+        rows = [{
+            'username': f'{BENCH_PREFIX}{n}',
+            'email': f'{BENCH_PREFIX}{n}@bench.local',
+            'password_hash': password_hash,
+            'role': UserRole.USER,
+            'is_active': True,
+            'created_at': now - timedelta(days=random.randint(0, 365)),
+        } for n in range(offset, min(offset + BATCH_SIZE, start + total))]
+        ids = db.session.scalars(insert(Users).returning(Users.id), rows).all()
+        db.session.execute(insert(UserStatistics), [{'user_id': user_id} for user_id in ids])
+        db.session.commit()
+        user_ids.extend(ids)
+        print(f"  пользователи: {len(user_ids)}/{total}")
+    return user_ids
+
+
+def seed_dialogs(user_ids, scenario_ids, total_messages):
+    """
+    Создаёт завершённые диалоги с сообщениями пачками.
+    :param user_ids: list[int]
+    :param scenario_ids: list[int]
+    :param total_messages: int — целевое количество сообщений
+    """
+    dialogs_total = max(1, total_messages // MESSAGES_PER_DIALOG)
+    now = datetime.utcnow()
+    dialogs_batch = max(1, BATCH_SIZE // MESSAGES_PER_DIALOG * 4)
+    created = 0
+    while created < dialogs_total:
+        size = min(dialogs_batch, dialogs_total - created)
+        started = [now - timedelta(minutes=random.randint(10, 180 * 24 * 60)) for _ in range(size)]
+        rows = [{
+            'user_id': random.choice(user_ids),
+            'scenario_id': random.choice(scenario_ids),
+            'started_at': started[i],
+            'completed_at': started[i] + timedelta(minutes=5),
+            'duration': 300,
+            'status': 'completed',
+            'is_finished': True,
+            'total_messages': MESSAGES_PER_DIALOG,
+            'user_messages_count': MESSAGES_PER_DIALOG // 2,
+            'ai_messages_count': MESSAGES_PER_DIALOG // 2,
+            'is_archived': False,
+        } for i in range(size)]
+        dialog_ids = db.session.scalars(insert(Dialog).returning(Dialog.id), rows).all()
+
+        messages = []
+        for dialog_id, started_at in zip(dialog_ids, started):
+            for j in range(MESSAGES_PER_DIALOG):
+                is_user = j % 2 == 1
+                messages.append({
+                    'dialog_id': dialog_id,
+                    'sender': 'user' if is_user else 'assistant',
+                    'text': random.choice(USER_LINES if is_user else AI_LINES),
+                    'timestamp': started_at + timedelta(seconds=15 * j),
+                })
+        db.session.execute(insert(Message), messages)
+        db.session.commit()
+        created += size
+        print(f"  диалоги: {created}/{dialogs_total}, сообщения: {created * MESSAGES_PER_DIALOG}")
+
+
+def purge():
+    """
+    Удаляет пользователей bench_user_* вместе с их диалогами, сообщениями и статистикой.
+    """
+    bench_users = select(Users.id).where(Users.username.like(f'{BENCH_PREFIX}%')).scalar_subquery()
+    bench_dialogs = select(Dialog.id).where(Dialog.user_id.in_(bench_users)).scalar_subquery()
+    db.session.execute(delete(Message).where(Message.dialog_id.in_(bench_dialogs)))
+    db.session.execute(delete(Dialog).where(Dialog.user_id.in_(bench_users)))
+    db.session.execute(delete(UserStatistics).where(UserStatistics.user_id.in_(bench_users)))
+    db.session.execute(delete(Users).where(Users.username.like(f'{BENCH_PREFIX}%')))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Наполнение БД данными для нагрузочных тестов')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42, help='seed генератора для воспроизводимости')
+    parser.add_argument('--purge', action='store_true', help='удалить ранее созданные данные')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with app.app_context():
+        if args.purge:
+            purge()
+            print("Данные нагрузочных тестов удалены")
+            return
+
+        started = time.perf_counter()
+        scenario_ids = _ensure_scenarios()
+        user_ids = seed_users(args.users)
+        seed_dialogs(user_ids, scenario_ids, args.messages)
+        # Обновляем статистику планировщика, иначе первые прогоны идут по неверным планам
+        db.session.commit()
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('ANALYZE users; ANALYZE dialogs; ANALYZE messages;')
+        print(f"Готово за {time.perf_counter() - started:.1f} с. Пароль пользователей: {BENCH_PASSWORD}")
+
+
+if __name__ == '__main__':
+    main()
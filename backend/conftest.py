@@ -0,0 +1,115 @@
+# Общие фикстуры pytest для backend. Файл лежит в корне backend, чтобы тесты импортировали модули
+# приложения (utils, services) так же, как gunicorn и задания.
+# Тестовое приложение собирается без app.py (там подключение к Postgres и миграции): SQLite в памяти,
+# Redis — fakeredis (requirements-dev.txt), маршруты регистрируются с теми же префиксами.
+import pytest
+
+
+@pytest.fixture
+def query_guard(monkeypatch):
+    """
+    Включает QUERY_GUARD в режиме raise: превышение бюджета SQL-запросов вызывает AssertionError.
+    Режим читается при импорте utils.query_budget, поэтому подменяется атрибут модуля.
+    :return: модуль utils.query_budget
+    """
+    from utils import query_budget
+    monkeypatch.setattr(query_budget, 'QUERY_GUARD_MODE', 'raise')
+    return query_budget
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """
+    Подключает общий клиент Redis к fakeredis. Подменяется пул соединений, а не сам клиент:
+    модули импортируют redis_client напрямую и продолжают работать с тем же объектом.
+    :return: FakeRedis с теми же данными
+    """
+    import fakeredis
+    from utils.redis_client import redis_client
+    fake = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_client, 'connection_pool', fake.connection_pool)
+    return fake
+
+
+@pytest.fixture
+def app(fake_redis):
+    """
+    Приложение с маршрутами backend на SQLite в памяти.
+    """
+    from flask_jwt_extended import JWTManager
+    from sqlalchemy.pool import StaticPool
+    from models.database import db
+    from routes.activity import activity_bp
+    from routes.chat import chat_bp
+    from routes.profile import profile_bp
+    from routes.progress import progress_bp
+    from utils.json_provider import ApiFlask
+
+    app = ApiFlask(__name__)
+    app.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI='sqlite://',
+        SQLALCHEMY_ENGINE_OPTIONS={'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}},
+        JWT_SECRET_KEY='test-secret',
+    )
+    db.init_app(app)
+    JWTManager(app)
+    app.register_blueprint(progress_bp, url_prefix='/api/progress')
+    app.register_blueprint(profile_bp, url_prefix='/api/profile')
+    app.register_blueprint(chat_bp, url_prefix='/api/chat')
+    app.register_blueprint(activity_bp)
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def user(app):
+    """
+    Пользователь со статистикой.
+    """
+    from models.database import db
+    from models.models import Users, UserStatistics
+    user = Users(username='tester', email='tester@example.com', password_hash='-')
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(UserStatistics(user_id=user.id))
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def auth_headers(user):
+    from flask_jwt_extended import create_access_token
+    return {'Authorization': f'Bearer {create_access_token(identity=user.id)}'}
+
+
+@pytest.fixture
+def make_scenario(app):
+    """
+    Фабрика сценариев с обязательными полями.
+    """
+    from models.database import db
+    from models.models import Scenario, ScenarioType
+
+    def make(**fields):
+        values = dict(
+            name='Пролитое вино', description='Официант пролил вино на гостя ресторана.',
+            category='cafe', subcategory='service', sphere='Общепит', situation='Жалоба', mood='злой',
+            language='русском', user_role='официант', ai_role='гость ресторана', ai_behavior='раздражён',
+            prompt_template='Ты гость ресторана.', type=ScenarioType.CAFE,
+        )
+        values.update(fields)
+        scenario = Scenario(**values)
+        db.session.add(scenario)
+        db.session.commit()
+        return scenario
+    return make
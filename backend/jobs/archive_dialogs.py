@@ -0,0 +1,53 @@
+"""
+Фоновый архиватор диалогов.
+
+Завершённые диалоги, которые пользователь отправил в архив и которые старше
+ARCHIVE_AFTER_DAYS дней, переносятся из таблицы messages в сжатый JSON в колонке
+Dialog.messages (см. services/dialog_archive_service.py). Открытие такого диалога
+читает сообщения из архива, разархивация возвращает строки в messages.
+Новые диалоги при завершении получают стенограмму (Dialog.transcript), которая заменяет
+этот архив: их строки в messages уже удалены, и архиватор их пропускает. Архиватор нужен
+для диалогов, завершённых до появления стенограмм и ещё не переведённых jobs.compact_transcripts.
+Если messages секционирована (jobs/partition_messages.py), заодно создаются секции
+на ближайшие месяцы.
+
+Запуск по расписанию (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.archive_dialogs --older-than-days 90
+"""
+import argparse
+import os
+import time
+
+from app import app
+from models.database import db
+from services.dialog_archive_service import DialogArchiveService
+from jobs.partition_messages import is_partitioned, ensure_partitions
+
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перенос старых архивных диалогов в холодное хранение')
+    parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--batch-size', type=int, default=200, help='диалогов в одной транзакции')
+    parser.add_argument('--max-batches', type=int, help='ограничить число пачек за запуск')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if is_partitioned():
+            ensure_partitions()
+            db.session.commit()
+
+        started = time.perf_counter()
+        totals = DialogArchiveService.archive_old_dialogs(args.older_than_days, args.batch_size, args.max_batches)
+        print(f"Архивировано диалогов: {totals['dialogs']}, сообщений: {totals['messages']} "
+              f"за {time.perf_counter() - started:.1f} с")
+
+        if totals['messages']:
+            # После массового удаления строк обновляем карту видимости и статистику планировщика
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.exec_driver_sql('VACUUM (ANALYZE) messages')
+
+
+if __name__ == '__main__':
+    main()
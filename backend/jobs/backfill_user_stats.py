@@ -0,0 +1,70 @@
+"""
+Заполнение счётчиков серий и уникальных сценариев в user_statistics по истории диалогов.
+
+Новые значения UserStatistics.current_streak, best_streak и unique_successful_scenarios
+ведутся инкрементально при завершении диалога; этот скрипт один раз считает их для уже
+накопленной истории (и после массового повторного анализа, который меняет успешность
+диалогов не в порядке их завершения). Всё считается тремя запросами на стороне базы.
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.backfill_user_stats
+"""
+import time
+
+from sqlalchemy import text
+
+from app import app
+from models.database import db
+
+# Серии: диалоги пользователя по времени завершения делятся на группы, каждая неуспешная или неоценённая
+# начинает новую; длина серии — число успешных в группе, текущая — в последней группе
+STREAKS_SQL = """
+WITH ordered AS (
+    SELECT user_id, is_successful,
+           SUM(CASE WHEN is_successful THEN 0 ELSE 1 END)
+               OVER (PARTITION BY user_id ORDER BY completed_at, id) AS grp
+    FROM dialogs
+    WHERE status = 'completed'
+), runs AS (
+    SELECT user_id, grp, COUNT(*) FILTER (WHERE is_successful) AS length
+    FROM ordered
+    GROUP BY user_id, grp
+), streaks AS (
+    SELECT user_id, MAX(length) AS best, (ARRAY_AGG(length ORDER BY grp DESC))[1] AS current
+    FROM runs
+    GROUP BY user_id
+)
+UPDATE user_statistics s
+SET current_streak = streaks.current, best_streak = streaks.best
+FROM streaks
+WHERE s.user_id = streaks.user_id
+"""
+
+UNIQUE_SCENARIOS_SQL = """
+UPDATE user_statistics s
+SET unique_successful_scenarios = counts.scenarios
+FROM (
+    SELECT user_id, COUNT(DISTINCT scenario_id) AS scenarios
+    FROM dialogs
+    WHERE is_successful
+    GROUP BY user_id
+) counts
+WHERE s.user_id = counts.user_id
+"""
+
+
+def main():
+    with app.app_context():
+        started = time.perf_counter()
+        db.session.execute(text(
+            "UPDATE user_statistics SET current_streak = 0, best_streak = 0, unique_successful_scenarios = 0"
+        ))
+        streaks = db.session.execute(text(STREAKS_SQL)).rowcount
+        scenarios = db.session.execute(text(UNIQUE_SCENARIOS_SQL)).rowcount
+        db.session.commit()
+        print(f"Серии обновлены для пользователей: {streaks}, уникальные сценарии: {scenarios} "
+              f"за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Перевод исторических завершённых диалогов в компактную стенограмму.
+
+Новые диалоги получают стенограмму (Dialog.transcript) при завершении; этот скрипт
+делает то же для уже накопленных: сообщения каждой пачки кодируются одним блобом
+(см. utils/transcript_codec.py), а их строки удаляются из messages.
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.compact_transcripts --batch-size 500
+"""
+import argparse
+import time
+
+from sqlalchemy import text
+
+from app import app
+from models.database import db
+from services.dialog_archive_service import DialogArchiveService
+
+
+def _table_size(name):
+    return db.session.execute(text("SELECT pg_size_pretty(pg_total_relation_size(:name))"), {'name': name}).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Компактные стенограммы для завершённых диалогов')
+    parser.add_argument('--batch-size', type=int, default=500, help='диалогов в одной транзакции')
+    parser.add_argument('--max-batches', type=int, help='ограничить число пачек за запуск')
+    args = parser.parse_args()
+
+    with app.app_context():
+        print(f"Размер messages до: {_table_size('messages')}, dialogs: {_table_size('dialogs')}")
+        started = time.perf_counter()
+        totals = DialogArchiveService.compact_completed_dialogs(args.batch_size, args.max_batches)
+        print(f"Стенограммы записаны для диалогов: {totals['dialogs']}, сообщений: {totals['messages']} "
+              f"за {time.perf_counter() - started:.1f} с")
+
+        if totals['messages']:
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.exec_driver_sql('VACUUM (ANALYZE) messages')
+        # Место на диске освобождается только после VACUUM FULL или pg_repack, обычный VACUUM делает его доступным для новых строк
+        print(f"Размер messages после: {_table_size('messages')}, dialogs: {_table_size('dialogs')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Удаление повторных выдач неповторяемых достижений перед созданием уникального индекса.
+
+До миграции 6 одно и то же неповторяемое достижение могло быть выдано пользователю несколько раз
+(гонка в AchievementService.check_achievements). Скрипт оставляет самую раннюю выдачу, удаляет
+остальные, печатает каждую удалённую запись и списывает начисленные за неё баллы, затем создаёт
+частичный индекс ux_user_achievements_once. Повторяемые достижения (is_repeatable) не затрагиваются.
+Повторный запуск ничего не меняет.
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.dedupe_user_achievements
+"""
+import time
+from collections import Counter
+
+from sqlalchemy import text
+
+from app import app
+from models.database import db
+
+# Копия признака повторяемости могла устареть, если приложение запускалось без миграции 6
+SYNC_SQL = """
+UPDATE user_achievements ua
+SET is_repeatable = COALESCE(a.is_repeatable, FALSE)
+FROM achievements a
+WHERE a.id = ua.achievement_id AND ua.is_repeatable IS DISTINCT FROM COALESCE(a.is_repeatable, FALSE)
+"""
+
+# Остаётся выдача с наименьшим id (самая ранняя)
+DEDUPE_SQL = """
+DELETE FROM user_achievements ua
+USING user_achievements kept
+WHERE ua.user_id = kept.user_id AND ua.achievement_id = kept.achievement_id AND ua.id > kept.id
+  AND NOT ua.is_repeatable AND NOT kept.is_repeatable
+RETURNING ua.id, ua.user_id, ua.achievement_id, ua.earned_at
+"""
+
+REFUND_SQL = """
+UPDATE users u
+SET points = GREATEST(COALESCE(u.points, 0) - :amount, 0)
+WHERE u.id = :user_id
+"""
+
+INDEX_SQL = [
+    "DROP INDEX IF EXISTS ux_user_achievements_user_achievement",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_user_achievements_once "
+    "ON user_achievements (user_id, achievement_id) WHERE NOT is_repeatable",
+]
+
+
+def main():
+    with app.app_context():
+        started = time.perf_counter()
+        synced = db.session.execute(text(SYNC_SQL)).rowcount
+        deleted = db.session.execute(text(DEDUPE_SQL)).all()
+        for row in deleted:
+            print(f"Удалена повторная выдача id={row.id}: пользователь {row.user_id}, "
+                  f"достижение {row.achievement_id}, получено {row.earned_at}")
+
+        points = dict(db.session.execute(
+            text("SELECT id, COALESCE(points, 0) FROM achievements WHERE id = ANY(:ids)"),
+            {'ids': list({row.achievement_id for row in deleted})}
+        ).all()) if deleted else {}
+        refunds = Counter()
+        for row in deleted:
+            refunds[row.user_id] += points.get(row.achievement_id, 0)
+        for user_id, amount in refunds.items():
+            if amount:
+                db.session.execute(text(REFUND_SQL), {'user_id': user_id, 'amount': amount})
+
+        for statement in INDEX_SQL:
+            db.session.execute(text(statement))
+        db.session.commit()
+        print(f"Синхронизирован признак повторяемости: {synced}, удалено повторов: {len(deleted)} "
+              f"у пользователей: {len(refunds)} за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == '__main__':
+    main()
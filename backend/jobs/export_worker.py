@@ -0,0 +1,43 @@
+"""
+Воркер фоновых выгрузок диалогов в Parquet.
+
+Задания ставит эндпоинт POST /api/admin/organizations/<id>/exports; воркер забирает их
+из очереди Redis, пишет файл в EXPORT_DIR и обновляет состояние задания, которое
+отдаёт GET /api/admin/exports/<job_id>. Выгрузка идёт серверным курсором, поэтому
+память воркера не зависит от размера организации. Нужен пакет pyarrow.
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.export_worker            # обрабатывать очередь постоянно
+    python -m jobs.export_worker --once     # обработать накопившиеся задания и выйти
+"""
+import argparse
+
+from app import app
+from models.database import db
+from utils.redis_client import redis_client
+from services.dialog_export_service import DialogExportService, EXPORT_QUEUE_KEY
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Воркер фоновых выгрузок диалогов в Parquet')
+    parser.add_argument('--once', action='store_true', help='выйти, когда очередь опустеет')
+    parser.add_argument('--poll-timeout', type=int, default=5, help='ожидание задания в очереди, секунды')
+    args = parser.parse_args()
+
+    with app.app_context():
+        while True:
+            item = redis_client.blpop(EXPORT_QUEUE_KEY, timeout=args.poll_timeout)
+            if item is None:
+                if args.once:
+                    break
+                continue
+            job_id = item[1].decode('utf-8')
+            job = DialogExportService.run_job(job_id)
+            # Между заданиями не держим соединение и объекты сессии
+            db.session.remove()
+            if job:
+                print(f"Выгрузка {job_id}: {job['status']}, строк: {job.get('rows', 0)}")
+
+
+if __name__ == '__main__':
+    main()
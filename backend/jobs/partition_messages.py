@@ -0,0 +1,152 @@
+"""
+Секционирование таблицы messages по месяцам (RANGE по timestamp).
+
+Одноразовое преобразование (--convert) выполняется в одной транзакции и блокирует
+messages на время копирования, поэтому запускать его нужно в окно обслуживания.
+Старая таблица остаётся под именем messages_unpartitioned и удаляется флагом --drop-old
+после проверки. Регулярный запуск без флагов (или из jobs/archive_dialogs.py) создаёт
+секции на ближайшие месяцы; --cold-tablespace переносит старые секции в холодное хранилище.
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.partition_messages --convert
+    python -m jobs.partition_messages --months-ahead 3 --cold-tablespace cold --cold-after-months 12
+"""
+from datetime import date
+import argparse
+
+from sqlalchemy import text
+
+from app import app
+from models.database import db
+
+PARTITION_NAME = 'messages_{year:04d}_{month:02d}'
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned():
+    """
+    Проверяет, секционирована ли уже таблица messages.
+    :return: bool
+    """
+    return bool(db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'messages' AND c.relnamespace = 'public'::regnamespace"
+    )).scalar())
+
+
+def _create_partition(table, month_start):
+    name = PARTITION_NAME.format(year=month_start.year, month=month_start.month)
+    db.session.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{_add_months(month_start, 1).isoformat()}')"
+    ))
+    return name
+
+
+def ensure_partitions(months_ahead=3):
+    """
+    Создаёт месячные секции messages с текущего месяца на months_ahead вперёд (без коммита).
+    :param months_ahead: int
+    :return: список имён секций
+    """
+    current = date.today().replace(day=1)
+    return [_create_partition('messages', _add_months(current, i)) for i in range(months_ahead + 1)]
+
+
+def move_cold_partitions(tablespace, after_months):
+    """
+    Переносит секции старше after_months месяцев в табличное пространство tablespace (без коммита).
+    :param tablespace: строка — имя табличного пространства
+    :param after_months: int
+    :return: список перенесённых секций
+    """
+    boundary = _add_months(date.today().replace(day=1), -after_months)
+    rows = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace "
+        "WHERE p.relname = 'messages' AND c.relname ~ '^messages_[0-9]{4}_[0-9]{2}$' "
+        "AND coalesce(t.spcname, '') <> :tablespace"
+    ), {'tablespace': tablespace}).scalars().all()
+    moved = []
+    for name in sorted(rows):
+        year, month = int(name[9:13]), int(name[14:16])
+        if date(year, month, 1) < boundary:
+            db.session.execute(text(f'ALTER TABLE {name} SET TABLESPACE "{tablespace}"'))
+            moved.append(name)
+    return moved
+
+
+def convert(months_ahead=3):
+    """
+    Преобразует messages в секционированную таблицу и копирует данные (одна транзакция).
+    """
+    db.session.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+    # Ключ секционирования входит в первичный ключ и не может быть NULL
+    db.session.execute(text(
+        'UPDATE messages m SET "timestamp" = coalesce(d.started_at, now()) '
+        'FROM dialogs d WHERE m."timestamp" IS NULL AND d.id = m.dialog_id'
+    ))
+    db.session.execute(text(
+        'CREATE TABLE messages_new (LIKE messages INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")'
+    ))
+    db.session.execute(text('ALTER TABLE messages_new ALTER COLUMN "timestamp" SET NOT NULL'))
+    db.session.execute(text('ALTER TABLE messages_new ADD PRIMARY KEY (id, "timestamp")'))
+    db.session.execute(text("ALTER TABLE messages_new ADD FOREIGN KEY (dialog_id) REFERENCES dialogs (id)"))
+
+    first = db.session.execute(text('SELECT min("timestamp") FROM messages')).scalar()
+    month = (first.date() if first else date.today()).replace(day=1)
+    last = _add_months(date.today().replace(day=1), months_ahead)
+    while month <= last:
+        _create_partition('messages_new', month)
+        month = _add_months(month, 1)
+    # Строки вне созданных диапазонов (например, с часами из будущего) не должны ломать вставку
+    db.session.execute(text("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages_new DEFAULT"))
+
+    db.session.execute(text("INSERT INTO messages_new SELECT * FROM messages"))
+    db.session.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    db.session.execute(text("ALTER INDEX IF EXISTS ix_messages_dialog_id_timestamp RENAME TO ix_messages_unpartitioned_dialog_id_timestamp"))
+    db.session.execute(text("ALTER TABLE messages_new RENAME TO messages"))
+    db.session.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+    db.session.execute(text('CREATE INDEX ix_messages_dialog_id_timestamp ON messages (dialog_id, "timestamp")'))
+    db.session.commit()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('ANALYZE messages')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Секционирование таблицы messages по месяцам')
+    parser.add_argument('--convert', action='store_true', help='преобразовать messages в секционированную таблицу')
+    parser.add_argument('--drop-old', action='store_true', help='удалить messages_unpartitioned после преобразования')
+    parser.add_argument('--months-ahead', type=int, default=3, help='на сколько месяцев вперёд создавать секции')
+    parser.add_argument('--cold-tablespace', help='табличное пространство для старых секций')
+    parser.add_argument('--cold-after-months', type=int, default=12)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.convert:
+            if is_partitioned():
+                print("Таблица messages уже секционирована")
+            else:
+                convert(args.months_ahead)
+                print("Таблица messages секционирована, старая таблица: messages_unpartitioned")
+        if args.drop_old:
+            db.session.execute(text("DROP TABLE IF EXISTS messages_unpartitioned"))
+            db.session.commit()
+            print("messages_unpartitioned удалена")
+        if not is_partitioned():
+            return
+        created = ensure_partitions(args.months_ahead)
+        moved = move_cold_partitions(args.cold_tablespace, args.cold_after_months) if args.cold_tablespace else []
+        db.session.commit()
+        print(f"Секции на ближайшие месяцы: {', '.join(created)}")
+        if moved:
+            print(f"Перенесены в {args.cold_tablespace}: {', '.join(moved)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Воркер повторного анализа диалогов.
+
+Задания ставит эндпоинт POST /api/admin/reanalysis (после изменения
+PromptTemplate.analysis_prompt); воркер забирает их из очереди Redis и переанализирует
+диалоги пачками. Запросы к GigaChat внутри пачки идут параллельно
+(REANALYSIS_CONCURRENCY), общая частота ограничена REANALYSIS_RPS для всех воркеров.
+После каждой пачки прогресс сохраняется в задании, поэтому остановленное задание
+продолжается с того же места (POST /api/admin/reanalysis/<job_id>/resume).
+
+Запуск (из каталога backend, с теми же переменными окружения, что и у приложения):
+    python -m jobs.reanalysis_worker            # обрабатывать очередь постоянно
+    python -m jobs.reanalysis_worker --once     # обработать накопившиеся задания и выйти
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+from models.database import db
+from utils.redis_client import redis_client
+from services.dialog_analysis_service import DialogAnalysisService, REANALYSIS_QUEUE_KEY, REANALYSIS_CONCURRENCY
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Воркер повторного анализа диалогов')
+    parser.add_argument('--once', action='store_true', help='выйти, когда очередь опустеет')
+    parser.add_argument('--poll-timeout', type=int, default=5, help='ожидание задания в очереди, секунды')
+    parser.add_argument('--concurrency', type=int, default=REANALYSIS_CONCURRENCY, help='одновременных запросов к GigaChat')
+    args = parser.parse_args()
+
+    with app.app_context(), ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        while True:
+            item = redis_client.blpop(REANALYSIS_QUEUE_KEY, timeout=args.poll_timeout)
+            if item is None:
+                if args.once:
+                    break
+                continue
+            job_id = item[1].decode('utf-8')
+            job = DialogAnalysisService.run_job(job_id, pool)
+            # Между заданиями не держим соединение и объекты сессии
+            db.session.remove()
+            if job:
+                print(f"Повторный анализ {job_id}: {job['status']}, успешно: {job.get('succeeded', 0)}, "
+                      f"ошибок: {job.get('failed', 0)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Enum, JSON, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Enum, JSON, Text, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.exc import IntegrityError
 from .database import db
@@ -81,6 +81,7 @@ class Organization(db.Model):
     description = Column(String(500))  # Описание организации
     created_at = Column(DateTime, default=datetime.utcnow)  # Дата создания
     is_active = Column(Boolean, default=True)  # Активна ли организация
+    forbidden_words = Column(Text)  # Запрещенные слова в ответах ИИ для сценариев организации
 
     # Связи
     users = relationship("Users", back_populates="organization")  # Пользователи организации
@@ -116,6 +117,7 @@ class Scenario(db.Model):
     difficulty = Column(Integer, default=1)  # Сложность (1-5)
     estimated_time = Column(Integer)  # Оценочное время (в минутах)
     category_id = Column(Integer, ForeignKey('categories.id'))  # Категория (внешний ключ)
+    forbidden_words = Column(Text)  # Запрещенные слова в ответах ИИ для сценария
 
     # Связи
     organization = relationship("Organization", back_populates="scenarios")  # Связь с организацией
@@ -156,6 +158,9 @@ class Dialog(db.Model):
     completed_at = Column(DateTime, nullable=True)  # Время завершения
     is_successful = Column(Boolean, nullable=True)  # Успешность диалога
     is_archived = Column(Boolean, default=False)  # Архивирован ли диалог
+    transcript = Column(LargeBinary)  # Сжатая стенограмма завершённого диалога (utils/transcript_codec.py)
+    analysis_version = Column(String(32))  # Версия промпта, которым получен анализ (services/dialog_analysis_service.py)
+    analyzed_at = Column(DateTime)  # Время последнего анализа
 
     # Связи
     user = relationship("Users", back_populates="dialogs")  # Связь с пользователем
@@ -210,6 +215,14 @@ class UserAchievement(db.Model):
     achievement_id = Column(Integer, ForeignKey('achievements.id'), nullable=False)  # Связь с достижением
     earned_at = Column(DateTime, default=datetime.utcnow)  # Время получения достижения
     progress = Column(Float, default=0.0)  # Прогресс выполнения (0.0 - 1.0)
+    # Копия Achievement.is_repeatable: частичный индекс не может сослаться на другую таблицу
+    is_repeatable = Column(Boolean, default=False, nullable=False, server_default='false')
+
+    # Неповторяемое достижение выдаётся пользователю один раз (нужно для массовой выдачи через ON CONFLICT)
+    __table_args__ = (
+        Index('ux_user_achievements_once', 'user_id', 'achievement_id', unique=True,
+              postgresql_where=~is_repeatable),
+    )
 
     # Связи
     user = relationship("Users", back_populates="user_achievements")  # Связь с пользователем
@@ -288,6 +301,10 @@ class UserStatistics(db.Model):
     total_time_spent = Column(Integer, default=0)  # Общее время в секундах
     average_score = Column(Float, default=0.0)  # Средняя оценка
     successful_dialogs = Column(Integer, default=0)  # Успешные диалоги
+    scored_dialogs = Column(Integer, default=0)  # Диалоги с оценкой (знаменатель average_score)
+    current_streak = Column(Integer, default=0)  # Текущая серия успешных диалогов подряд
+    best_streak = Column(Integer, default=0)  # Лучшая серия успешных диалогов
+    unique_successful_scenarios = Column(Integer, default=0)  # Различные сценарии, пройденные успешно
     created_at = Column(DateTime, default=datetime.utcnow)  # Дата создания
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Дата обновления
 
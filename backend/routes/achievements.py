@@ -1,9 +1,11 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required
+from utils.auth import load_current_user
 from models.models import db, Achievement, UserAchievement, UserRole
 from models.models import Users
 from sqlalchemy.exc import IntegrityError
 from services.achievement_service import AchievementService
+from services.bulk_import_service import BulkImportService
 
 achievements_admin_bp = Blueprint('achievements_admin', __name__)
 
@@ -14,8 +16,10 @@ def get_current_user_achievements():
     Получить список достижений текущего пользователя.
     Возвращает массив достижений с деталями.
     """
-    user_id = get_jwt_identity()
-    achievements_data = AchievementService.get_user_achievements(user_id)
+    current_user = load_current_user()
+    if not current_user:
+        return jsonify({'error': 'Пользователь не найден'}), 404
+    achievements_data = AchievementService.get_user_achievements(current_user.id)
     return jsonify(achievements_data), 200
 
 @achievements_admin_bp.route('/achievements', methods=['GET'], endpoint='get_all_achievements_v2')
@@ -24,8 +28,7 @@ def get_all_achievements():
     """
     Получить список всех достижений (только для администратора).
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -51,8 +54,7 @@ def create_achievement():
     Принимает JSON с полями: title, description, icon, points, is_repeatable, requirements.
     Возвращает созданное достижение.
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -105,6 +107,31 @@ def create_achievement():
         db.session.rollback()
         return jsonify({'error': 'Ошибка при создании достижения', 'details': str(e)}), 500
 
+@achievements_admin_bp.route('/achievements/import', methods=['POST'], endpoint='import_achievements_v2')
+@jwt_required()
+def import_achievements():
+    """
+    Массовый импорт достижений (только для администратора).
+    Принимает JSON-массив (или {"items": [...]}) либо CSV с полями title, description, icon, points,
+    is_repeatable, requirements (в CSV — строкой JSON). Параметр ?dry_run=1 только проверяет записи.
+    Возвращает отчёт об импорте.
+    """
+    current_user = load_current_user()
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    try:
+        rows = BulkImportService.parse_rows(request)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        report = BulkImportService.import_achievements(rows, dry_run=request.args.get('dry_run') in ('1', 'true'))
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': 'Ошибка при импорте достижений', 'details': str(e)}), 500
+    return jsonify(report), 200 if report['failed'] else 201
+
 @achievements_admin_bp.route('/achievements/<int:achievement_id>', methods=['PUT'], endpoint='update_achievement_v2')
 @jwt_required()
 def update_achievement(achievement_id):
@@ -113,8 +140,7 @@ def update_achievement(achievement_id):
     Принимает JSON с новыми значениями полей.
     Пересчитывает баллы у всех пользователей.
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -127,6 +153,10 @@ def update_achievement(achievement_id):
     achievement.is_repeatable = data.get('is_repeatable', achievement.is_repeatable)
     achievement.requirements = data.get('requirements', achievement.requirements)
     try:
+        # Копия признака в выданных достижениях определяет, действует ли для них уникальный индекс
+        UserAchievement.query.filter_by(achievement_id=achievement.id).update(
+            {'is_repeatable': bool(achievement.is_repeatable)}, synchronize_session=False
+        )
         db.session.commit()
         # Пересчитываем баллы у всех пользователей
         AchievementService.recalculate_all_users_points()
@@ -139,6 +169,10 @@ def update_achievement(achievement_id):
             'is_repeatable': achievement.is_repeatable,
             'requirements': achievement.requirements
         }}), 200
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Достижение выдано некоторым пользователям несколько раз: '
+                                 'отзовите повторные выдачи, прежде чем делать его неповторяемым'}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Ошибка при обновлении достижения', 'details': str(e)}), 500
@@ -149,8 +183,7 @@ def delete_achievement(achievement_id):
     """
     Удалить достижение по id (только для администратора).
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -173,8 +206,7 @@ def assign_achievement_to_user():
     Назначить или отменить назначение достижения пользователю (только для администратора).
     Принимает user_id, achievement_id, action ('assign' или 'unassign').
     """
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -196,10 +228,11 @@ def assign_achievement_to_user():
 
     if action == 'assign':
         existing_user_achievement = UserAchievement.query.filter_by(user_id=user_id, achievement_id=achievement_id).first()
-        if existing_user_achievement:
+        if existing_user_achievement and not achievement.is_repeatable:
             return jsonify({'error': 'Достижение уже назначено этому пользователю'}), 409
         try:
-            user_achievement = UserAchievement(user_id=user_id, achievement_id=achievement_id)
+            user_achievement = UserAchievement(user_id=user_id, achievement_id=achievement_id,
+                                               is_repeatable=bool(achievement.is_repeatable))
             db.session.add(user_achievement)
             db.session.commit()
             return jsonify({'message': 'Достижение успешно назначено пользователю'}), 200
@@ -220,14 +253,55 @@ def assign_achievement_to_user():
     else:
         return jsonify({'error': 'Недопустимое действие'}), 400
 
+@achievements_admin_bp.route('/achievements/<int:achievement_id>/bulk', methods=['POST'], endpoint='bulk_assign_achievement_v2')
+@jwt_required()
+def bulk_assign_achievement(achievement_id):
+    """
+    Массово назначить или отозвать достижение (только для администратора).
+    Принимает action ('assign' или 'unassign') и ровно один отбор пользователей:
+    user_ids (список), organization_id или filters (role, organization_id, is_active, q — как в списке пользователей).
+    Баллы за достижение начисляются или списываются тем же запросом.
+    Возвращает matched (пользователей в отборе), changed (изменено) и skipped.
+    """
+    current_admin = load_current_user()
+    if not current_admin or current_admin.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in ('assign', 'unassign'):
+        return jsonify({'error': 'Недопустимое действие'}), 400
+
+    achievement = db.session.get(Achievement, achievement_id)
+    if not achievement:
+        return jsonify({'error': 'Достижение не найдено'}), 404
+
+    try:
+        target_query = AchievementService.build_target_query(
+            user_ids=data.get('user_ids'),
+            organization_id=data.get('organization_id'),
+            filters=data.get('filters')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        if action == 'assign':
+            result = AchievementService.bulk_assign(achievement, target_query)
+        else:
+            result = AchievementService.bulk_unassign(achievement, target_query)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': 'Ошибка при массовом изменении достижения', 'details': str(e)}), 500
+    return jsonify({'action': action, 'achievement_id': achievement.id, **result}), 200
+
 @achievements_admin_bp.route('/achievements/<int:achievement_id>/unassign/<int:user_id>', methods=['DELETE'], endpoint='unassign_achievement_by_path_params_v3')
 @jwt_required()
 def unassign_achievement_by_path_params(achievement_id, user_id):
     """
     Отменить назначение достижения пользователю по id (только для администратора).
     """
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -250,9 +324,8 @@ def get_user_achievements_by_id(user_id):
     """
     Получить список достижений пользователя по его id (для администратора или самого пользователя).
     """
-    current_user_id = get_jwt_identity()
-    current_user = Users.query.get(current_user_id)
-    if not current_user or (current_user.role.value != 'admin' and current_user_id != user_id):
+    current_user = load_current_user()
+    if not current_user or (current_user.role.value != 'admin' and current_user.id != user_id):
         return jsonify({'error': 'Доступ запрещен'}), 403
 
     achievements_data = AchievementService.get_user_achievements(user_id)
@@ -1,7 +1,10 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from models.models import Scenario, UserProgress, Achievement, Users, UserAchievement
+from flask_jwt_extended import jwt_required
+from models.models import Scenario, UserProgress, Achievement, UserAchievement
 from models.database import db
+from sqlalchemy.orm import joinedload
+from utils.auth import get_current_user_model
+from utils.query_budget import query_budget
 from datetime import datetime, timedelta
 import logging
 
@@ -18,11 +21,11 @@ def get_activity():
     Возвращает список событий, агрегированных по дням за последние 7 дней.
     Опционально: параметр 'detailed' для получения детализированных событий.
     """
-    user_id = get_jwt_identity()
-    user = Users.query.get(user_id)
+    user = get_current_user_model()
     if not user:
-        logger.warning(f"User not found for user_id: {user_id}")
+        logger.warning("User not found for current token")
         return jsonify({'dailyActivity': []})
+    user_id = user.id
 
     # Определяем период (7 дней назад)
     week_ago = datetime.utcnow() - timedelta(days=7)
@@ -60,28 +63,31 @@ def get_activity():
 
     # Сортировка по дате (от новых к старым)
     result.sort(key=lambda x: x['date'], reverse=True)
-    logger.info(f"Daily activity for user {user_id}: {result}")
+    logger.debug("Daily activity for user %s: %d days", user_id, len(result))
     return jsonify({'dailyActivity': result})
 
 # Опциональный эндпоинт для детализированных событий (если нужен)
 @activity_bp.route('/detailed', methods=['GET'])
 @jwt_required()
+@query_budget(5)
 def get_detailed_activity():
     """
     Получение детализированных событий активности пользователя (завершённые тренировки, достижения, регистрация).
     Возвращает список событий, отсортированных по дате (от новых к старым).
     """
-    user_id = get_jwt_identity()
-    user = Users.query.get(user_id)
+    user = get_current_user_model()
     if not user:
-        logger.warning(f"User not found for user_id: {user_id}")
+        logger.warning("User not found for current token")
         return jsonify([])
 
     events = []
 
     # Завершённые тренировки
-    for p in UserProgress.query.filter_by(user_id=user.id, status='completed').all():
-        scenario = Scenario.query.get(p.scenario_id)
+    completed_progress = UserProgress.query.options(joinedload(UserProgress.scenario)).filter_by(
+        user_id=user.id, status='completed'
+    ).all()
+    for p in completed_progress:
+        scenario = p.scenario
         if p.updated_at:
             events.append({
                 'date': p.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
@@ -92,8 +98,8 @@ def get_detailed_activity():
             logger.warning(f"UserProgress {p.id} has no updated_at")
 
     # Полученные достижения
-    for ua in UserAchievement.query.filter_by(user_id=user.id).all():
-        achievement = Achievement.query.get(ua.achievement_id)
+    for ua in UserAchievement.query.options(joinedload(UserAchievement.achievement)).filter_by(user_id=user.id).all():
+        achievement = ua.achievement
         if ua.earned_at and achievement:
             events.append({
                 'date': ua.earned_at.strftime('%Y-%m-%d %H:%M:%S'),
@@ -113,5 +119,5 @@ def get_detailed_activity():
 
     # Сортировка по дате (от новых к старым)
     events.sort(key=lambda x: x['date'], reverse=True)
-    logger.info(f"Detailed activity for user {user_id}: {events}")
+    logger.debug("Detailed activity for user %s: %d events", user.id, len(events))
     return jsonify(events)
\ No newline at end of file
@@ -1,6 +1,17 @@
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from models.models import Users, UserRole, Dialog, Achievement, Scenario, Organization
+from flask import Blueprint, jsonify, request, send_file, Response, stream_with_context
+from flask_jwt_extended import jwt_required
+from utils.auth import load_current_user, invalidate_user_cache
+from services.scenario_catalog_service import ScenarioCatalogService
+from services.user_listing_service import UserListingService
+from services.dialog_export_service import DialogExportService, EXPORT_STREAM_MAX_ROWS
+from services.bulk_import_service import BulkImportService
+from services.dialog_analysis_service import DialogAnalysisService
+from services.ai_reply_service import AIReplyService, SPECULATIVE_MAX_FANOUT
+from services.response_filter_service import ResponseFilterService
+from services.analysis_cache_service import AnalysisCacheService
+from utils.query_budget import query_budget
+from utils.profiler import list_profiles, get_profile_path
+from models.models import Users, UserRole, Dialog, Achievement, Scenario, Organization, PromptTemplate
 from models.database import db
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import func
@@ -8,34 +19,42 @@ from datetime import datetime, timedelta
 
 admin_bp = Blueprint('admin', __name__)
 
+def _serialize_admin_user(user):
+    """Преобразует пользователя в словарь для списков админ-панели"""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'role': user.role,
+        'organization_id': user.organization_id,
+        'created_at': user.created_at,
+        'last_login': user.last_login,
+        'is_active': user.is_active
+    }
+
 @admin_bp.route('/users', methods=['GET'])
 @jwt_required()
 def get_all_users():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
-    users = Users.query.all()
-    users_data = []
-    for user in users:
-        users_data.append({
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'role': user.role.value,
-            'created_at': user.created_at.isoformat(),
-            'last_login': user.last_login.isoformat() if user.last_login else None,
-            'is_active': user.is_active
-        })
-    return jsonify(users_data), 200
+    if UserListingService.is_paginated_request(request.args):
+        try:
+            page = UserListingService.get_page(request.args, serialize=_serialize_admin_user)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(page), 200
+
+    # Без параметров пагинации — прежний формат (массив всех пользователей)
+    users = Users.query.order_by(Users.id).all()
+    return jsonify([_serialize_admin_user(user) for user in users]), 200
 
 @admin_bp.route('/users/<int:user_id>', methods=['PUT'])
 @jwt_required()
 def update_user(user_id):
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
 
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -45,13 +64,8 @@ def update_user(user_id):
         return jsonify({'error': 'Пользователь не найден'}), 404
 
     data = request.get_json()
-    print(f"Received data: {data}")
     if 'role' in data:
-        print(f"Role received: {data['role']}")
-        print(f"Role uppercase: {data['role'].upper()}")
         valid_role_names = [r.name for r in UserRole]
-        print(f"Valid role names: {valid_role_names}")
-        print(f"Is received role in valid names? {data['role'].upper() in valid_role_names}")
         # Проверка на допустимые роли, чтобы избежать некорректных значений
         if data['role'].upper() in valid_role_names:
             user_to_update.role = UserRole[data['role'].upper()]
@@ -69,6 +83,7 @@ def update_user(user_id):
 
     try:
         db.session.commit()
+        invalidate_user_cache(user_to_update.id)
         return jsonify({'message': 'Пользователь успешно обновлен', 'user': {
             'id': user_to_update.id,
             'username': user_to_update.username,
@@ -86,8 +101,7 @@ def update_user(user_id):
 @admin_bp.route('/users/<int:user_id>', methods=['DELETE'])
 @jwt_required()
 def delete_user(user_id):
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
 
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -97,12 +111,16 @@ def delete_user(user_id):
         return jsonify({'error': 'Пользователь не найден'}), 404
     
     # Запретить удаление самого себя
-    if user_to_delete.id == current_user_id:
+    if user_to_delete.id == current_admin.id:
         return jsonify({'error': 'Нельзя удалить самого себя'}), 400
 
     try:
+        had_organization = user_to_delete.organization_id is not None
         db.session.delete(user_to_delete)
         db.session.commit()
+        invalidate_user_cache(user_id)
+        if had_organization:
+            ScenarioCatalogService.bump_version()
         return jsonify({'message': 'Пользователь успешно удален'}), 200
     except Exception as e:
         db.session.rollback()
@@ -111,8 +129,7 @@ def delete_user(user_id):
 @admin_bp.route('/stats', methods=['GET'])
 @jwt_required()
 def get_admin_stats():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -137,8 +154,7 @@ def get_admin_stats():
 @admin_bp.route('/stats/daily', methods=['GET'])
 @jwt_required()
 def get_daily_stats():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
@@ -177,8 +193,7 @@ def get_daily_stats():
 @admin_bp.route('/stats/roles', methods=['GET'])
 @jwt_required()
 def get_roles_stats():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
     from models.models import UserRole
@@ -189,8 +204,7 @@ def get_roles_stats():
 @admin_bp.route('/stats/top-scenarios', methods=['GET'])
 @jwt_required()
 def get_top_scenarios():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
     from models.models import Scenario
@@ -206,24 +220,26 @@ def get_top_scenarios():
 
 @admin_bp.route('/stats/achievements-distribution', methods=['GET'])
 @jwt_required()
+@query_budget(3)
 def get_achievements_distribution():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
     from models.models import Achievement, UserAchievement
-    achievements = Achievement.query.all()
-    data = []
-    for ach in achievements:
-        count = UserAchievement.query.filter_by(achievement_id=ach.id).count()
-        data.append({"name": ach.name, "count": count})
-    return jsonify({"labels": [x["name"] for x in data], "counts": [x["count"] for x in data]})
+    # Одним запросом: количество получений по каждому достижению (включая нулевые)
+    rows = (
+        db.session.query(Achievement.name, func.count(UserAchievement.id))
+        .outerjoin(UserAchievement, UserAchievement.achievement_id == Achievement.id)
+        .group_by(Achievement.id, Achievement.name)
+        .order_by(Achievement.id)
+        .all()
+    )
+    return jsonify({"labels": [name for name, _ in rows], "counts": [count for _, count in rows]})
 
 @admin_bp.route('/stats/top-users', methods=['GET'])
 @jwt_required()
 def get_top_users():
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
     top = (
@@ -238,40 +254,54 @@ def get_top_users():
 
 # ========== API ЭНДПОИНТЫ ДЛЯ ОРГАНИЗАЦИЙ ==========
 
+def _organizations_with_counts():
+    """Запрос организаций с количеством пользователей и сценариев (агрегаты считаются одним запросом)"""
+    users_counts = db.session.query(
+        Users.organization_id.label('organization_id'),
+        func.count(Users.id).label('users_count')
+    ).group_by(Users.organization_id).subquery()
+    scenarios_counts = db.session.query(
+        Scenario.organization_id.label('organization_id'),
+        func.count(Scenario.id).label('scenarios_count')
+    ).group_by(Scenario.organization_id).subquery()
+    return db.session.query(
+        Organization,
+        func.coalesce(users_counts.c.users_count, 0),
+        func.coalesce(scenarios_counts.c.scenarios_count, 0)
+    ).outerjoin(
+        users_counts, users_counts.c.organization_id == Organization.id
+    ).outerjoin(
+        scenarios_counts, scenarios_counts.c.organization_id == Organization.id
+    )
+
+def _build_organizations_list():
+    """Список организаций для админ-панели"""
+    return [{
+        'id': org.id,
+        'name': org.name,
+        'description': org.description,
+        'created_at': org.created_at,
+        'users_count': users_count,
+        'scenarios_count': scenarios_count
+    } for org, users_count, scenarios_count in _organizations_with_counts().order_by(Organization.id).all()]
+
 @admin_bp.route('/organizations', methods=['GET'])
 @jwt_required()
 def get_all_organizations():
     """Получить список всех организаций"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
 
-    organizations = Organization.query.all()
-    organizations_data = []
-    for org in organizations:
-        # Подсчитываем количество пользователей и сценариев
-        users_count = Users.query.filter_by(organization_id=org.id).count()
-        scenarios_count = Scenario.query.filter_by(organization_id=org.id).count()
-        
-        organizations_data.append({
-            'id': org.id,
-            'name': org.name,
-            'description': org.description,
-            'created_at': org.created_at.isoformat(),
-            'users_count': users_count,
-            'scenarios_count': scenarios_count
-        })
-    
-    return jsonify(organizations_data), 200
+    # Список кэшируется на версию каталога (меняется при изменении сценариев, организаций и их состава)
+    return ScenarioCatalogService.catalog_response('organizations_admin', _build_organizations_list)
 
 @admin_bp.route('/organizations', methods=['POST'])
 @jwt_required()
 def create_organization():
     """Создать новую организацию"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -286,15 +316,18 @@ def create_organization():
     try:
         new_organization = Organization(
             name=name,
-            description=description
+            description=description,
+            forbidden_words=data.get('forbidden_words')
         )
         db.session.add(new_organization)
         db.session.commit()
+        ScenarioCatalogService.bump_version()
 
         return jsonify({
             'id': new_organization.id,
             'name': new_organization.name,
             'description': new_organization.description,
+            'forbidden_words': new_organization.forbidden_words,
             'created_at': new_organization.created_at.isoformat()
         }), 201
     except IntegrityError:
@@ -308,8 +341,7 @@ def create_organization():
 @jwt_required()
 def update_organization(org_id):
     """Обновить организацию"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -326,13 +358,19 @@ def update_organization(org_id):
         organization.name = name
     if description is not None:
         organization.description = description
+    if 'forbidden_words' in data:
+        organization.forbidden_words = data['forbidden_words']
 
     try:
         db.session.commit()
+        ScenarioCatalogService.bump_version()
+        if 'forbidden_words' in data:
+            ResponseFilterService.bump_version()
         return jsonify({
             'id': organization.id,
             'name': organization.name,
             'description': organization.description,
+            'forbidden_words': organization.forbidden_words,
             'created_at': organization.created_at.isoformat()
         }), 200
     except IntegrityError:
@@ -346,8 +384,7 @@ def update_organization(org_id):
 @jwt_required()
 def delete_organization(org_id):
     """Удалить организацию"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -356,9 +393,8 @@ def delete_organization(org_id):
     if not organization:
         return jsonify({'error': 'Организация не найдена'}), 404
 
-    # Проверяем, есть ли пользователи или сценарии в организации
-    users_count = Users.query.filter_by(organization_id=org_id).count()
-    scenarios_count = Scenario.query.filter_by(organization_id=org_id).count()
+    # Проверяем, есть ли пользователи или сценарии в организации (один запрос)
+    _, users_count, scenarios_count = _organizations_with_counts().filter(Organization.id == org_id).one()
     
     if users_count > 0 or scenarios_count > 0:
         return jsonify({
@@ -368,6 +404,7 @@ def delete_organization(org_id):
     try:
         db.session.delete(organization)
         db.session.commit()
+        ScenarioCatalogService.bump_version()
         return jsonify({'message': 'Организация успешно удалена'}), 200
     except Exception as e:
         db.session.rollback()
@@ -377,8 +414,7 @@ def delete_organization(org_id):
 @jwt_required()
 def get_organization_users(org_id):
     """Получить пользователей организации"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -387,26 +423,21 @@ def get_organization_users(org_id):
     if not organization:
         return jsonify({'error': 'Организация не найдена'}), 404
 
-    users = Users.query.filter_by(organization_id=org_id).all()
-    users_data = []
-    for user in users:
-        users_data.append({
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'role': user.role.value,
-            'is_active': user.is_active,
-            'created_at': user.created_at.isoformat()
-        })
+    if UserListingService.is_paginated_request(request.args):
+        try:
+            page = UserListingService.get_page(request.args, organization_id=org_id, serialize=_serialize_admin_user)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(page), 200
 
-    return jsonify(users_data), 200
+    users = Users.query.filter_by(organization_id=org_id).order_by(Users.id).all()
+    return jsonify([_serialize_admin_user(user) for user in users]), 200
 
 @admin_bp.route('/organizations/<int:org_id>/users', methods=['POST'])
 @jwt_required()
 def add_user_to_organization(org_id):
     """Добавить пользователя в организацию"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -431,17 +462,50 @@ def add_user_to_organization(org_id):
     try:
         user_to_add.organization_id = org_id
         db.session.commit()
+        invalidate_user_cache(user_to_add.id)
+        ScenarioCatalogService.bump_version()
         return jsonify({'message': 'Пользователь успешно добавлен в организацию'}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Ошибка при добавлении пользователя: {str(e)}'}), 500
 
+@admin_bp.route('/organizations/<int:org_id>/users/import', methods=['POST'])
+@jwt_required()
+def import_organization_users(org_id):
+    """
+    Массовое добавление сотрудников в организацию.
+    Принимает JSON-массив (или {"items": [...]}) либо CSV с полями email, username, password, role, is_active.
+    Новые пользователи создаются, существующие (по email) переводятся в организацию.
+    Параметр ?dry_run=1 только проверяет записи.
+    """
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    if not db.session.get(Organization, org_id):
+        return jsonify({'error': 'Организация не найдена'}), 404
+
+    try:
+        rows = BulkImportService.parse_rows(request)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        report = BulkImportService.import_users(rows, org_id, dry_run=request.args.get('dry_run') in ('1', 'true'))
+    except IntegrityError as e:
+        db.session.rollback()
+        return jsonify({'error': 'Конфликт при импорте пользователей', 'details': str(e.orig)}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка при импорте пользователей: {str(e)}'}), 500
+    return jsonify(report), 200 if report['failed'] else 201
+
 @admin_bp.route('/organizations/<int:org_id>/users/<int:user_id>', methods=['DELETE'])
 @jwt_required()
 def remove_user_from_organization(org_id, user_id):
     """Удалить пользователя из организации"""
-    current_admin_id = get_jwt_identity()
-    current_admin = Users.query.get(current_admin_id)
+    current_admin = load_current_user()
 
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -460,6 +524,8 @@ def remove_user_from_organization(org_id, user_id):
     try:
         user.organization_id = None  # Убираем из организации
         db.session.commit()
+        invalidate_user_cache(user.id)
+        ScenarioCatalogService.bump_version()
         return jsonify({'message': 'Пользователь успешно удален из организации'}), 200
     except Exception as e:
         db.session.rollback()
@@ -469,8 +535,7 @@ def remove_user_from_organization(org_id, user_id):
 @jwt_required()
 def get_organization_scenarios(org_id):
     """Получить сценарии организации"""
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
 
     if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -499,8 +564,7 @@ def get_organization_scenarios(org_id):
 @jwt_required()
 def detach_scenario_from_organization(org_id, scenario_id):
     """Отвязать сценарий от организации (не удаляя сам сценарий)."""
-    current_admin_id = get_jwt_identity()
-    current_admin = Users.query.get(current_admin_id)
+    current_admin = load_current_user()
 
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -519,7 +583,293 @@ def detach_scenario_from_organization(org_id, scenario_id):
     try:
         scenario.organization_id = None
         db.session.commit()
+        ScenarioCatalogService.bump_version()
         return jsonify({'message': 'Сценарий отвязан от организации'}), 200
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': f'Не удалось отвязать сценарий: {str(e)}'}), 500 
\ No newline at end of file
+        return jsonify({'error': f'Не удалось отвязать сценарий: {str(e)}'}), 500 
+
+# ========== ПРОФИЛИ ЗАПРОСОВ ==========
+
+@admin_bp.route('/profiles', methods=['GET'])
+@jwt_required()
+def get_request_profiles():
+    """Список сохранённых профилей запросов (speedscope)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    return jsonify(list_profiles()), 200
+
+@admin_bp.route('/profiles/<profile_id>', methods=['GET'])
+@jwt_required()
+def download_request_profile(profile_id):
+    """Скачать профиль запроса (открывается в https://www.speedscope.app)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    path = get_profile_path(profile_id)
+    if not path:
+        return jsonify({'error': 'Профиль не найден'}), 404
+
+    return send_file(path, mimetype='application/json', as_attachment=True,
+                     download_name=f'{profile_id}.speedscope.json')
+
+# ========== ВЫГРУЗКА ДИАЛОГОВ ==========
+
+@admin_bp.route('/organizations/<int:org_id>/export', methods=['GET'])
+@jwt_required()
+def export_organization_dialogs(org_id):
+    """Потоковая выгрузка диалогов организации с оценками и анализом (format=ndjson|csv, from, to, include_messages)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    organization = Organization.query.get(org_id)
+    if not organization:
+        return jsonify({'error': 'Организация не найдена'}), 404
+
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Поддерживаются форматы ndjson и csv'}), 400
+    try:
+        filters = DialogExportService.parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    total = DialogExportService.count_dialogs(org_id, **filters)
+    if total > EXPORT_STREAM_MAX_ROWS:
+        return jsonify({
+            'error': 'Слишком большая выгрузка для потоковой передачи, используйте фоновую выгрузку в Parquet',
+            'total': total,
+            'limit': EXPORT_STREAM_MAX_ROWS
+        }), 413
+
+    rows = DialogExportService.iter_rows(org_id, **filters)
+    if export_format == 'csv':
+        body, mimetype = DialogExportService.stream_csv(rows), 'text/csv; charset=utf-8'
+    else:
+        body, mimetype = DialogExportService.stream_ndjson(rows), 'application/x-ndjson'
+    filename = f"organization_{org_id}_dialogs_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Total-Count': str(total)
+    })
+
+@admin_bp.route('/organizations/<int:org_id>/exports', methods=['POST'])
+@jwt_required()
+def create_organization_export(org_id):
+    """Поставить фоновую выгрузку диалогов организации в Parquet (выполняет jobs/export_worker.py)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    organization = Organization.query.get(org_id)
+    if not organization:
+        return jsonify({'error': 'Организация не найдена'}), 404
+
+    try:
+        filters = DialogExportService.parse_filters(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    job_id = DialogExportService.enqueue_export(org_id, filters, current_user.id)
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
+@admin_bp.route('/exports/<job_id>', methods=['GET'])
+@jwt_required()
+def get_export_status(job_id):
+    """Состояние фоновой выгрузки"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    job = DialogExportService.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Выгрузка не найдена'}), 404
+    return jsonify(job), 200
+
+@admin_bp.route('/exports/<job_id>/download', methods=['GET'])
+@jwt_required()
+def download_export(job_id):
+    """Скачать готовую выгрузку в Parquet"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    path = DialogExportService.get_job_file(job_id)
+    if not path:
+        return jsonify({'error': 'Выгрузка не найдена или ещё не готова'}), 404
+
+    return send_file(path, mimetype='application/vnd.apache.parquet', as_attachment=True,
+                     download_name=f'export_{job_id}.parquet')
+
+@admin_bp.route('/reanalysis', methods=['POST'])
+@jwt_required()
+def create_reanalysis_job():
+    """
+    Поставить повторный анализ завершённых диалогов (выполняет jobs/reanalysis_worker.py).
+    Фильтры: scenario_id, organization_id, from, to; only_stale (по умолчанию true) — только диалоги,
+    проанализированные другой версией промпта анализа.
+    """
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    try:
+        filters = DialogAnalysisService.parse_filters(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    job = DialogAnalysisService.enqueue_job(filters, current_user.id)
+    return jsonify(job), 202
+
+@admin_bp.route('/reanalysis/<job_id>', methods=['GET'])
+@jwt_required()
+def get_reanalysis_status(job_id):
+    """Состояние задания повторного анализа"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    job = DialogAnalysisService.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    return jsonify(job), 200
+
+@admin_bp.route('/reanalysis/<job_id>/resume', methods=['POST'])
+@jwt_required()
+def resume_reanalysis(job_id):
+    """Продолжить прерванное задание повторного анализа с контрольной точки"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    try:
+        job = DialogAnalysisService.resume_job(job_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    if not job:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    return jsonify(job), 202
+
+@admin_bp.route('/reanalysis/<job_id>/cancel', methods=['POST'])
+@jwt_required()
+def cancel_reanalysis(job_id):
+    """Остановить задание повторного анализа после текущей пачки"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    job = DialogAnalysisService.cancel_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    return jsonify(job), 200
+
+@admin_bp.route('/scenarios/<int:scenario_id>/speculative', methods=['GET'])
+@jwt_required()
+def get_scenario_speculative(scenario_id):
+    """Доля выходов из роли по сценарию и число параллельных кандидатов реплики ИИ"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    stats = AIReplyService.get_break_stats(scenario_id)
+    return jsonify(dict(stats, scenario_id=scenario_id, fanout=AIReplyService.choose_fanout(scenario_id, stats))), 200
+
+@admin_bp.route('/scenarios/<int:scenario_id>/speculative', methods=['PUT'])
+@jwt_required()
+def set_scenario_speculative(scenario_id):
+    """Задать число параллельных кандидатов для сценария (fanout: 1..SPECULATIVE_MAX_FANOUT или null — автоматически)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    if not db.session.get(Scenario, scenario_id):
+        return jsonify({'error': 'Сценарий не найден'}), 404
+
+    fanout = (request.get_json(silent=True) or {}).get('fanout')
+    if fanout is not None and (not isinstance(fanout, int) or isinstance(fanout, bool) or not 1 <= fanout <= SPECULATIVE_MAX_FANOUT):
+        return jsonify({'error': f'fanout должен быть целым от 1 до {SPECULATIVE_MAX_FANOUT} или null'}), 400
+
+    AIReplyService.set_fanout_override(scenario_id, fanout)
+    stats = AIReplyService.get_break_stats(scenario_id)
+    return jsonify(dict(stats, scenario_id=scenario_id, fanout=AIReplyService.choose_fanout(scenario_id, stats))), 200
+
+@admin_bp.route('/role-breaks', methods=['GET'])
+@jwt_required()
+def get_role_break_report():
+    """Телеметрия выходов из роли по сценариям и шаблонам промптов (сценарии — по убыванию доли выходов)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    scenarios = db.session.query(Scenario.id, Scenario.name, Scenario.prompt_template_id).all()
+    template_ids = sorted({row.prompt_template_id for row in scenarios if row.prompt_template_id})
+    template_names = dict(db.session.query(PromptTemplate.id, PromptTemplate.name)
+                          .filter(PromptTemplate.id.in_(template_ids)).all()) if template_ids else {}
+    scenario_stats, template_stats = AIReplyService.get_break_report([row.id for row in scenarios], template_ids)
+
+    scenario_items = [
+        dict(scenario_stats[row.id], scenario_id=row.id, name=row.name, prompt_template_id=row.prompt_template_id)
+        for row in scenarios if scenario_stats[row.id]['turns']
+    ]
+    scenario_items.sort(key=lambda item: item['rate'] or 0, reverse=True)
+    template_items = [
+        dict(template_stats[template_id], prompt_template_id=template_id, name=template_names.get(template_id))
+        for template_id in template_ids if template_stats[template_id]['turns']
+    ]
+    template_items.sort(key=lambda item: item['rate'] or 0, reverse=True)
+    return jsonify({'scenarios': scenario_items, 'templates': template_items}), 200
+
+@admin_bp.route('/scenarios/<int:scenario_id>/role-breaks', methods=['DELETE'])
+@jwt_required()
+def reset_scenario_role_breaks(scenario_id):
+    """Сбросить телеметрию выходов из роли по сценарию (вместе с ней отключается усиленный промпт с первой попытки)"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    if not db.session.get(Scenario, scenario_id):
+        return jsonify({'error': 'Сценарий не найден'}), 404
+
+    AIReplyService.reset_break_stats(scenario_id)
+    return jsonify({'message': 'Статистика выходов из роли сброшена', 'scenario_id': scenario_id}), 200
+
+@admin_bp.route('/analysis-cache', methods=['GET'])
+@jwt_required()
+def get_analysis_cache_stats():
+    """Статистика кэша анализа диалогов: режим, попадания, промахи, доля попаданий, число записей"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    return jsonify(AnalysisCacheService.get_stats()), 200
+
+@admin_bp.route('/analysis-cache', methods=['DELETE'])
+@jwt_required()
+def clear_analysis_cache():
+    """Очистить кэш анализа диалогов"""
+    current_user = load_current_user()
+
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    deleted = AnalysisCacheService.clear()
+    return jsonify({'message': 'Кэш анализа очищен', 'deleted_keys': deleted}), 200
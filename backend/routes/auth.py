@@ -4,8 +4,11 @@ from models.models import Users, UserPreferences, UserStatistics, UserRole
 from models.database import db
 from datetime import datetime
 from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, unset_jwt_cookies
-import traceback
 from services.achievement_service import AchievementService
+from utils.auth import get_current_user_model
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Blueprint для маршрутов аутентификации
 auth_bp = Blueprint('auth', __name__)
@@ -77,7 +80,7 @@ def register():
     except Exception as e:
         db.session.rollback()
         # Логируем полную информацию об ошибке для отладки
-        print(f"Ошибка при регистрации: {e}\n{traceback.format_exc()}")
+        logger.exception("Ошибка при регистрации: %s", e)
         return jsonify({'error': 'Ошибка при регистрации', 'details': str(e)}), 500
 
 @auth_bp.route('/login', methods=['POST'])
@@ -115,7 +118,7 @@ def login():
             'access_token': access_token,
             'refresh_token': refresh_token
         })
-        print(f"Login Response: {response.json}")
+        logger.info("Успешный вход пользователя %s", user.id, extra={'sampled': True})
         return response, 200
     
     return jsonify({'error': 'Неверный email или пароль'}), 401
@@ -137,19 +140,17 @@ def check_auth():
     Проверка авторизации пользователя по JWT.
     Если токен валиден и пользователь активен — возвращает информацию о пользователе.
     """
-    user_id = get_jwt_identity()
-    if user_id:
-        user = Users.query.get(user_id)
-        if user and user.is_active:
-            return jsonify({
-                'success': True,
-                'user': {
-                    'id': user.id,
-                    'email': user.email,
-                        'name': user.username,
-                        'role': user.role.value
-                }
-            }), 200
+    user = get_current_user_model()
+    if user and user.is_active:
+        return jsonify({
+            'success': True,
+            'user': {
+                'id': user.id,
+                'email': user.email,
+                'name': user.username,
+                'role': user.role.value
+            }
+        }), 200
     return jsonify({'success': False}), 401
 
 @auth_bp.route('/refresh', methods=['POST'])
@@ -1,11 +1,20 @@
 import os
 from flask import Blueprint, request, jsonify, current_app
-from models.models import Scenario, Dialog, Message, Users, UserStatistics, Achievement, UserAchievement, UserProgress, PromptTemplate
+from models.models import Scenario, Dialog, Message, UserStatistics, Achievement, UserAchievement, UserProgress, PromptTemplate
 from models.database import db
 import requests
 from datetime import datetime
-from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request, jwt_required
+from flask_jwt_extended import verify_jwt_in_request, jwt_required
 from services.gigachat_service import gigachat_service
+from services.chat_turn_service import ChatTurnService
+from services.ai_reply_service import AIReplyService
+from services.dialog_archive_service import DialogArchiveService
+from services.dialog_analysis_service import DialogAnalysisService, SCORING_INSTRUCTIONS
+from services.analysis_cache_service import AnalysisCacheService
+from services.scenario_catalog_service import ScenarioCatalogService
+from services.response_filter_service import ResponseFilterService
+from utils.auth import load_current_user, get_current_user_model
+from utils.metrics import llm_phase
 import time
 from utils.redis_client import redis_client
 import json
@@ -16,38 +25,6 @@ chat_bp = Blueprint('chat', __name__)
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
-# Определение списков для фильтрации ответов ИИ
-FORBIDDEN_KEYWORDS = [
-    # Существенно сокращено: оставляем только признаки самораскрытия ИИ и форматирование
-    'чат-бот', 'бот', 'искусственный интеллект',
-    'markdown', 'я ассистент', 'я бот', 'я искусственный интеллект', 'нейросеть'
-]
-
-# Фразы, которые указывают на выход из роли (переход к роли помощника)
-ROLE_BREAK_PHRASES = [
-    "я здесь, чтобы поддерживать уважительное и конструктивное общение",
-    "давайте обсудим",
-    "я всегда готов к уважительному диалогу",
-    "если вас что-то беспокоит или раздражает, давайте обсудим это без оскорблений",
-    "чем могу помочь",
-    "я всегда готов помочь",
-    "давайте обсудим спокойно",
-    "я здесь, чтобы помочь",
-    "я всегда готов к диалогу",
-    "извиняюсь", "извините", "помогу", "помочь", "решим", "решение проблемы",
-    # Ниже сохранены сервисные фразы персонала; их наличие значит выход из роли клиента
-    "скидка", "заменим", "компенсация", "предлагаю", "предложить",
-    "мы всё исправим", "как вам будет удобнее",
-    "мы вам заменим", "мы вам почистим", "мы вам компенсируем", "мы вам организуем",
-    "я сейчас всё поменяю", "я сейчас всё решу", "я сейчас всё исправлю", "я сейчас всё организую", "я сейчас всё улажу",
-    "давайте решим вопрос", "давайте решим ситуацию", "давайте решим проблему", "давайте уладим ситуацию",
-    "организуем замену", "организуем чистку", "организуем возврат", "организуем компенсацию", "организуем решение",
-    "приношу извинения", "приносим извинения", "приношу свои извинения", "приносим свои извинения",
-    "всё за наш счёт", "всё за мой счёт", "мы всё оплатим", "мы всё компенсируем", "мы всё уладим", "мы всё решим",
-    "могу вызвать курьера", "могу организовать курьера", "могу организовать замену", "могу организовать чистку",
-    "могу организовать возврат", "могу организовать компенсацию",
-]
-
 def send_gigachat_message(messages, temperature=0.7, max_tokens=1024, model=None):
     """
     Отправка сообщения в GigaChat API
@@ -133,11 +110,12 @@ def get_categories():
     """
     Получение списка всех категорий сценариев
     """
-    try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+    def build_categories():
         categories = db.session.query(Scenario.category).distinct().all()
-        return jsonify([category[0] for category in categories if category[0]])
+        return [category[0] for category in categories if category[0]]
+
+    try:
+        return ScenarioCatalogService.catalog_response('categories', build_categories)
     except Exception as e:
         return jsonify({'error': 'Ошибка при получении категорий', 'details': str(e)}), 500
 
@@ -147,14 +125,15 @@ def get_subcategories(category):
     """
     Получение подкатегорий для выбранной категории
     """
-    try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+    def build_subcategories():
         subcategories = db.session.query(Scenario.subcategory).filter(
             Scenario.category == category,
             Scenario.is_active == True
         ).distinct().all()
-        return jsonify([subcategory[0] for subcategory in subcategories if subcategory[0]])
+        return [subcategory[0] for subcategory in subcategories if subcategory[0]]
+
+    try:
+        return ScenarioCatalogService.catalog_response(f'subcategories:{category}', build_subcategories)
     except Exception as e:
         return jsonify({'error': 'Ошибка при получении подкатегорий', 'details': str(e)}), 500
 
@@ -165,8 +144,6 @@ def get_scenario(category, subcategory):
     Получение информации о сценарии
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
         scenario = Scenario.query.filter_by(
             category=category,
             subcategory=subcategory,
@@ -195,8 +172,7 @@ def start_or_get_session():
     """
     try:
         verify_jwt_in_request()
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         if not current_user:
             return jsonify({'error': 'User not found from token'}), 401
     except Exception as e:
@@ -264,20 +240,9 @@ def start_or_get_session():
                             current_app.logger.error(f"Ошибка при первой реплике (существующий диалог), попытка {attempt+1}: {str(e)}")
                             time.sleep(0.6)
                     if ai_text:
-                        ai_message = Message(
-                            dialog_id=existing_dialog.id,
-                            sender='assistant',
-                            text=ai_text,
-                            timestamp=datetime.utcnow()
-                        )
-                        db.session.add(ai_message)
+                        ai_message = ChatTurnService.add_message(existing_dialog, 'assistant', ai_text)
                         db.session.commit()
-                        first_ai_message = {
-                            'id': ai_message.id,
-                            'sender': ai_message.sender,
-                            'text': ai_message.text,
-                            'timestamp': ai_message.timestamp.isoformat()
-                        }
+                        first_ai_message = ChatTurnService.serialize_message(ai_message)
                 except Exception as e:
                     current_app.logger.error(f"Ошибка при первой реплике для существующего диалога: {str(e)}")
 
@@ -293,88 +258,104 @@ def start_or_get_session():
                 'is_new_session': False
             }), 200
 
-        # Активной сессии нет — создаём новую
-        dialog = Dialog(
-            user_id=current_user.id,
-            scenario_id=scenario_id,
-            status='active',
-            started_at=datetime.utcnow()
-        )
-        db.session.add(dialog)
-        db.session.commit()
+        # Активной сессии нет — создаём новую.
+        # Диалог и первая реплика записываются одним коммитом после ответа нейросети
+        # Параллельный запрос уже создаёт сессию по этому сценарию
+        if not ChatTurnService.acquire_session_start(current_user.id, scenario_id):
+            return jsonify({'error': 'Сессия уже создаётся'}), 409
+        try:
+            started_at = datetime.utcnow()
 
-        # Получаем первую реплику от нейросети только для новой сессии
-        first_prompt = generate_system_prompt_for_start(scenario)
-        first_ai_message = None
+            # Получаем первую реплику от нейросети только для новой сессии
+            first_prompt = generate_system_prompt_for_start(scenario)
+            first_ai_message = None
         
-        api_params = {
-            'model': 'GigaChat',
-            'messages': [
-                {'role': 'system', 'content': first_prompt},
-                {'role': 'user', 'content': 'Начни диалог как описано в инструкции. Сразу войди в роль и начни конфликт.'}
-            ],
-            'temperature': 0.8,
-            'max_tokens': 300,
-            'top_p': 0.9,
-            'frequency_penalty': 0.1,
-            'presence_penalty': 0.1
-        }
+            api_params = {
+                'model': 'GigaChat',
+                'messages': [
+                    {'role': 'system', 'content': first_prompt},
+                    {'role': 'user', 'content': 'Начни диалог как описано в инструкции. Сразу войди в роль и начни конфликт.'}
+                ],
+                'temperature': 0.8,
+                'max_tokens': 300,
+                'top_p': 0.9,
+                'frequency_penalty': 0.1,
+                'presence_penalty': 0.1
+            }
         
-        try:
-            # Ретраи генерации первой реплики
-            ai_text = None
-            for attempt in range(3):
-                try:
-                    response = gigachat_service.send(api_params, retries=1)
-                    # Обработка недостаточного баланса — прекращаем попытки
-                    if response and isinstance(response, dict) and response.get('error', {}).get('code') == 'insufficient_balance':
-                        ai_text = get_fallback_response(scenario, reason='insufficient_balance')
-                        break
-                    
-                    if response and response.get('choices'):
-                        candidate = response['choices'][0]['message']['content'].strip()
-                        filtered = filter_ai_response(candidate, scenario)
-                        if filtered and filtered != '__ROLE_BREAK__':
-                            ai_text = filtered
+            try:
+                # Ретраи генерации первой реплики
+                ai_text = None
+                for attempt in range(3):
+                    try:
+                        response = gigachat_service.send(api_params, retries=1)
+                        # Обработка недостаточного баланса — прекращаем попытки
+                        if response and isinstance(response, dict) and response.get('error', {}).get('code') == 'insufficient_balance':
+                            ai_text = get_fallback_response(scenario, reason='insufficient_balance')
                             break
-                        else:
-                            api_params['messages'][0]['content'] += "\n\nСтрого: не выходи из роли клиента, не извиняйся, не предлагай помощь, не упоминай Markdown."
-                            api_params['temperature'] = min(0.95, api_params.get('temperature', 0.8) + 0.05)
-                    time.sleep(0.4)
-                except Exception as e:
-                    current_app.logger.error(f"Ошибка при получении первой реплики, попытка {attempt+1}: {str(e)}")
-                    time.sleep(0.6)
-            
-            if ai_text:
-                ai_message = Message(
-                    dialog_id=dialog.id,
-                    sender='assistant',
-                    text=ai_text,
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(ai_message)
-                db.session.commit()
-                
-                first_ai_message = {
-                    'id': ai_message.id,
-                    'sender': ai_message.sender,
-                    'text': ai_message.text,
-                    'timestamp': ai_message.timestamp.isoformat()
-                }
                     
-        except Exception as e:
-            current_app.logger.error(f"Ошибка при получении первой реплики: {str(e)}")
+                        if response and response.get('choices'):
+                            candidate = response['choices'][0]['message']['content'].strip()
+                            filtered = filter_ai_response(candidate, scenario)
+                            if filtered and filtered != '__ROLE_BREAK__':
+                                ai_text = filtered
+                                break
+                            else:
+                                api_params['messages'][0]['content'] += "\n\nСтрого: не выходи из роли клиента, не извиняйся, не предлагай помощь, не упоминай Markdown."
+                                api_params['temperature'] = min(0.95, api_params.get('temperature', 0.8) + 0.05)
+                        time.sleep(0.4)
+                    except Exception as e:
+                        current_app.logger.error(f"Ошибка при получении первой реплики, попытка {attempt+1}: {str(e)}")
+                        time.sleep(0.6)
             
-        return jsonify({
-            'dialog_id': dialog.id,
-            'scenario': {
-                'id': scenario.id,
-                'name': scenario.name,
-                'description': scenario.description
-            },
-            'first_ai_message': first_ai_message,
-            'is_new_session': True
-        }), 200
+            except Exception as e:
+                current_app.logger.error(f"Ошибка при получении первой реплики: {str(e)}")
+                ai_text = None
+
+            # Повторная проверка: за время ожидания нейросети диалог мог создать другой запрос
+            # (например, если блокировка истекла или Redis недоступен)
+            existing_dialog = Dialog.query.filter_by(
+                user_id=current_user.id,
+                scenario_id=scenario_id,
+                status='active'
+            ).order_by(Dialog.started_at.desc()).first()
+            if existing_dialog:
+                return jsonify({
+                    'dialog_id': existing_dialog.id,
+                    'scenario': {
+                        'id': scenario.id,
+                        'name': scenario.name,
+                        'description': scenario.description
+                    },
+                    'first_ai_message': None,
+                    'is_new_session': False
+                }), 200
+
+            dialog = Dialog(
+                user_id=current_user.id,
+                scenario_id=scenario_id,
+                status='active',
+                started_at=started_at
+            )
+            db.session.add(dialog)
+            ai_message = ChatTurnService.add_message(dialog, 'assistant', ai_text) if ai_text else None
+            db.session.commit()
+
+            if ai_message:
+                first_ai_message = ChatTurnService.serialize_message(ai_message)
+            
+            return jsonify({
+                'dialog_id': dialog.id,
+                'scenario': {
+                    'id': scenario.id,
+                    'name': scenario.name,
+                    'description': scenario.description
+                },
+                'first_ai_message': first_ai_message,
+                'is_new_session': True
+            }), 200
+        finally:
+            ChatTurnService.release_session_start(current_user.id, scenario_id)
         
     except Exception as e:
         current_app.logger.error(f"Ошибка в start_or_get_session: {str(e)}")
@@ -388,8 +369,7 @@ def get_session_messages(dialog_id):
     Получить историю сообщений диалога
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         
         # Проверяем, что диалог принадлежит текущему пользователю
         dialog = Dialog.query.filter_by(
@@ -400,19 +380,14 @@ def get_session_messages(dialog_id):
         if not dialog:
             return jsonify({'error': 'Диалог не найден'}), 404
             
-        # Получаем все сообщения диалога в хронологическом порядке
-        messages = Message.query.filter_by(dialog_id=dialog_id).order_by(Message.timestamp).all()
+        # Получаем все сообщения диалога в хронологическом порядке (для старых архивных — из сжатого архива)
+        messages = DialogArchiveService.get_messages(dialog)
         return jsonify({
             'dialog_id': dialog.id,
             'status': getattr(dialog, 'status', None),
             'started_at': dialog.started_at.isoformat(),
             'completed_at': getattr(dialog, 'completed_at', None).isoformat() if getattr(dialog, 'completed_at', None) else None,
-            'messages': [{
-                'id': m.id,
-                'sender': m.sender,
-                'text': m.text,
-                'timestamp': m.timestamp.isoformat()
-            } for m in messages]
+            'messages': [m._asdict() for m in messages]
         })
     except Exception as e:
         return jsonify({'error': 'Ошибка при получении сообщений', 'details': str(e)}), 500
@@ -424,8 +399,7 @@ def send_session_message(dialog_id):
     Отправка сообщения в диалог с обработкой завершения
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = get_current_user_model()
         data = request.get_json()
         message_content = data.get('message', '').strip()
         
@@ -448,20 +422,23 @@ def send_session_message(dialog_id):
         if message_content.upper() == 'ЗАВЕРШИТЬ СИМУЛЯЦИЮ':
             return complete_dialog_with_simulation_command(dialog, current_user, message_content, data)
         
-        # Сохраняем обычное сообщение пользователя
-        user_message = Message(
-            dialog_id=dialog_id,
-            sender='user',
-            text=message_content,
-            timestamp=datetime.utcnow()
-        )
-        db.session.add(user_message)
-        db.session.commit()
+        # Повтор запроса клиентом с тем же ключом не должен создавать дубликаты
+        idempotency_key = ChatTurnService.get_idempotency_key(request, data)
+        turn_state, cached_response = ChatTurnService.begin(dialog_id, idempotency_key)
+        if turn_state == 'done':
+            return jsonify(cached_response), 200
+        if turn_state == 'in_progress':
+            return jsonify({'error': 'Сообщение уже обрабатывается'}), 409
+
+        # Сообщение пользователя запишем вместе с ответом ИИ одной транзакцией
+        user_timestamp = datetime.utcnow()
 
         # Получаем историю сообщений для контекста (ограничиваем количество)
-        messages = Message.query.filter_by(dialog_id=dialog_id).order_by(Message.timestamp).all()
         max_history = 10
-        messages_for_context = messages[-max_history:]
+        messages_for_context = Message.query.filter_by(dialog_id=dialog_id).order_by(
+            Message.timestamp.desc()
+        ).limit(max_history - 1).all()
+        messages_for_context.reverse()
         
         # Формируем контекст для API
         history = []
@@ -470,10 +447,11 @@ def send_session_message(dialog_id):
         # Добавляем системный промпт
         history.append({'role': 'system', 'content': system_prompt})
         
-        # Добавляем историю диалога
+        # Добавляем историю диалога и текущее сообщение пользователя
         for m in messages_for_context:
             role = 'user' if m.sender == 'user' else 'assistant'
             history.append({'role': role, 'content': m.text})
+        history.append({'role': 'user', 'content': message_content})
 
         # Параметры для продолжения диалога
         api_params = {
@@ -486,72 +464,83 @@ def send_session_message(dialog_id):
             'presence_penalty': 0.15
         }
         
-        # Получаем ответ от ИИ с повторными попытками
+        # Получаем ответ от ИИ: для сценариев с частым выходом из роли — усиленный промпт с первой попытки
+        # и несколько кандидатов параллельно, иначе последовательные повторы
         ai_content = None
-        retry_count = 0
-        max_retries = 3
-        
-        while retry_count < max_retries:
-            try:
-                response = gigachat_service.send(api_params, retries=1)
-                # Если провайдер вернул недостаточный баланс — не мучаем ретраи
-                if response and isinstance(response, dict) and response.get('error', {}).get('code') == 'insufficient_balance':
-                    ai_content = get_fallback_response(dialog.scenario, reason='insufficient_balance')
-                    break
-                
-                if response and response.get('choices'):
-                    raw_ai_content = response['choices'][0]['message']['content'].strip()
-                    ai_content = filter_ai_response(raw_ai_content, dialog.scenario)
-                    
-                    # Если контент прошел фильтрацию, используем его
-                    if ai_content and ai_content != '__ROLE_BREAK__':
+        break_stats = AIReplyService.get_break_stats(dialog.scenario_id)
+        outcome = AIReplyService.new_turn_outcome(hardened=AIReplyService.should_harden(break_stats))
+        if outcome['hardened']:
+            api_params = preharden_api_params(api_params, dialog.scenario)
+        fanout = AIReplyService.choose_fanout(dialog.scenario_id, break_stats)
+        if fanout > 1:
+            ai_content = AIReplyService.generate_speculative(
+                api_params,
+                fanout,
+                accept=lambda text: role_break_reason(text, dialog.scenario),
+                harden=lambda params: harden_api_params(params, dialog.scenario),
+                outcome=outcome
+            )
+            if outcome['insufficient_balance']:
+                ai_content = get_fallback_response(dialog.scenario, reason='insufficient_balance')
+        else:
+            retry_count = 0
+            max_retries = 3
+
+            while retry_count < max_retries:
+                try:
+                    response = gigachat_service.send(api_params, retries=1)
+                    # Если провайдер вернул недостаточный баланс — не мучаем ретраи
+                    if response and isinstance(response, dict) and response.get('error', {}).get('code') == 'insufficient_balance':
+                        outcome['insufficient_balance'] = True
+                        ai_content = get_fallback_response(dialog.scenario, reason='insufficient_balance')
                         break
-                    elif ai_content == '__ROLE_BREAK__':
+
+                    if response and response.get('choices'):
+                        raw_ai_content = response['choices'][0]['message']['content'].strip()
+                        reason = role_break_reason(raw_ai_content, dialog.scenario)
+                        AIReplyService.note_attempt(outcome, reason, plain=not outcome['hardened'] and not outcome['breaks'])
+
+                        # Если контент прошел фильтрацию, используем его
+                        if reason is None:
+                            ai_content = raw_ai_content
+                            break
                         # Если ИИ вышел из роли, корректируем промпт и пробуем еще раз
-                        api_params['messages'][-1]['content'] += f"\n\nВНИМАНИЕ! Ты вышел из роли. Ты должен отвечать ТОЛЬКО как {dialog.scenario.ai_role}. Не извиняйся, не предлагай помощь, оставайся злым и конфликтным!"
-                        api_params['temperature'] = min(0.95, api_params['temperature'] + 0.1)
-                        
-                retry_count += 1
-                time.sleep(0.5)
-                
-            except Exception as e:
-                current_app.logger.error(f"Ошибка при запросе к API, попытка {retry_count + 1}: {str(e)}")
-                retry_count += 1
-                time.sleep(1)
-        
+                        api_params = harden_api_params(api_params, dialog.scenario)
+
+                    retry_count += 1
+                    time.sleep(0.5)
+
+                except Exception as e:
+                    current_app.logger.error(f"Ошибка при запросе к API, попытка {retry_count + 1}: {str(e)}")
+                    retry_count += 1
+                    time.sleep(1)
+
         # Если не удалось получить валидный ответ
-        if not ai_content or ai_content == '__ROLE_BREAK__':
+        if not ai_content:
             ai_content = get_fallback_response(dialog.scenario, reason='gigachat_unavailable')
+            outcome['fallback'] = True
             current_app.logger.error("Использован резервный ответ")
-                
-        # Сохраняем ответ ИИ в базу данных
-        ai_message = Message(
-            dialog_id=dialog_id,
-            sender='assistant',
-            text=ai_content,
-            timestamp=datetime.utcnow()
+        elif outcome['insufficient_balance']:
+            outcome['fallback'] = True
+        AIReplyService.record_turn(dialog.scenario_id, dialog.scenario.prompt_template_id, outcome)
+
+        # Сохраняем сообщение пользователя, ответ ИИ и счётчики одним коммитом
+        user_message, ai_message = ChatTurnService.persist_turn(
+            dialog, message_content, ai_content, user_timestamp
         )
-        db.session.add(ai_message)
-        db.session.commit()
         
-        return jsonify({
-            'user_message': {
-                'id': user_message.id,
-                'sender': user_message.sender,
-                'text': user_message.text,
-                'timestamp': user_message.timestamp.isoformat()
-            },
-            'ai_message': {
-                'id': ai_message.id,
-                'sender': ai_message.sender,
-                'text': ai_message.text,
-                'timestamp': ai_message.timestamp.isoformat()
-            }
-        }), 200
+        response_data = {
+            'user_message': ChatTurnService.serialize_message(user_message),
+            'ai_message': ChatTurnService.serialize_message(ai_message)
+        }
+        ChatTurnService.finish(dialog_id, idempotency_key, response_data)
+        return jsonify(response_data), 200
             
     except Exception as e:
         current_app.logger.error(f"Необработанная ошибка в send_session_message: {str(e)}")
         db.session.rollback()
+        if 'idempotency_key' in locals():
+            ChatTurnService.release(dialog_id, idempotency_key)
         return jsonify({'error': 'Ошибка при отправке сообщения', 'details': str(e)}), 500
 
 @chat_bp.route('/sessions', methods=['GET'])
@@ -565,8 +554,7 @@ def list_user_sessions():
     - include_archived: true|false (необязательно, по умолчанию false)
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         if not current_user:
             return jsonify({'error': 'Пользователь не найден'}), 404
 
@@ -592,8 +580,9 @@ def list_user_sessions():
         # Собираем краткую информацию
         result = []
         for d in dialogs:
-            # Получаем последнее сообщение для превью
-            last_msg = (
+            # Получаем последнее сообщение для превью (у диалогов в холодном архиве оно хранится в самом архиве)
+            archived_preview = DialogArchiveService.get_last_message_preview(d)
+            last_msg = None if archived_preview else (
                 Message.query.filter_by(dialog_id=d.id)
                 .order_by(Message.timestamp.desc())
                 .first()
@@ -603,15 +592,15 @@ def list_user_sessions():
                 'scenario_id': d.scenario_id,
                 'scenario_name': getattr(d.scenario, 'name', None),
                 'status': getattr(d, 'status', None),
-                'started_at': d.started_at.isoformat() if getattr(d, 'started_at', None) else None,
-                'completed_at': getattr(d, 'completed_at', None).isoformat() if getattr(d, 'completed_at', None) else None,
+                'started_at': d.started_at,
+                'completed_at': d.completed_at,
                 'duration': getattr(d, 'duration', None),
                 'is_archived': bool(getattr(d, 'is_archived', False)),
                 'last_message': {
                     'sender': getattr(last_msg, 'sender', None),
                     'text': getattr(last_msg, 'text', None),
-                    'timestamp': last_msg.timestamp.isoformat() if last_msg and getattr(last_msg, 'timestamp', None) else None,
-                } if last_msg else None
+                    'timestamp': last_msg.timestamp,
+                } if last_msg else archived_preview
             })
 
         return jsonify({'sessions': result}), 200
@@ -624,8 +613,7 @@ def list_user_sessions():
 @jwt_required()
 def archive_session(dialog_id):
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         dialog = Dialog.query.filter_by(id=dialog_id, user_id=current_user.id).first()
         if not dialog:
             return jsonify({'error': 'Диалог не найден'}), 404
@@ -640,12 +628,13 @@ def archive_session(dialog_id):
 @jwt_required()
 def restore_session(dialog_id):
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         dialog = Dialog.query.filter_by(id=dialog_id, user_id=current_user.id).first()
         if not dialog:
             return jsonify({'error': 'Диалог не найден'}), 404
         dialog.is_archived = False
+        # Сообщения из холодного архива возвращаются в таблицу messages
+        DialogArchiveService.restore_dialog(dialog)
         db.session.commit()
         return jsonify({'message': 'Диалог восстановлен', 'dialog_id': dialog.id}), 200
     except Exception as e:
@@ -673,6 +662,12 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
         dialog.status = 'completed'
         dialog.completed_at = datetime.utcnow()
         
+        # Длительность нужна статистике ниже; как в finish_dialog — из запроса или по времени диалога
+        try:
+            dialog.duration = int(duration) if duration else 0
+        except (ValueError, TypeError):
+            dialog.duration = int((dialog.completed_at - dialog.started_at).total_seconds())
+        
         # Коммитим основные изменения диалога
         try:
             db.session.commit()
@@ -682,23 +677,21 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
 
         # Получаем сообщения для анализа
         try:
-            messages = Message.query.filter_by(dialog_id=dialog.id).order_by(Message.timestamp).all()
+            messages = DialogArchiveService.get_messages(dialog)
         except Exception as e:
             messages = []
 
         # Формируем текст диалога для анализа
         dialog_text = ""
         try:
-            dialog_messages = [m for m in messages if m.sender in ['user', 'assistant']]
-            dialog_text = "\n".join([
-                f"{'Пользователь' if m.sender == 'user' else 'ИИ'}: {m.text}" 
-                for m in dialog_messages
-            ])
+            dialog_text = build_dialog_text(messages)
         except Exception as e:
             dialog_text = "Ошибка при формировании диалога для анализа"
 
         # Получаем анализ от ИИ
         analysis = "Анализ временно недоступен"
+        analysis_version = None
+        scoring = None
         
         if dialog_text and len(dialog_text) > 10:
             # Пытаемся получить промпт анализа из шаблона сценария
@@ -711,59 +704,24 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
                 except Exception as e:
                     current_app.logger.warning(f"Не удалось загрузить шаблон анализа: {e}")
             
-            # Если есть кастомный промпт из шаблона, используем его
-            if analysis_prompt_template:
-                # Подставляем переменные в шаблон
-                analysis_prompt = analysis_prompt_template.replace('{dialog_text}', dialog_text)
-                analysis_prompt = analysis_prompt.replace('{scenario_description}', getattr(dialog.scenario, 'description', 'Неизвестный сценарий'))
-                analysis_prompt = analysis_prompt.replace('{user_role}', getattr(dialog.scenario, 'user_role', 'Сотрудник'))
-                analysis_prompt = analysis_prompt.replace('{ai_role}', getattr(dialog.scenario, 'ai_role', 'Клиент'))
-                analysis_prompt = analysis_prompt.replace('{language}', getattr(dialog.scenario, 'language', 'русском'))
-            else:
-                # Используем улучшенный дефолтный промпт
-                analysis_prompt = f"""Ты опытный эксперт по обучению персонала в сфере обслуживания клиентов. Проанализируй следующий диалог:
+            analysis_prompt = build_analysis_prompt(dialog.scenario, analysis_prompt_template, dialog_text)
 
-**Контекст сценария:**
-- Сценарий: {getattr(dialog.scenario, 'description')}
-- Роль сотрудника: {getattr(dialog.scenario, 'user_role')}
-- Роль клиента (ИИ): {getattr(dialog.scenario, 'ai_role')}
-
-**Диалог:**
-{dialog_text}
-
-**Задание:**
-Проведи детальный анализ диалога (не более 400 слов), структурированный по следующим пунктам:
-
-1. **Общая оценка диалога** (3-4 предложения)
-   - Как прошел разговор в целом
-   - Была ли достигнута цель коммуникации
-   - Общее впечатление от взаимодействия
-
-2. **Сильные стороны сотрудника** (3-4 конкретных примера)
-   - Какие навыки общения были продемонстрированы успешно
-   - Удачные фразы и подходы
-   - Проявление эмпатии, профессионализма
-
-3. **Области для улучшения** (3-4 конкретных момента)
-   - Что можно было сделать лучше
-   - Упущенные возможности
-   - Ошибки в коммуникации
-
-4. **Практические рекомендации** (3-5 конкретных советов)
-   - Что делать в следующий раз
-   - Какие фразы использовать
-   - Как улучшить подход
-
-Отвечай только на {dialog.scenario.language} языке. Будь конструктивен, конкретен и поддерживающ. Приводи примеры из диалога."""
+            # Повторяющиеся диалоги получают анализ из кэша без запроса к GigaChat
+            prompt_version = DialogAnalysisService.prompt_version(analysis_prompt_template)
+            cache_key = AnalysisCacheService.make_key(prompt_version, dialog.scenario, dialog_text)
+            cached = AnalysisCacheService.lookup(cache_key)
+            if cached:
+                analysis, scoring = DialogAnalysisService.parse_scoring(cached)
+                analysis_version = prompt_version
 
             # Пытаемся получить анализ
-            for attempt in range(3):
+            for attempt in range(0 if cached else 3):
                 try:
                     analysis_params = {
                         'model': 'GigaChat',
                         'messages': [{'role': 'user', 'content': analysis_prompt}],
                         'temperature': 0.3,
-                        'max_tokens': 600,
+                        'max_tokens': 800,
                         'timeout': 15
                     }
                     
@@ -774,10 +732,13 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
                         break
                     
                     if response and response.get('choices'):
-                        candidate = response['choices'][0]['message']['content'].strip()
+                        content = response['choices'][0]['message']['content'].strip()
+                        candidate, scoring = DialogAnalysisService.parse_scoring(content)
                         filtered = filter_ai_response(candidate, dialog.scenario)
                         if filtered and filtered != '__ROLE_BREAK__':
                             analysis = filtered
+                            analysis_version = prompt_version
+                            AnalysisCacheService.store(cache_key, content)
                             break
                         
                 except Exception as api_error:
@@ -799,6 +760,10 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
 
         # Сохраняем анализ в диалог
         dialog.analysis = analysis
+        if analysis_version:
+            # Диалоги с резервным текстом без версии подхватит повторный анализ
+            dialog.analysis_version = analysis_version
+            dialog.analyzed_at = datetime.utcnow()
         
         # Создаем системное сообщение с анализом
         analysis_message = Message(
@@ -810,6 +775,7 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
         db.session.add(analysis_message)
 
         # Обновляем статистику пользователя
+        user_stats = None
         try:
             user_stats = current_user.statistics
             if user_stats is None:
@@ -836,6 +802,16 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
         except Exception as stats_error:
             current_app.logger.error(f"Ошибка при обновлении статистики: {stats_error}")
 
+        # Оценка и серия — отдельно от счётчиков выше: ошибка в них не должна оставлять диалог без оценки
+        try:
+            if scoring and analysis_version:
+                DialogAnalysisService.apply_scoring(dialog, user_stats, scoring)
+            elif user_stats is not None:
+                # Завершённый диалог без оценки (анализ не удался) прерывает серию успешных диалогов
+                user_stats.current_streak = 0
+        except Exception as scoring_error:
+            current_app.logger.error(f"Ошибка при записи оценки диалога: {scoring_error}")
+
         # Обновляем прогресс по сценарию
         try:
             progress = UserProgress.query.filter_by(
@@ -863,6 +839,16 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
         except Exception as progress_error:
             current_app.logger.error(f"Ошибка при обновлении прогресса: {progress_error}")
 
+        # Переводим сообщения завершённого диалога в компактную стенограмму
+        # (сообщения для ответа сериализуем заранее: их строки в messages после этого удаляются)
+        db.session.flush()
+        user_message_payload = ChatTurnService.serialize_message(user_message)
+        analysis_message_payload = ChatTurnService.serialize_message(analysis_message)
+        try:
+            DialogArchiveService.compact_transcript(dialog)
+        except Exception as transcript_error:
+            current_app.logger.error(f"Ошибка при записи стенограммы диалога: {transcript_error}")
+
         # Финальный коммит всех изменений
         try:
             db.session.commit()
@@ -889,20 +875,12 @@ def complete_dialog_with_simulation_command(dialog, current_user, message_conten
             'status': 'completed',
             'completed_at': dialog.completed_at.isoformat(),
             'duration': dialog.duration,
+            'score': dialog.score,
+            'is_successful': dialog.is_successful,
             'achievements': achievement_names,
             'stats_updated': True,
-            'user_message': {
-                'id': user_message.id,
-                'sender': user_message.sender,
-                'text': user_message.text,
-                'timestamp': user_message.timestamp.isoformat()
-            },
-            'analysis_message': {
-                'id': analysis_message.id,
-                'sender': analysis_message.sender,
-                'text': analysis_message.text,
-                'timestamp': analysis_message.timestamp.isoformat()
-            }
+            'user_message': user_message_payload,
+            'analysis_message': analysis_message_payload
         }
         
         return jsonify(response_data), 200
@@ -956,8 +934,7 @@ def finish_dialog(dialog_id):
     Завершение диалога через эндпоинт
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         
         dialog = Dialog.query.filter_by(
             id=dialog_id,
@@ -992,20 +969,18 @@ def finish_dialog(dialog_id):
 
         # Получаем сообщения для анализа
         try:
-            messages = Message.query.filter_by(dialog_id=dialog_id).order_by(Message.timestamp).all()
+            messages = DialogArchiveService.get_messages(dialog)
         except Exception as e:
             messages = []
 
         # Формируем анализ
         analysis = "Анализ временно недоступен"
+        analysis_version = None
+        scoring = None
         
         if messages:
             # Формируем текст диалога
-            dialog_messages = [m for m in messages if m.sender in ['user', 'assistant']]
-            dialog_text = "\n".join([
-                f"{'Пользователь' if m.sender == 'user' else 'ИИ'}: {m.text}" 
-                for m in dialog_messages
-            ])
+            dialog_text = build_dialog_text(messages)
 
             if dialog_text and len(dialog_text) > 10:
                 # Пытаемся получить промпт анализа из шаблона сценария
@@ -1018,67 +993,37 @@ def finish_dialog(dialog_id):
                     except Exception as e:
                         current_app.logger.warning(f"Не удалось загрузить шаблон анализа: {e}")
                 
-                # Если есть кастомный промпт из шаблона, используем его
-                if analysis_prompt_template:
-                    # Подставляем переменные в шаблон
-                    analysis_prompt = analysis_prompt_template.replace('{dialog_text}', dialog_text)
-                    analysis_prompt = analysis_prompt.replace('{scenario_description}', getattr(dialog.scenario, 'description', 'Неизвестный сценарий'))
-                    analysis_prompt = analysis_prompt.replace('{user_role}', getattr(dialog.scenario, 'user_role', 'Сотрудник'))
-                    analysis_prompt = analysis_prompt.replace('{ai_role}', getattr(dialog.scenario, 'ai_role', 'Клиент'))
-                    analysis_prompt = analysis_prompt.replace('{language}', getattr(dialog.scenario, 'language', 'русском'))
-                else:
-                    # Используем улучшенный дефолтный промпт
-                    analysis_prompt = f"""Ты опытный эксперт по обучению персонала в сфере обслуживания клиентов. Проанализируй следующий диалог:
-
-**Контекст сценария:**
-- Сценарий: {getattr(dialog.scenario, 'description')}
-- Роль сотрудника: {getattr(dialog.scenario, 'user_role')}
-- Роль клиента (ИИ): {getattr(dialog.scenario, 'ai_role')}
+                analysis_prompt = build_analysis_prompt(dialog.scenario, analysis_prompt_template, dialog_text)
 
-**Диалог:**
-{dialog_text}
-
-**Задание:**
-Проведи детальный анализ диалога (не более 400 слов), структурированный по следующим пунктам:
-
-1. **Общая оценка диалога** (3-4 предложения)
-   - Как прошел разговор в целом
-   - Была ли достигнута цель коммуникации
-   - Общее впечатление от взаимодействия
-
-2. **Сильные стороны сотрудника** (3-4 конкретных примера)
-   - Какие навыки общения были продемонстрированы успешно
-   - Удачные фразы и подходы
-   - Проявление эмпатии, профессионализма
-
-3. **Области для улучшения** (3-4 конкретных момента)
-   - Что можно было сделать лучше
-   - Упущенные возможности
-   - Ошибки в коммуникации
-
-4. **Практические рекомендации** (3-5 конкретных советов)
-   - Что делать в следующий раз
-   - Какие фразы использовать
-   - Как улучшить подход
-
-Отвечай только на {getattr(dialog.scenario, 'language')} языке. Будь конструктивен, конкретен и поддерживающ. Приводи примеры из диалога."""
+                # Повторяющиеся диалоги получают анализ из кэша без запроса к GigaChat
+                prompt_version = DialogAnalysisService.prompt_version(analysis_prompt_template)
+                cache_key = AnalysisCacheService.make_key(prompt_version, dialog.scenario, dialog_text)
+                cached = AnalysisCacheService.lookup(cache_key)
+                if cached:
+                    analysis, scoring = DialogAnalysisService.parse_scoring(cached)
+                    analysis_version = prompt_version
 
                 # Пытаемся получить анализ
-                for attempt in range(3):
+                for attempt in range(0 if cached else 3):
                     try:
                         analysis_params = {
                             'model': 'GigaChat',
                             'messages': [{'role': 'user', 'content': analysis_prompt}],
                             'temperature': 0.3,
-                            'max_tokens': 600
+                            'max_tokens': 800
                         }
                         
                         response = gigachat_service.send(analysis_params, retries=1)
                         
                         if response and response.get('choices'):
-                            analysis_content = response['choices'][0]['message']['content'].strip()
+                            content = response['choices'][0]['message']['content'].strip()
+                            analysis_content, scoring = DialogAnalysisService.parse_scoring(content)
                             if analysis_content and len(analysis_content) > 20:
                                 analysis = analysis_content
+                                analysis_version = prompt_version
+                                # Кэш общий с complete_dialog_with_simulation_command: только ответы, прошедшие фильтр
+                                if filter_ai_response(analysis_content, dialog.scenario) != '__ROLE_BREAK__':
+                                    AnalysisCacheService.store(cache_key, content)
                                 break
                                 
                     except Exception as api_error:
@@ -1104,6 +1049,10 @@ def finish_dialog(dialog_id):
 
         # Сохраняем анализ в диалог
         dialog.analysis = analysis
+        if analysis_version:
+            # Диалоги с резервным текстом без версии подхватит повторный анализ
+            dialog.analysis_version = analysis_version
+            dialog.analyzed_at = datetime.utcnow()
         
         # Создаем системное сообщение с анализом
         analysis_message = Message(
@@ -1115,6 +1064,7 @@ def finish_dialog(dialog_id):
         db.session.add(analysis_message)
 
         # Обновляем статистику пользователя
+        user_stats = None
         try:
             user_stats = UserStatistics.query.filter_by(user_id=current_user.id).first()
             if user_stats is None:
@@ -1140,6 +1090,16 @@ def finish_dialog(dialog_id):
         except Exception as stats_error:
             current_app.logger.error(f"Ошибка при обновлении статистики: {stats_error}")
 
+        # Оценка и серия — отдельно от счётчиков выше: ошибка в них не должна оставлять диалог без оценки
+        try:
+            if scoring and analysis_version:
+                DialogAnalysisService.apply_scoring(dialog, user_stats, scoring)
+            elif user_stats is not None:
+                # Завершённый диалог без оценки (анализ не удался) прерывает серию успешных диалогов
+                user_stats.current_streak = 0
+        except Exception as scoring_error:
+            current_app.logger.error(f"Ошибка при записи оценки диалога: {scoring_error}")
+
         # Обновляем прогресс по сценарию
         try:
             progress = UserProgress.query.filter_by(
@@ -1167,6 +1127,15 @@ def finish_dialog(dialog_id):
         except Exception as progress_error:
             current_app.logger.error(f"Ошибка при обновлении прогресса: {progress_error}")
 
+        # Переводим сообщения завершённого диалога в компактную стенограмму
+        # (сообщение для ответа сериализуем заранее: его строка в messages после этого удаляется)
+        db.session.flush()
+        analysis_message_payload = ChatTurnService.serialize_message(analysis_message)
+        try:
+            DialogArchiveService.compact_transcript(dialog)
+        except Exception as transcript_error:
+            current_app.logger.error(f"Ошибка при записи стенограммы диалога: {transcript_error}")
+
         # Финальный коммит
         try:
             db.session.commit()
@@ -1192,16 +1161,13 @@ def finish_dialog(dialog_id):
                 'id': dialog.id,
                 'status': dialog.status,
                 'completed_at': dialog.completed_at.isoformat(),
-                'duration': dialog.duration
+                'duration': dialog.duration,
+                'score': dialog.score,
+                'is_successful': dialog.is_successful
             },
             'analysis': analysis,
             'new_achievements': achievement_names,
-            'analysis_message': {
-                'id': analysis_message.id,
-                'sender': analysis_message.sender,
-                'text': analysis_message.text,
-                'timestamp': analysis_message.timestamp.isoformat()
-            }
+            'analysis_message': analysis_message_payload
         }
         
         return jsonify(response_data), 200
@@ -1424,32 +1390,98 @@ def generate_system_prompt_for_continue(scenario):
 Продолжай диалог в выбранной роли. Не выходи из образа и не давай инструкций пользователю."""
 
 
+def build_dialog_text(messages):
+    """
+    Текст диалога для анализа: реплики пользователя и ИИ по строкам
+    """
+    return "\n".join(
+        f"{'Пользователь' if m.sender == 'user' else 'ИИ'}: {m.text}"
+        for m in messages if m.sender in ('user', 'assistant')
+    )
+
+
+def build_analysis_prompt(scenario, analysis_prompt_template, dialog_text):
+    """
+    Промпт анализа диалога: шаблон сценария с подставленными переменными или встроенный промпт,
+    в конце — запрос структурированной оценки (SCORING_INSTRUCTIONS)
+    """
+    if analysis_prompt_template:
+        analysis_prompt = analysis_prompt_template.replace('{dialog_text}', dialog_text)
+        analysis_prompt = analysis_prompt.replace('{scenario_description}', getattr(scenario, 'description', 'Неизвестный сценарий'))
+        analysis_prompt = analysis_prompt.replace('{user_role}', getattr(scenario, 'user_role', 'Сотрудник'))
+        analysis_prompt = analysis_prompt.replace('{ai_role}', getattr(scenario, 'ai_role', 'Клиент'))
+        analysis_prompt = analysis_prompt.replace('{language}', getattr(scenario, 'language', 'русском'))
+        return analysis_prompt + SCORING_INSTRUCTIONS
+
+    return f"""Ты опытный эксперт по обучению персонала в сфере обслуживания клиентов. Проанализируй следующий диалог:
+
+**Контекст сценария:**
+- Сценарий: {getattr(scenario, 'description')}
+- Роль сотрудника: {getattr(scenario, 'user_role')}
+- Роль клиента (ИИ): {getattr(scenario, 'ai_role')}
+
+**Диалог:**
+{dialog_text}
+
+**Задание:**
+Проведи детальный анализ диалога (не более 400 слов), структурированный по следующим пунктам:
+
+1. **Общая оценка диалога** (3-4 предложения)
+   - Как прошел разговор в целом
+   - Была ли достигнута цель коммуникации
+   - Общее впечатление от взаимодействия
+
+2. **Сильные стороны сотрудника** (3-4 конкретных примера)
+   - Какие навыки общения были продемонстрированы успешно
+   - Удачные фразы и подходы
+   - Проявление эмпатии, профессионализма
+
+3. **Области для улучшения** (3-4 конкретных момента)
+   - Что можно было сделать лучше
+   - Упущенные возможности
+   - Ошибки в коммуникации
+
+4. **Практические рекомендации** (3-5 конкретных советов)
+   - Что делать в следующий раз
+   - Какие фразы использовать
+   - Как улучшить подход
+
+Отвечай только на {getattr(scenario, 'language')} языке. Будь конструктивен, конкретен и поддерживающ. Приводи примеры из диалога.""" + SCORING_INSTRUCTIONS
+
+
+def harden_api_params(api_params, scenario):
+    """
+    Параметры повторного запроса после выхода из роли: напоминание о роли в последнем сообщении и температура выше.
+    Возвращает копию: исходные параметры могут ещё читаться параллельными запросами кандидатов
+    """
+    messages = list(api_params['messages'])
+    messages[-1] = dict(messages[-1], content=messages[-1]['content'] + f"\n\nВНИМАНИЕ! Ты вышел из роли. Ты должен отвечать ТОЛЬКО как {scenario.ai_role}. Не извиняйся, не предлагай помощь, оставайся злым и конфликтным!")
+    return dict(api_params, messages=messages, temperature=min(0.95, api_params['temperature'] + 0.1))
+
+
+def preharden_api_params(api_params, scenario):
+    """
+    Параметры первого запроса для сценария с частым выходом из роли: напоминание о роли в системном промпте.
+    Возвращает копию
+    """
+    messages = list(api_params['messages'])
+    messages[0] = dict(messages[0], content=messages[0]['content'] + f"\n\nВНИМАНИЕ! Отвечай ТОЛЬКО как {scenario.ai_role}. Не извиняйся, не предлагай помощь, не выходи из роли и не упоминай, что ты ИИ.")
+    return dict(api_params, messages=messages)
+
+
+@llm_phase('filter')
+def role_break_reason(text, scenario):
+    """
+    Причина выхода ИИ из роли: совпавшая фраза или запрещённое слово (глобальные списки, списки организации,
+    шаблона и сценария), 'empty' или 'wrong_role'; None — ответ в роли
+    """
+    if not text or len(text.strip()) < 3:
+        return 'empty'
+    return ResponseFilterService.get_matcher(scenario).find(text)
+
+
 def filter_ai_response(text, scenario):
     """
     Фильтрация ответов ИИ для предотвращения выхода из роли
     """
-    if not text or len(text.strip()) < 3:
-        return '__ROLE_BREAK__'
-    
-    lower_text = text.lower()
-    
-    # 1) Явные признаки выхода в режим помощника/персонала или самораскрытия ИИ
-    for indicator in ROLE_BREAK_PHRASES:
-        if indicator in lower_text:
-            return '__ROLE_BREAK__'
-
-    for word in FORBIDDEN_KEYWORDS:
-        if word in lower_text:
-            return '__ROLE_BREAK__'
-    
-    # 2) Проверяем, что ИИ говорит от лица правильной роли (безопасно для None)
-    ai_role_lower = str(getattr(scenario, 'ai_role', '') or '').lower()
-    user_role_lower = str(getattr(scenario, 'user_role', '') or '').lower()
-    
-    # Если ИИ говорит от лица пользователя - это нарушение (пример с официантом)
-    if 'официант' in user_role_lower and any(phrase in lower_text for phrase in [
-        'я официант', 'как официант', 'в качестве официанта'
-    ]):
-        return '__ROLE_BREAK__'
-    
-    return text
\ No newline at end of file
+    return '__ROLE_BREAK__' if role_break_reason(text, scenario) else text
@@ -1,28 +1,33 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required
 from models.models import (
-    Users, UserStatistics, UserPreferences, 
+    UserStatistics, UserPreferences, 
     Dialog, UserProgress, Badge, UserBadge, Scenario
 )
 from datetime import datetime, timedelta
 from models.database import db
+from sqlalchemy.orm import joinedload
+from utils.auth import get_current_user_model
+from utils.query_budget import query_budget
 
 profile_bp = Blueprint('profile', __name__)
 
 @profile_bp.route('/', methods=['GET'])
 @jwt_required()
+@query_budget(10)
 def get_profile():
     """
     Получение профиля пользователя с полной статистикой
     """
-    user_id = get_jwt_identity()
-    
-    current_user = Users.query.get(user_id)
+    current_user = get_current_user_model()
     if not current_user:
         return jsonify({'error': 'Пользователь не найден'}), 404
 
     # Получаем все диалоги пользователя
-    all_dialogs = Dialog.query.filter_by(user_id=current_user.id).order_by(Dialog.id.desc()).all()
+    # Сценарии подгружаются тем же запросом; дальнейшие Scenario.query.get берутся из identity map
+    all_dialogs = Dialog.query.options(joinedload(Dialog.scenario)).filter_by(
+        user_id=current_user.id
+    ).order_by(Dialog.id.desc()).all()
     
     completed_dialogs = []
     active_dialogs = []
@@ -50,15 +55,20 @@ def get_profile():
     preferences = current_user.preferences
 
     # Формируем completed_scenarios для ответа (по уникальным сценариям)
+    progress_by_scenario = {}
+    if completed_scenario_ids:
+        for p in UserProgress.query.filter(
+            UserProgress.user_id == current_user.id,
+            UserProgress.scenario_id.in_(completed_scenario_ids)
+        ).order_by(UserProgress.id).all():
+            progress_by_scenario.setdefault(p.scenario_id, p)
+
     completed_scenarios = []
     for scenario_id in completed_scenario_ids:
         scenario = Scenario.query.get(scenario_id)
         if scenario:
             last_dialog = next((d for d in completed_dialogs if d.scenario_id == scenario_id), None)
-            progress = UserProgress.query.filter_by(
-                user_id=current_user.id,
-                scenario_id=scenario_id
-            ).first()
+            progress = progress_by_scenario.get(scenario_id)
             
             completed_scenarios.append({
                 'id': scenario.id,
@@ -69,10 +79,10 @@ def get_profile():
             })
 
     # Получаем badges
-    user_badges = UserBadge.query.filter_by(user_id=current_user.id).all()
+    user_badges = UserBadge.query.options(joinedload(UserBadge.badge)).filter_by(user_id=current_user.id).all()
     badges_data = []
     for ub in user_badges:
-        badge = Badge.query.get(ub.badge_id)
+        badge = ub.badge
         if badge:
             badges_data.append({
                 'id': badge.id,
@@ -158,8 +168,8 @@ def get_profile():
         },
         'dialogs': [{
             'id': d.id,
-            'started_at': d.started_at.isoformat(),
-            'completed_at': d.completed_at.isoformat() if d.completed_at else None,
+            'started_at': d.started_at,
+            'completed_at': d.completed_at,
             'score': d.score,
             'status': d.status,
             'duration': d.duration if d.duration and d.duration > 0 else None,
@@ -168,7 +178,7 @@ def get_profile():
         } for d in all_dialogs],
         'badges': badges_data,
         'weeklyProgress': [{
-            'date': p.updated_at.isoformat(),
+            'date': p.updated_at,
             'status': 'completed' if p.completed else 'in_progress', 
             'progress_percentage': p.progress_percentage or 0
         } for p in weekly_progress],
@@ -189,8 +199,7 @@ def update_preferences():
     Обновление настроек пользователя (язык, сложность, тема, уведомления).
     Принимает JSON с новыми значениями.
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = get_current_user_model()
     if not current_user:
         return jsonify({'error': 'Пользователь не найден'}), 404
     
@@ -1,30 +1,33 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models.models import UserProgress, Scenario, Users
+from models.models import UserProgress, Scenario
 from models.database import db
+from sqlalchemy.orm import joinedload
+from utils.auth import load_current_user
+from utils.query_budget import query_budget
 from datetime import datetime, timedelta
 
 progress_bp = Blueprint('progress', __name__, url_prefix='/api/progress')
 
 @progress_bp.route('/', methods=['GET'], strict_slashes=False)
 @jwt_required()
+@query_budget(4)
 def get_progress():
     """
     Получение прогресса пользователя по всем сценариям или по конкретному сценарию.
     Принимает scenario_id как query-параметр (опционально).
     Возвращает список прогресса с информацией о сценариях.
     """
-    user_id = get_jwt_identity()
-    user = Users.query.get(user_id)
+    user = load_current_user()
     scenario_id = request.args.get('scenario_id')
-    query = UserProgress.query.filter_by(user_id=user.id)
+    query = UserProgress.query.options(joinedload(UserProgress.scenario)).filter_by(user_id=user.id)
     if scenario_id:
         query = query.filter_by(scenario_id=scenario_id)
     progress_list = query.order_by(UserProgress.updated_at.desc()).all()
 
     result = []
     for p in progress_list:
-        scenario = Scenario.query.get(p.scenario_id)
+        scenario = p.scenario
         result.append({
             'id': p.id,
             'scenario_id': p.scenario_id,
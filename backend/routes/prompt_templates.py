@@ -1,8 +1,11 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from models.models import PromptTemplate, Organization, Users, db
+from flask_jwt_extended import jwt_required
+from utils.auth import load_current_user
+from models.models import PromptTemplate, Organization, db
 from sqlalchemy.exc import IntegrityError
 from utils.redis_client import redis_client
+from services.scenario_catalog_service import ScenarioCatalogService
+from services.response_filter_service import ResponseFilterService
 
 # Дефолтный промпт анализа, если не передан при создании шаблона
 DEFAULT_ANALYSIS_PROMPT = """Ты опытный эксперт по обучению персонала в сфере обслуживания клиентов. Проанализируй следующий диалог:
@@ -49,8 +52,7 @@ def get_prompt_templates():
     Получение списка шаблонов промптов
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         
         if not current_user:
             return jsonify({'error': 'Пользователь не найден'}), 404
@@ -95,8 +97,7 @@ def create_prompt_template():
     Создание нового шаблона промпта
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         
         if not current_user:
             return jsonify({'error': 'Пользователь не найден'}), 404
@@ -122,7 +123,7 @@ def create_prompt_template():
             sections_json=data.get('sections_json', ''),
             analysis_prompt=(data.get('analysis_prompt') or DEFAULT_ANALYSIS_PROMPT),
             organization_id=data.get('organization_id'),
-            created_by_user_id=user_id,
+            created_by_user_id=current_user.id,
             is_global=data.get('is_global', True)
         )
         
@@ -158,8 +159,7 @@ def update_prompt_template(template_id):
     Обновление шаблона промпта
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         
         if not current_user:
             return jsonify({'error': 'Пользователь не найден'}), 404
@@ -195,6 +195,11 @@ def update_prompt_template(template_id):
             template.is_global = data['is_global']
         
         db.session.commit()
+        # Название шаблона отображается в каталоге сценариев
+        ScenarioCatalogService.bump_version()
+        # Скомпилированные фильтры ответов ИИ собраны по прежнему списку запрещённых слов
+        if 'forbidden_words' in data:
+            ResponseFilterService.bump_version()
         
         return jsonify({
             'id': template.id,
@@ -225,8 +230,7 @@ def delete_prompt_template(template_id):
     Удаление шаблона промпта
     """
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         
         if not current_user:
             return jsonify({'error': 'Пользователь не найден'}), 404
@@ -241,6 +245,8 @@ def delete_prompt_template(template_id):
         
         db.session.delete(template)
         db.session.commit()
+        ScenarioCatalogService.bump_version()
+        ResponseFilterService.bump_version()
         
         return jsonify({'message': 'Шаблон успешно удален'})
     
@@ -280,8 +286,7 @@ def get_active_prompt_template():
 def activate_prompt_template(template_id):
     """Делает шаблон активным (глобально)."""
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         if not current_user or current_user.role.value != 'admin':
             return jsonify({'error': 'Недостаточно прав'}), 403
         tpl = PromptTemplate.query.get(template_id)
@@ -297,8 +302,7 @@ def activate_prompt_template(template_id):
 def clear_active_prompt_template():
     """Сбрасывает активный шаблон (глобально)."""
     try:
-        user_id = get_jwt_identity()
-        current_user = Users.query.get(user_id)
+        current_user = load_current_user()
         if not current_user or current_user.role.value != 'admin':
             return jsonify({'error': 'Недостаточно прав'}), 403
         redis_client.delete('active_prompt_template_id')
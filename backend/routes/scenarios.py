@@ -1,33 +1,20 @@
 from flask import Blueprint, jsonify, request
-from models.models import Scenario, Dialog, UserProgress, ScenarioType, Users
+from models.models import Scenario, Dialog, UserProgress, ScenarioType
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from models.database import db
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required
+from utils.auth import load_current_user
+from services.scenario_catalog_service import ScenarioCatalogService
+from services.bulk_import_service import BulkImportService
 
 scenarios_bp = Blueprint('scenarios_bp', __name__)
 
-@scenarios_bp.route('/scenarios', methods=['POST'])
-@jwt_required()
-def add_scenario():
-    data = request.get_json()
-
-    name = data.get('name')
-    description = data.get('description')
-    category = data.get('sphere') # Используем 'sphere' как 'category'
-    subcategory = data.get('situation') # Используем 'situation' как 'subcategory'
-    mood = data.get('mood')
-    language = data.get('language')
-    user_role = data.get('user_role')
-    ai_role = data.get('ai_role')
-    ai_behavior = data.get('ai_behavior')
-    is_template = data.get('is_template', False) # Добавляем новое поле, по умолчанию False
-    organization_id = data.get('organization_id') # Добавляем поддержку организации
-
-    if not all([name, description, category, subcategory, mood, language, user_role, ai_role, ai_behavior]):
-        return jsonify({'error': 'Необходимо заполнить все обязательные поля.'}), 400
-
-    # Генерация prompt_template
-    prompt_template = f"""Ты должен действовать как тренажер отработки коммуникационных навыков в сервисе ({category}). Твоя задача - создать реалистичную симуляцию диалога в заданной ситуации, в которой ты будешь изображать участника конфликта в соответствии с заданными параметрами, после чего предоставить полезную обратную связь по ее результатам.
+def build_default_prompt_template(category, description, user_role, ai_role, ai_behavior):
+    """
+    Системный промпт сценария по умолчанию (используется, если готовый промпт не передан)
+    """
+    return f"""Ты должен действовать как тренажер отработки коммуникационных навыков в сервисе ({category}). Твоя задача - создать реалистичную симуляцию диалога в заданной ситуации, в которой ты будешь изображать участника конфликта в соответствии с заданными параметрами, после чего предоставить полезную обратную связь по ее результатам.
 
 Описание конфликтной ситуации: {description}
 
@@ -56,6 +43,29 @@ def add_scenario():
 НАЧНИ СИМУЛЯЦИЮ НЕМЕДЛЕННО ПОСЛЕ ПОЛУЧЕНИЯ ДАННОЙ СИСТЕМНОЙ ПОДСКАЗКИ
 """
 
+@scenarios_bp.route('/scenarios', methods=['POST'])
+@jwt_required()
+def add_scenario():
+    data = request.get_json()
+
+    name = data.get('name')
+    description = data.get('description')
+    category = data.get('sphere') # Используем 'sphere' как 'category'
+    subcategory = data.get('situation') # Используем 'situation' как 'subcategory'
+    mood = data.get('mood')
+    language = data.get('language')
+    user_role = data.get('user_role')
+    ai_role = data.get('ai_role')
+    ai_behavior = data.get('ai_behavior')
+    is_template = data.get('is_template', False) # Добавляем новое поле, по умолчанию False
+    organization_id = data.get('organization_id') # Добавляем поддержку организации
+
+    if not all([name, description, category, subcategory, mood, language, user_role, ai_role, ai_behavior]):
+        return jsonify({'error': 'Необходимо заполнить все обязательные поля.'}), 400
+
+    # Генерация prompt_template
+    prompt_template = build_default_prompt_template(category, description, user_role, ai_role, ai_behavior)
+
     # Если на вход передан готовый системный промпт (например, выбран шаблон) — используем его
     if data.get('prompt_template'):
         prompt_template = data['prompt_template']
@@ -79,12 +89,14 @@ def add_scenario():
         prompt_template_id=prompt_template_id,  # Добавляем связь с шаблоном
         type=ScenarioType.CAFE,  # По умолчанию, чтобы не нарушать NOT NULL
         difficulty=1, # Заглушка
-        organization_id=organization_id  # Добавляем организацию
+        organization_id=organization_id,  # Добавляем организацию
+        forbidden_words=data.get('forbidden_words')  # Запрещенные слова в ответах ИИ
     )
 
     try:
         db.session.add(new_scenario)
         db.session.commit()
+        ScenarioCatalogService.bump_version()
 
         # Сохраняем привязку шаблона к сценарию в Redis (для обратной совместимости и кэша)
         try:
@@ -110,10 +122,39 @@ def add_scenario():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-@scenarios_bp.route('/scenarios', methods=['GET'])
+@scenarios_bp.route('/scenarios/import', methods=['POST'])
 @jwt_required()
-def get_all_scenarios_admin():
-    scenarios = Scenario.query.all()
+def import_scenarios():
+    """
+    Массовый импорт сценариев (только для администратора).
+    Принимает JSON-массив (или {"items": [...]}) либо CSV (тело text/csv или файл в поле file)
+    с полями как у POST /scenarios. Параметр ?dry_run=1 только проверяет записи.
+    Возвращает отчёт: сколько создано, какие строки отклонены и почему.
+    """
+    current_user = load_current_user()
+    if not current_user or current_user.role.value != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    try:
+        rows = BulkImportService.parse_rows(request)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        report = BulkImportService.import_scenarios(rows, dry_run=request.args.get('dry_run') in ('1', 'true'))
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Ошибка при импорте сценариев: {str(e)}'}), 500
+    return jsonify(report), 200 if report['failed'] else 201
+
+def _build_admin_scenarios_list():
+    """
+    Собирает полный список сценариев для админки (раздел каталога 'scenarios_admin').
+    """
+    scenarios = Scenario.query.options(
+        joinedload(Scenario.organization),
+        joinedload(Scenario.prompt_template_obj)
+    ).all()
     scenarios_list = []
     for scenario in scenarios:
         scenarios_list.append({
@@ -127,6 +168,7 @@ def get_all_scenarios_admin():
             'user_role': scenario.user_role,
             'ai_role': scenario.ai_role,
             'ai_behavior': scenario.ai_behavior,
+            'forbidden_words': scenario.forbidden_words,
             'created_at': scenario.created_at.isoformat(),
             'is_active': scenario.is_active,
             'is_template': scenario.is_template,
@@ -141,7 +183,31 @@ def get_all_scenarios_admin():
                 'name': scenario.prompt_template_obj.name if scenario.prompt_template_obj else None,
             }
         })
-    return jsonify(scenarios_list), 200
+    return scenarios_list
+
+def _build_user_view_scenarios_list():
+    """
+    Собирает общую для всех пользователей часть списка сценариев (раздел каталога 'scenarios_user_view').
+    """
+    scenarios = Scenario.query.options(joinedload(Scenario.organization)).filter_by(is_template=False).all()
+    return [{
+        'id': scenario.id,
+        'name': scenario.name,
+        'description': scenario.description,
+        'difficulty': scenario.difficulty,
+        'estimated_time': scenario.estimated_time,
+        'created_at': scenario.created_at.isoformat(),
+        'organization_id': scenario.organization_id,
+        'organization': {
+            'id': scenario.organization.id if scenario.organization else None,
+            'name': scenario.organization.name if scenario.organization else None,
+        }
+    } for scenario in scenarios]
+
+@scenarios_bp.route('/scenarios', methods=['GET'])
+@jwt_required()
+def get_all_scenarios_admin():
+    return ScenarioCatalogService.catalog_response('scenarios_admin', _build_admin_scenarios_list)
 
 @scenarios_bp.route('/', methods=['GET'])
 @jwt_required()
@@ -149,12 +215,11 @@ def get_scenarios_for_user_view():
     """
     Получает список всех сценариев с информацией о прогрессе пользователя
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user:
         return jsonify({'error': 'Пользователь не найден'}), 401
-    # Получаем все сценарии, которые НЕ являются шаблонами
-    scenarios = Scenario.query.filter_by(is_template=False).all()
+    # Получаем все сценарии, которые НЕ являются шаблонами (из кэша каталога)
+    scenarios = ScenarioCatalogService.get_data('scenarios_user_view', _build_user_view_scenarios_list)
     
     # Получаем прогресс пользователя для всех сценариев
     progress_dict = {
@@ -177,39 +242,25 @@ def get_scenarios_for_user_view():
         for stat in dialog_stats
     }
     
-    # Формируем ответ
-    scenarios_list = []
+    # Дополняем общие данные сценариев прогрессом и статистикой пользователя
     for scenario in scenarios:
-        progress = progress_dict.get(scenario.id)
-        stats = dialog_stats_dict.get(scenario.id, {
+        progress = progress_dict.get(scenario['id'])
+        stats = dialog_stats_dict.get(scenario['id'], {
             'total_dialogs': 0,
             'average_score': 0.0
         })
         
-        scenarios_list.append({
-            'id': scenario.id,
-            'name': scenario.name,
-            'description': scenario.description,
-            'difficulty': scenario.difficulty,
-            'estimated_time': scenario.estimated_time,
-            'created_at': scenario.created_at.isoformat(),
-            'progress': {
-                'status': progress.status if progress else 'not_started',
-                'progress_percentage': progress.progress_percentage if progress else 0,
-                'last_updated': progress.updated_at.isoformat() if progress else None
-            },
-            'statistics': {
-                'total_dialogs': stats['total_dialogs'],
-                'average_score': stats['average_score']
-            },
-            'organization_id': scenario.organization_id,
-            'organization': {
-                'id': scenario.organization.id if scenario.organization else None,
-                'name': scenario.organization.name if scenario.organization else None,
-            }
-        })
+        scenario['progress'] = {
+            'status': progress.status if progress else 'not_started',
+            'progress_percentage': progress.progress_percentage if progress else 0,
+            'last_updated': progress.updated_at.isoformat() if progress else None
+        }
+        scenario['statistics'] = {
+            'total_dialogs': stats['total_dialogs'],
+            'average_score': stats['average_score']
+        }
     
-    return jsonify(scenarios_list)
+    return jsonify(scenarios)
 
 @scenarios_bp.route('/<int:scenario_id>', methods=['GET'])
 @jwt_required()
@@ -217,8 +268,7 @@ def get_scenario(scenario_id):
     """
     Получает детальную информацию о конкретном сценарии
     """
-    user_id = get_jwt_identity()
-    current_user = Users.query.get(user_id)
+    current_user = load_current_user()
     if not current_user:
         return jsonify({'error': 'Пользователь не найден'}), 404
     # Получаем сценарий, убеждаясь, что он не шаблонный, если запрос идет от обычного пользователя
@@ -283,7 +333,7 @@ def update_scenario(scenario_id):
     # Обновляем только те поля, которые пришли в запросе
     for field in [
         'name', 'description', 'category', 'subcategory', 'sphere', 'situation', 'mood', 'language',
-        'user_role', 'ai_role', 'ai_behavior', 'is_template'
+        'user_role', 'ai_role', 'ai_behavior', 'is_template', 'forbidden_words'
     ]:
         if field in data:
             setattr(scenario, field, data[field])
@@ -302,6 +352,7 @@ def update_scenario(scenario_id):
 
     try:
         db.session.commit()
+        ScenarioCatalogService.bump_version()
 
         # Сохраняем/сбрасываем привязку в Redis
         try:
@@ -338,6 +389,7 @@ def delete_scenario(scenario_id):
     try:
         db.session.delete(scenario)
         db.session.commit()
+        ScenarioCatalogService.bump_version()
         return jsonify({'message': 'Сценарий успешно удалён!'}), 200
     except Exception as e:
         db.session.rollback()
@@ -349,7 +401,7 @@ def get_unique_spheres():
     """
     Получение списка уникальных сфер из всех существующих сценариев
     """
-    try:
+    def build_spheres():
         # Получаем уникальные сферы (category) из базы данных
         unique_spheres = db.session.query(Scenario.category).distinct().filter(
             Scenario.category.isnot(None),
@@ -357,8 +409,9 @@ def get_unique_spheres():
         ).order_by(Scenario.category).all()
         
         # Преобразуем в простой список строк
-        spheres_list = [sphere[0] for sphere in unique_spheres if sphere[0]]
-        
-        return jsonify({'spheres': spheres_list}), 200
+        return {'spheres': [sphere[0] for sphere in unique_spheres if sphere[0]]}
+
+    try:
+        return ScenarioCatalogService.catalog_response('unique_spheres', build_spheres)
     except Exception as e:
         return jsonify({'error': 'Не удалось получить список сфер', 'details': str(e)}), 500
@@ -1,6 +1,7 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required
 from models.models import Users, db
+from utils.auth import load_current_user, get_current_user_model
 from datetime import datetime, timedelta
 
 bp = Blueprint('tokens', __name__)
@@ -11,8 +12,7 @@ def get_token_usage():
     """
     Получение информации об использовании токенов текущего пользователя
     """
-    user_id = get_jwt_identity()
-    user = Users.query.get(user_id)
+    user = get_current_user_model()
     
     if not user:
         return jsonify({'error': 'Пользователь не найден'}), 404
@@ -31,10 +31,9 @@ def add_tokens():
     Добавление токенов пользователю (только для администраторов)
     """
     # Проверяем, что пользователь - администратор
-    user_id = get_jwt_identity()
-    admin = Users.query.get(user_id)
+    current_user = load_current_user()
     
-    if not admin or admin.role != 'admin':
+    if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Недостаточно прав'}), 403
     
     data = request.get_json()
@@ -65,10 +64,9 @@ def reset_tokens():
     Сброс счетчика использованных токенов (только для администраторов)
     """
     # Проверяем, что пользователь - администратор
-    user_id = get_jwt_identity()
-    admin = Users.query.get(user_id)
+    current_user = load_current_user()
     
-    if not admin or admin.role != 'admin':
+    if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Недостаточно прав'}), 403
     
     data = request.get_json()
@@ -99,10 +97,9 @@ def set_token_limit():
     Установка лимита токенов для пользователя (только для администраторов)
     """
     # Проверяем, что пользователь - администратор
-    user_id = get_jwt_identity()
-    admin = Users.query.get(user_id)
+    current_user = load_current_user()
     
-    if not admin or admin.role != 'admin':
+    if not current_user or current_user.role.value != 'admin':
         return jsonify({'error': 'Недостаточно прав'}), 403
     
     data = request.get_json()
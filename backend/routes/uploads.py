@@ -1,7 +1,7 @@
 # Роуты для загрузки, получения и удаления иконок достижений
 from flask import Blueprint, request, jsonify, send_file, abort
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from models.models import Users, UserRole
+from flask_jwt_extended import jwt_required
+from utils.auth import load_current_user
 import os
 from werkzeug.utils import secure_filename 
 
@@ -14,8 +14,7 @@ def upload_achievement_icon():
     Загрузка иконки достижения (только для администратора).
     :return: JSON с url и статусом
     """
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
 
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -46,8 +45,7 @@ def list_achievement_icons():
     Получить список всех загруженных иконок достижений (только для администратора).
     :return: JSON со списком url
     """
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
     upload_folder = os.path.join(os.getcwd(), 'uploads', 'achievement_icons')
@@ -76,8 +74,7 @@ def delete_achievement_icon(filename):
     :param filename: строка — имя файла
     :return: JSON с результатом
     """
-    current_user_id = get_jwt_identity()
-    current_admin = Users.query.get(current_user_id)
+    current_admin = load_current_user()
     if not current_admin or current_admin.role.value != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
     upload_folder = os.path.join(os.getcwd(), 'uploads', 'achievement_icons')
@@ -2,8 +2,14 @@
 from datetime import datetime
 from models.models import Achievement, UserAchievement, UserStatistics, db, Users
 from flask import current_app
+from sqlalchemy import select, update, func, literal
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from services.user_listing_service import UserListingService
 import json
 
+# Максимум идентификаторов в явном списке пользователей для массовой выдачи
+BULK_MAX_USER_IDS = 50000
+
 class AchievementService:
     """
     Класс-сервис для управления достижениями пользователей:
@@ -34,7 +40,8 @@ class AchievementService:
                     user_achievement = UserAchievement(
                         user_id=user_id,
                         achievement_id=ach.id,
-                        earned_at=datetime.utcnow()
+                        earned_at=datetime.utcnow(),
+                        is_repeatable=bool(ach.is_repeatable)
                     )
                     db.session.add(user_achievement)
                     # Начисляем баллы пользователю
@@ -69,7 +76,8 @@ class AchievementService:
                     user_achievement = UserAchievement(
                         user_id=user_id,
                         achievement_id=achievement.id,
-                        earned_at=datetime.utcnow()
+                        earned_at=datetime.utcnow(),
+                        is_repeatable=bool(achievement.is_repeatable)
                     )
                     db.session.add(user_achievement)
                     # Начисляем баллы пользователю
@@ -104,43 +112,55 @@ class AchievementService:
             user = Users.query.get(user_id)
             reg_date = user.created_at.isoformat() if user and user.created_at else datetime.utcnow().isoformat()
 
-            result = []
-            for ach in all_achievements:
-                req = ach.requirements or {}
-                if isinstance(req, str):
-                    try:
-                        req = json.loads(req)
-                    except Exception:
-                        req = {}
-                if not req or not req.get('type') or req.get('type') == 'none':
-                    unlocked = True
-                    progress = 100
-                    achieved_at = user_achievements[ach.id].earned_at.isoformat() if ach.id in user_achievements else reg_date
-                else:
-                    req_type = req.get('type')
-                    req_value = req.get('value')
-                    stat_value = getattr(user_stats, req_type, 0) if user_stats and req_type else 0
-                    unlocked = ach.id in user_achievements
-                    progress = 100 if unlocked else (min(100, int((float(stat_value) / float(req_value)) * 100)) if req_value else 0)
-                    achieved_at = user_achievements[ach.id].earned_at.isoformat() if unlocked else None
-
-                result.append({
-                    'id': ach.id,
-                    'name': ach.name,
-                    'description': ach.description,
-                    'icon_url': ach.icon,
-                    'points': ach.points,  
-                    'achieved_at': achieved_at,
-                    'unlocked': unlocked,
-                    'progress': progress,
-                    'requirements': req
-                })
-
-            return result
+            return AchievementService.build_achievements_progress(all_achievements, user_achievements, user_stats, reg_date)
         except Exception as e:
             current_app.logger.error(f"Ошибка при получении достижений пользователя: {str(e)}")
             return []
 
+    @staticmethod
+    def build_achievements_progress(all_achievements, user_achievements, user_stats, reg_date):
+        """
+        Вычисляет прогресс пользователя по каждому достижению (без обращений к БД).
+        :param all_achievements: список объектов Achievement
+        :param user_achievements: dict achievement_id -> UserAchievement
+        :param user_stats: объект UserStatistics или None
+        :param reg_date: строка — дата регистрации (ISO) для достижений без требований
+        :return: список словарей с данными о достижениях
+        """
+        result = []
+        for ach in all_achievements:
+            req = ach.requirements or {}
+            if isinstance(req, str):
+                try:
+                    req = json.loads(req)
+                except Exception:
+                    req = {}
+            if not req or not req.get('type') or req.get('type') == 'none':
+                unlocked = True
+                progress = 100
+                achieved_at = user_achievements[ach.id].earned_at.isoformat() if ach.id in user_achievements else reg_date
+            else:
+                req_type = req.get('type')
+                req_value = req.get('value')
+                stat_value = getattr(user_stats, req_type, 0) if user_stats and req_type else 0
+                unlocked = ach.id in user_achievements
+                progress = 100 if unlocked else (min(100, int((float(stat_value) / float(req_value)) * 100)) if req_value else 0)
+                achieved_at = user_achievements[ach.id].earned_at.isoformat() if unlocked else None
+
+            result.append({
+                'id': ach.id,
+                'name': ach.name,
+                'description': ach.description,
+                'icon_url': ach.icon,
+                'points': ach.points,  
+                'achieved_at': achieved_at,
+                'unlocked': unlocked,
+                'progress': progress,
+                'requirements': req
+            })
+
+        return result
+
     @staticmethod
     def create_achievement(name, description, icon, points=0, requirements={}):
         """
@@ -170,34 +190,127 @@ class AchievementService:
             db.session.rollback()
             return None
 
+    @staticmethod
+    def build_target_query(user_ids=None, organization_id=None, filters=None):
+        """
+        Строит подзапрос идентификаторов пользователей для массовой выдачи или отзыва достижения.
+        Должен быть указан ровно один способ отбора.
+        :param user_ids: список id пользователей
+        :param organization_id: int — все пользователи организации
+        :param filters: dict — фильтры как у списка пользователей админки (role, organization_id, is_active, q)
+        :return: Select с единственной колонкой Users.id
+        :raises ValueError: при некорректном отборе
+        """
+        if sum(target is not None for target in (user_ids, organization_id, filters)) != 1:
+            raise ValueError('Укажите ровно одно из: user_ids, organization_id, filters')
+
+        query = select(Users.id)
+        if user_ids is not None:
+            if not isinstance(user_ids, list) or not user_ids:
+                raise ValueError('user_ids должен быть непустым списком')
+            if len(user_ids) > BULK_MAX_USER_IDS:
+                raise ValueError(f'Слишком много пользователей: максимум {BULK_MAX_USER_IDS}')
+            try:
+                ids = {int(user_id) for user_id in user_ids}
+            except (TypeError, ValueError):
+                raise ValueError('user_ids должен содержать целые числа')
+            return query.where(Users.id.in_(ids))
+        if organization_id is not None:
+            try:
+                return query.where(Users.organization_id == int(organization_id))
+            except (TypeError, ValueError):
+                raise ValueError('Некорректный organization_id')
+        if not isinstance(filters, dict):
+            raise ValueError('filters должен быть объектом')
+        # Те же фильтры, что у постраничного списка пользователей; пустой отбор (все пользователи) не допускается
+        parsed = UserListingService.parse_filters({key: str(value) for key, value in filters.items() if value is not None})
+        if not parsed:
+            raise ValueError('Фильтр не задан')
+        return UserListingService._apply_filters(query, parsed)
+
+    @staticmethod
+    def bulk_assign(achievement, target_query):
+        """
+        Выдаёт достижение всем пользователям отбора одним INSERT ... SELECT ... ON CONFLICT DO NOTHING
+        и в том же запросе начисляет баллы только тем, кому достижение выдано сейчас.
+        Повторяемое достижение не попадает под уникальный индекс и выдаётся ещё раз.
+        :param achievement: объект Achievement
+        :param target_query: Select с колонкой Users.id (см. build_target_query)
+        :return: dict — matched (пользователей в отборе), changed (выдано), skipped (уже было)
+        """
+        targets = target_query.subquery()
+        matched = db.session.scalar(select(func.count()).select_from(targets))
+        inserted = pg_insert(UserAchievement).from_select(
+            ['user_id', 'achievement_id', 'earned_at', 'progress', 'is_repeatable'],
+            select(targets.c.id, literal(achievement.id), literal(datetime.utcnow()), literal(1.0),
+                   literal(bool(achievement.is_repeatable)))
+        ).on_conflict_do_nothing(
+            index_elements=['user_id', 'achievement_id'], index_where=~UserAchievement.is_repeatable
+        ).returning(UserAchievement.user_id)
+
+        if achievement.points:
+            inserted = inserted.cte('inserted')
+            statement = update(Users).where(Users.id == inserted.c.user_id).values(
+                points=func.coalesce(Users.points, 0) + achievement.points
+            ).returning(Users.id)
+        else:
+            statement = inserted
+        changed = len(db.session.execute(statement).all())
+        db.session.commit()
+        return {'matched': matched, 'changed': changed, 'skipped': matched - changed}
+
+    @staticmethod
+    def bulk_unassign(achievement, target_query):
+        """
+        Отзывает достижение у пользователей отбора одним DELETE и в том же запросе списывает начисленные за него баллы.
+        Повторяемое достижение снимается со всех выдач: баллы списываются за каждую.
+        :param achievement: объект Achievement
+        :param target_query: Select с колонкой Users.id (см. build_target_query)
+        :return: dict — matched (пользователей в отборе), changed (пользователей, у кого отозвано),
+                 skipped (не было), revoked (удалено выдач)
+        """
+        targets = target_query.subquery()
+        matched = db.session.scalar(select(func.count()).select_from(targets))
+        deleted = UserAchievement.__table__.delete().where(
+            UserAchievement.achievement_id == achievement.id,
+            UserAchievement.user_id.in_(select(targets.c.id))
+        ).returning(UserAchievement.user_id).cte('deleted')
+        # UPDATE ... FROM меняет строку пользователя один раз, поэтому выдачи сначала считаются по пользователям
+        per_user = select(deleted.c.user_id, func.count().label('grants')).group_by(deleted.c.user_id).cte('per_user')
+
+        if achievement.points:
+            users = Users.__table__
+            statement = users.update().where(users.c.id == per_user.c.user_id).values(
+                points=func.greatest(func.coalesce(users.c.points, 0) - achievement.points * per_user.c.grants, 0)
+            ).returning(users.c.id, per_user.c.grants)
+        else:
+            statement = select(per_user.c.user_id, per_user.c.grants)
+        rows = db.session.execute(statement).all()
+        db.session.commit()
+        changed = len(rows)
+        return {'matched': matched, 'changed': changed, 'skipped': matched - changed,
+                'revoked': sum(row.grants for row in rows)}
+
     @staticmethod
     def _get_streak(user_id):
         """
         Возвращает текущий стрик (серия) успешных диалогов подряд для пользователя.
+        Счётчик ведётся в UserStatistics при завершении диалога (см. DialogAnalysisService.apply_scoring).
         :param user_id: int — идентификатор пользователя
         :return: int — длина стрика
         """
-        from models.models import Dialog
-        dialogs = Dialog.query.filter_by(user_id=user_id).order_by(Dialog.completed_at.desc()).all()
-        streak = 0
-        for d in dialogs:
-            if d.is_successful:
-                streak += 1
-            else:
-                break
-        return streak
+        user_stats = UserStatistics.query.filter_by(user_id=user_id).first()
+        return (user_stats.current_streak or 0) if user_stats else 0
 
     @staticmethod
     def _unique_scenarios_count(user_id):
         """
-        Возвращает количество уникальных успешно завершённых сценариев пользователя.
+        Возвращает количество уникальных успешно завершённых сценариев пользователя (счётчик из UserStatistics).
         :param user_id: int — идентификатор пользователя
         :return: int — количество уникальных сценариев
         """
-        from models.models import Dialog
-        dialogs = Dialog.query.filter_by(user_id=user_id).filter(Dialog.is_successful==True).all()
-        scenario_ids = set(d.scenario_id for d in dialogs)
-        return len(scenario_ids)
+        user_stats = UserStatistics.query.filter_by(user_id=user_id).first()
+        return (user_stats.unique_successful_scenarios or 0) if user_stats else 0
 
     @staticmethod
     def recalculate_all_users_points():
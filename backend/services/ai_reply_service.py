@@ -0,0 +1,304 @@
+# Сервис получения реплики ИИ в диалоге: спекулятивная генерация нескольких кандидатов параллельно
+# (с разной температурой) вместо последовательных повторов после выхода из роли.
+# Число кандидатов подбирается по сценарию из измеренной доли выходов из роли в Redis.
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from services.gigachat_service import gigachat_service
+from utils.redis_client import redis_client
+from utils.tracing import start_span, capture_context, attach_context
+import logging
+import math
+import os
+
+# Режим спекулятивной генерации: off (последовательные повторы), auto (по доле выходов из роли), always
+SPECULATIVE_MODE = os.getenv('SPECULATIVE_MODE', 'off').lower()
+# Максимум параллельных кандидатов на одну реплику
+SPECULATIVE_MAX_FANOUT = int(os.getenv('SPECULATIVE_MAX_FANOUT', '3'))
+# Допустимая вероятность, что все кандидаты одного раунда выйдут из роли (для режима auto)
+SPECULATIVE_TARGET_FAILURE = float(os.getenv('SPECULATIVE_TARGET_FAILURE', '0.05'))
+# Сколько обращений по сценарию нужно, чтобы доверять измеренной доле
+SPECULATIVE_MIN_SAMPLES = int(os.getenv('SPECULATIVE_MIN_SAMPLES', '30'))
+# Шаг температуры между кандидатами
+SPECULATIVE_TEMPERATURE_STEP = 0.1
+MAX_TEMPERATURE = 0.95
+# Раундов: после неудачного раунда промпт усиливается и кандидаты запрашиваются снова
+SPECULATIVE_ROUNDS = 2
+# Ожидание кандидатов одного раунда (таймаут запроса к GigaChat — 30 с)
+SPECULATIVE_ROUND_TIMEOUT = 35
+# Потоков на процесс: запросы отменённых кандидатов дорабатывают в фоне и занимают поток до ответа
+SPECULATIVE_POOL_SIZE = int(os.getenv('SPECULATIVE_POOL_SIZE', '8'))
+
+# Телеметрия выходов из роли (hash): по сценарию и по шаблону промпта.
+# Поля: turns — реплик, attempts/breaks — ответов модели и выходов из роли среди них,
+# plain_attempts/plain_breaks — то же для запросов без усиленного промпта, hardened_turns — реплик с усилением
+# с первой попытки, fallbacks — реплик с резервным ответом, phrase:<фраза> — выходов из роли по совпавшей фразе
+ROLE_BREAK_SCENARIO_KEY = "role_break:scenario:{scenario_id}"
+ROLE_BREAK_TEMPLATE_KEY = "role_break:template:{template_id}"
+ROLE_BREAK_PHRASE_PREFIX = 'phrase:'
+# Ручная настройка числа кандидатов по сценарию (hash scenario_id -> fanout)
+SPECULATIVE_FANOUT_KEY = "speculative:fanout"
+# Доля выходов из роли без усиления, начиная с которой сценарий получает усиленный промпт с первой попытки
+ROLE_BREAK_HARDEN_RATE = float(os.getenv('ROLE_BREAK_HARDEN_RATE', '0.25'))
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=SPECULATIVE_POOL_SIZE, thread_name_prefix='speculative')
+
+
+class AIReplyService:
+    """
+    Класс-сервис для получения реплики ИИ:
+    - Телеметрия выходов из роли по сценарию и шаблону (фразы, попытки, резервные ответы)
+    - Усиленный промпт с первой попытки для сценариев с частым выходом из роли
+    - Выбор числа параллельных кандидатов (настройка администратора или по измеренной доле)
+    - Спекулятивная генерация: первый кандидат, прошедший фильтр, остальные отменяются
+    """
+    @staticmethod
+    def _summarize(raw):
+        """
+        Сводка телеметрии из полей hash.
+        :param raw: dict bytes -> bytes из HGETALL
+        :return: dict
+        """
+        counters = {k.decode('utf-8'): int(v) for k, v in raw.items()} if raw else {}
+        phrases = {name[len(ROLE_BREAK_PHRASE_PREFIX):]: count for name, count in counters.items()
+                   if name.startswith(ROLE_BREAK_PHRASE_PREFIX)}
+        attempts, breaks = counters.get('attempts', 0), counters.get('breaks', 0)
+        plain_attempts, plain_breaks = counters.get('plain_attempts', 0), counters.get('plain_breaks', 0)
+        turns = counters.get('turns', 0)
+        return {
+            'turns': turns,
+            'attempts': attempts,
+            'breaks': breaks,
+            'rate': round(breaks / attempts, 4) if attempts else None,
+            'plain_attempts': plain_attempts,
+            'plain_breaks': plain_breaks,
+            'plain_rate': round(plain_breaks / plain_attempts, 4) if plain_attempts else None,
+            'attempts_per_turn': round(attempts / turns, 3) if turns else None,
+            'hardened_turns': counters.get('hardened_turns', 0),
+            'fallbacks': counters.get('fallbacks', 0),
+            'phrases': dict(sorted(phrases.items(), key=lambda item: item[1], reverse=True)),
+        }
+
+    @staticmethod
+    def get_break_stats(scenario_id):
+        """
+        Возвращает телеметрию выходов из роли по сценарию и ручную настройку числа кандидатов.
+        :param scenario_id: int
+        :return: dict (см. _summarize) и fanout_override
+        """
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hgetall(ROLE_BREAK_SCENARIO_KEY.format(scenario_id=scenario_id))
+            pipe.hget(SPECULATIVE_FANOUT_KEY, str(scenario_id))
+            raw, override = pipe.execute()
+        except Exception as e:
+            logger.error("Ошибка при чтении статистики выходов из роли: %s", e)
+            raw = override = None
+        return dict(AIReplyService._summarize(raw), fanout_override=int(override) if override else None)
+
+    @staticmethod
+    def get_break_report(scenario_ids, template_ids):
+        """
+        Телеметрия выходов из роли по списку сценариев и шаблонов одним конвейером Redis.
+        :param scenario_ids: список id сценариев
+        :param template_ids: список id шаблонов
+        :return: (dict scenario_id -> сводка, dict template_id -> сводка)
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        for scenario_id in scenario_ids:
+            pipe.hgetall(ROLE_BREAK_SCENARIO_KEY.format(scenario_id=scenario_id))
+        for template_id in template_ids:
+            pipe.hgetall(ROLE_BREAK_TEMPLATE_KEY.format(template_id=template_id))
+        pipe.hgetall(SPECULATIVE_FANOUT_KEY)
+        results = pipe.execute()
+        overrides = {int(k): int(v) for k, v in results[-1].items()}
+        scenarios = {}
+        for scenario_id, raw in zip(scenario_ids, results):
+            stats = dict(AIReplyService._summarize(raw), fanout_override=overrides.get(scenario_id))
+            stats['hardened'] = AIReplyService.should_harden(stats)
+            stats['fanout'] = AIReplyService.choose_fanout(scenario_id, stats)
+            scenarios[scenario_id] = stats
+        templates = {template_id: AIReplyService._summarize(raw)
+                     for template_id, raw in zip(template_ids, results[len(scenario_ids):-1])}
+        return scenarios, templates
+
+    @staticmethod
+    def reset_break_stats(scenario_id):
+        """
+        Сбрасывает телеметрию сценария (например, после правки его промпта).
+        :param scenario_id: int
+        """
+        redis_client.delete(ROLE_BREAK_SCENARIO_KEY.format(scenario_id=scenario_id))
+
+    @staticmethod
+    def should_harden(stats):
+        """
+        Нужен ли сценарию усиленный промпт с первой попытки. Решение принимается по запросам без усиления,
+        поэтому после включения усиления доля не падает сама и оно не отключается до сброса статистики.
+        :param stats: dict из get_break_stats
+        :return: bool
+        """
+        return (stats['plain_attempts'] >= SPECULATIVE_MIN_SAMPLES
+                and stats['plain_rate'] is not None and stats['plain_rate'] >= ROLE_BREAK_HARDEN_RATE)
+
+    @staticmethod
+    def fanout_for_rate(rate):
+        """
+        Минимальное число кандидатов, при котором вероятность выхода из роли всех сразу не выше целевой.
+        :param rate: float — доля обращений с выходом из роли
+        :return: int
+        """
+        if rate <= 0:
+            return 1
+        if rate >= 1:
+            return SPECULATIVE_MAX_FANOUT
+        needed = math.ceil(math.log(SPECULATIVE_TARGET_FAILURE) / math.log(rate))
+        return max(1, min(SPECULATIVE_MAX_FANOUT, needed))
+
+    @staticmethod
+    def choose_fanout(scenario_id, stats=None):
+        """
+        Возвращает число параллельных кандидатов для реплики в сценарии.
+        :param scenario_id: int
+        :param stats: dict из get_break_stats (если уже прочитан)
+        :return: int (1 — обычные последовательные повторы)
+        """
+        if SPECULATIVE_MODE == 'off':
+            return 1
+        stats = stats or AIReplyService.get_break_stats(scenario_id)
+        if stats['fanout_override']:
+            return max(1, min(SPECULATIVE_MAX_FANOUT, stats['fanout_override']))
+        if SPECULATIVE_MODE == 'always':
+            return SPECULATIVE_MAX_FANOUT
+        if stats['attempts'] < SPECULATIVE_MIN_SAMPLES:
+            return 1
+        return AIReplyService.fanout_for_rate(stats['rate'])
+
+    @staticmethod
+    def set_fanout_override(scenario_id, fanout):
+        """
+        Задаёт число кандидатов для сценария вручную (None — выбирать автоматически).
+        :param scenario_id: int
+        :param fanout: int или None
+        """
+        if fanout:
+            redis_client.hset(SPECULATIVE_FANOUT_KEY, str(scenario_id), int(fanout))
+        else:
+            redis_client.hdel(SPECULATIVE_FANOUT_KEY, str(scenario_id))
+
+    @staticmethod
+    def new_turn_outcome(hardened=False):
+        """
+        Итог получения одной реплики для телеметрии.
+        :param hardened: bool — усиленный промпт с первой попытки
+        :return: dict
+        """
+        return {'hardened': hardened, 'attempts': 0, 'breaks': 0, 'plain_attempts': 0, 'plain_breaks': 0,
+                'reasons': [], 'errors': 0, 'insufficient_balance': False, 'fallback': False}
+
+    @staticmethod
+    def note_attempt(outcome, reason, plain):
+        """
+        Учитывает ответ модели в итоге реплики.
+        :param outcome: dict из new_turn_outcome
+        :param reason: строка — причина выхода из роли или None
+        :param plain: bool — запрос был без усиленного промпта
+        """
+        outcome['attempts'] += 1
+        if plain:
+            outcome['plain_attempts'] += 1
+        if reason is not None:
+            outcome['breaks'] += 1
+            outcome['reasons'].append(reason)
+            if plain:
+                outcome['plain_breaks'] += 1
+
+    @staticmethod
+    def record_turn(scenario_id, template_id, outcome):
+        """
+        Записывает итог реплики в телеметрию сценария и шаблона одним конвейером Redis.
+        :param scenario_id: int
+        :param template_id: int или None
+        :param outcome: dict из new_turn_outcome
+        """
+        increments = {
+            'turns': 1,
+            'attempts': outcome['attempts'],
+            'breaks': outcome['breaks'],
+            'plain_attempts': outcome['plain_attempts'],
+            'plain_breaks': outcome['plain_breaks'],
+            'hardened_turns': int(outcome['hardened']),
+            'fallbacks': int(outcome['fallback']),
+        }
+        for reason in outcome['reasons']:
+            field = ROLE_BREAK_PHRASE_PREFIX + reason
+            increments[field] = increments.get(field, 0) + 1
+        keys = [ROLE_BREAK_SCENARIO_KEY.format(scenario_id=scenario_id)]
+        if template_id:
+            keys.append(ROLE_BREAK_TEMPLATE_KEY.format(template_id=template_id))
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                for field, amount in increments.items():
+                    if amount:
+                        pipe.hincrby(key, field, amount)
+            pipe.execute()
+        except Exception as e:
+            logger.error("Ошибка при записи статистики выходов из роли: %s", e)
+
+    @staticmethod
+    def _send_candidate(params, index, spans):
+        with attach_context(spans), start_span('gigachat.candidate', attributes={
+                'candidate.index': index, 'candidate.temperature': params['temperature']}):
+            return gigachat_service.send(params, retries=0)
+
+    @staticmethod
+    def generate_speculative(api_params, fanout, accept, harden, outcome):
+        """
+        Запрашивает fanout кандидатов параллельно (температура растёт на SPECULATIVE_TEMPERATURE_STEP)
+        и возвращает первый прошедший фильтр. Ещё не начатые запросы отменяются; уже отправленные
+        дорабатывают в фоне, их ответы отбрасываются. Если все кандидаты раунда вышли из роли,
+        следующий раунд идёт с усиленным промптом.
+        :param api_params: dict — параметры запроса к GigaChat
+        :param fanout: int — число кандидатов
+        :param accept: функция текст -> причина выхода из роли или None
+        :param harden: функция params -> новые params с усиленным промптом
+        :param outcome: dict из new_turn_outcome — дополняется попытками и причинами
+        :return: строка или None
+        """
+        spans = capture_context()
+        params = api_params
+        for round_index in range(SPECULATIVE_ROUNDS):
+            plain = round_index == 0 and not outcome['hardened']
+            futures = [
+                _executor.submit(AIReplyService._send_candidate,
+                                 dict(params, temperature=min(MAX_TEMPERATURE, params['temperature'] + SPECULATIVE_TEMPERATURE_STEP * index)),
+                                 index, spans)
+                for index in range(fanout)
+            ]
+            try:
+                for future in as_completed(futures, timeout=SPECULATIVE_ROUND_TIMEOUT):
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        logger.warning("Ошибка кандидата GigaChat: %s", e)
+                        outcome['errors'] += 1
+                        continue
+                    if isinstance(response, dict) and response.get('error', {}).get('code') == 'insufficient_balance':
+                        outcome['insufficient_balance'] = True
+                        return None
+                    if not response or not response.get('choices'):
+                        outcome['errors'] += 1
+                        continue
+                    content = response['choices'][0]['message']['content'].strip()
+                    reason = accept(content)
+                    AIReplyService.note_attempt(outcome, reason, plain)
+                    if reason is None:
+                        return content
+            except FuturesTimeoutError:
+                outcome['errors'] += 1
+            finally:
+                for future in futures:
+                    future.cancel()
+            params = harden(params)
+        return None
@@ -0,0 +1,257 @@
+# Сервис кэша анализа диалогов: одинаковые диалоги (короткие сценарии, прогоны QA) получают готовый
+# анализ без запроса к GigaChat. Ключ — версия промпта анализа, контекст сценария (включая списки
+# фильтра ответов) и хэш нормализованной стенограммы; в режиме near похожие диалоги находятся по MinHash
+# от шинглов стенограммы. В кэш записываются только ответы, прошедшие фильтр ответов.
+from collections import namedtuple
+from services.response_filter_service import ResponseFilterService
+from utils.metrics import count_llm_event, LLM_EVENTS_KEY
+from utils.redis_client import redis_client
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+
+# Режим кэша: off, exact (совпадение нормализованной стенограммы), near (также почти совпадающие диалоги)
+ANALYSIS_CACHE_MODE = os.getenv('ANALYSIS_CACHE_MODE', 'exact').lower()
+# Сколько записей хранится; при превышении вытесняются давно не использованные (LRU)
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '5000'))
+ANALYSIS_CACHE_TTL = int(os.getenv('ANALYSIS_CACHE_TTL', str(30 * 24 * 3600)))
+# Минимальная оценка сходства по Жаккару для режима near
+ANALYSIS_CACHE_NEAR_THRESHOLD = float(os.getenv('ANALYSIS_CACHE_NEAR_THRESHOLD', '0.9'))
+
+# Запись кэша (hash: content — ответ модели как есть, signature — MinHash)
+ANALYSIS_CACHE_ENTRY_KEY = "analysis_cache:entry:{namespace}:{digest}"
+# Полоса LSH (set дайджестов записей с одинаковым фрагментом подписи)
+ANALYSIS_CACHE_BAND_KEY = "analysis_cache:band:{namespace}:{band}:{value}"
+# Время последнего обращения к записям (sorted set ключ записи -> unix time) для вытеснения
+ANALYSIS_CACHE_LRU_KEY = "analysis_cache:lru"
+
+# MinHash: MINHASH_BANDS полос по MINHASH_ROWS значений; кандидаты проверяются оценкой сходства
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+SHINGLE_SIZE = 3
+# Кандидатов из LSH, для которых читается подпись
+MAX_NEAR_CANDIDATES = 20
+_MERSENNE_PRIME = (1 << 61) - 1
+# Коэффициенты хэш-функций фиксированы: подписи, записанные разными процессами, сравнимы
+_rng = random.Random(1931)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+_SPACES = re.compile(r'\s+')
+
+# События кэша в метриках GigaChat (gigachat_events_total): доля попаданий = (hit + near_hit) / все
+HIT_EVENT = 'analysis_cache_hit'
+NEAR_HIT_EVENT = 'analysis_cache_near_hit'
+MISS_EVENT = 'analysis_cache_miss'
+
+CacheKey = namedtuple('CacheKey', ['namespace', 'digest', 'signature'])
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisCacheService:
+    """
+    Класс-сервис для кэша анализа диалогов:
+    - Нормализация стенограммы (регистр, ё, пунктуация, пробелы) и ключ по версии промпта и сценарию
+    - Точный поиск по хэшу и поиск почти совпадающих диалогов по MinHash и LSH (режим near)
+    - Вытеснение давно не использованных записей сверх ANALYSIS_CACHE_MAX_ENTRIES
+    - Счётчики попаданий и промахов в метриках
+    """
+    @staticmethod
+    def normalize_transcript(dialog_text):
+        """
+        Нормализует стенограмму: разница в регистре, пунктуации и пробелах не меняет ключ.
+        :param dialog_text: строка из build_dialog_text
+        :return: строка
+        """
+        lines = []
+        for line in dialog_text.splitlines():
+            line = _SPACES.sub(' ', _PUNCTUATION.sub(' ', line.lower().replace('ё', 'е'))).strip()
+            if line:
+                lines.append(line)
+        return '\n'.join(lines)
+
+    @staticmethod
+    def minhash(text):
+        """
+        MinHash-подпись по шинглам из SHINGLE_SIZE слов.
+        :param text: нормализованная стенограмма
+        :return: список int
+        """
+        words = text.split()
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big') for s in shingles]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+    @staticmethod
+    def _bands(signature):
+        """Значения полос LSH подписи: (номер полосы, хэш фрагмента)"""
+        for band in range(MINHASH_BANDS):
+            chunk = ','.join(map(str, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+            yield band, hashlib.md5(chunk.encode('ascii')).hexdigest()[:16]
+
+    @staticmethod
+    def make_key(version, scenario, dialog_text):
+        """
+        Ключ кэша анализа диалога. Запись прошла фильтр ответов сценария, поэтому в контекст входят
+        списки фильтра: версия списков организаций и шаблонов, организация, шаблон и слова сценария.
+        :param version: строка — DialogAnalysisService.prompt_version
+        :param scenario: объект Scenario (описание и роли подставляются в промпт анализа)
+        :param dialog_text: строка из build_dialog_text
+        :return: CacheKey или None, если кэш выключен
+        """
+        if ANALYSIS_CACHE_MODE not in ('exact', 'near'):
+            return None
+        fields = ('description', 'user_role', 'ai_role', 'language',
+                  'organization_id', 'prompt_template_id', 'forbidden_words')
+        context = '\x1f'.join([str(getattr(scenario, field, '') or '') for field in fields]
+                              + [str(ResponseFilterService.current_version())])
+        context_digest = hashlib.md5(context.encode('utf-8')).hexdigest()[:12]
+        normalized = AnalysisCacheService.normalize_transcript(dialog_text)
+        return CacheKey(
+            namespace=f'{version}:{context_digest}',
+            digest=hashlib.sha256(normalized.encode('utf-8')).hexdigest(),
+            signature=AnalysisCacheService.minhash(normalized) if ANALYSIS_CACHE_MODE == 'near' else None,
+        )
+
+    @staticmethod
+    def _entry_key(namespace, digest):
+        return ANALYSIS_CACHE_ENTRY_KEY.format(namespace=namespace, digest=digest)
+
+    @staticmethod
+    def _find_near(key):
+        """
+        Ищет запись почти совпадающего диалога: кандидаты по полосам LSH, затем оценка сходства по подписи.
+        :param key: CacheKey с подписью
+        :return: (ключ записи, текст) или None
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        for band, value in AnalysisCacheService._bands(key.signature):
+            pipe.smembers(ANALYSIS_CACHE_BAND_KEY.format(namespace=key.namespace, band=band, value=value))
+        counts = {}
+        for members in pipe.execute():
+            for digest in members:
+                counts[digest] = counts.get(digest, 0) + 1
+        candidates = sorted(counts, key=counts.get, reverse=True)[:MAX_NEAR_CANDIDATES]
+        if not candidates:
+            return None
+
+        pipe = redis_client.pipeline(transaction=False)
+        entry_keys = [AnalysisCacheService._entry_key(key.namespace, digest.decode('ascii')) for digest in candidates]
+        for entry_key in entry_keys:
+            pipe.hget(entry_key, 'signature')
+        best = None
+        for entry_key, signature in zip(entry_keys, pipe.execute()):
+            if not signature:
+                continue
+            other = signature.decode('ascii').split(',')
+            similarity = sum(str(a) == b for a, b in zip(key.signature, other)) / len(key.signature)
+            if similarity >= ANALYSIS_CACHE_NEAR_THRESHOLD and (best is None or similarity > best[0]):
+                best = (similarity, entry_key)
+        if best is None:
+            return None
+        content = redis_client.hget(best[1], 'content')
+        return (best[1], content) if content is not None else None
+
+    @staticmethod
+    def lookup(key):
+        """
+        Возвращает сохранённый ответ модели для диалога и учитывает попадание или промах в метриках.
+        :param key: CacheKey или None
+        :return: строка или None
+        """
+        if key is None:
+            return None
+        try:
+            entry_key = AnalysisCacheService._entry_key(key.namespace, key.digest)
+            content = redis_client.hget(entry_key, 'content')
+            event = HIT_EVENT
+            if content is None and key.signature:
+                found = AnalysisCacheService._find_near(key)
+                if found:
+                    entry_key, content = found
+                    event = NEAR_HIT_EVENT
+            if content is None:
+                count_llm_event(MISS_EVENT)
+                return None
+            redis_client.zadd(ANALYSIS_CACHE_LRU_KEY, {entry_key: time.time()}, xx=True)
+            count_llm_event(event)
+            return content.decode('utf-8')
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша анализа: {str(e)}")
+            return None
+
+    @staticmethod
+    def store(key, content):
+        """
+        Сохраняет ответ модели для диалога и вытесняет давно не использованные записи сверх лимита.
+        :param key: CacheKey или None
+        :param content: строка — ответ модели (с блоком оценки)
+        """
+        if key is None:
+            return
+        try:
+            entry_key = AnalysisCacheService._entry_key(key.namespace, key.digest)
+            mapping = {'content': content}
+            if key.signature:
+                mapping['signature'] = ','.join(map(str, key.signature))
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hset(entry_key, mapping=mapping)
+            pipe.expire(entry_key, ANALYSIS_CACHE_TTL)
+            if key.signature:
+                for band, value in AnalysisCacheService._bands(key.signature):
+                    band_key = ANALYSIS_CACHE_BAND_KEY.format(namespace=key.namespace, band=band, value=value)
+                    pipe.sadd(band_key, key.digest)
+                    pipe.expire(band_key, ANALYSIS_CACHE_TTL)
+            pipe.zadd(ANALYSIS_CACHE_LRU_KEY, {entry_key: time.time()})
+            pipe.zcard(ANALYSIS_CACHE_LRU_KEY)
+            size = pipe.execute()[-1]
+            if size > ANALYSIS_CACHE_MAX_ENTRIES:
+                # Дайджесты вытесненных записей остаются в полосах LSH до истечения TTL и пропускаются при поиске
+                evicted = redis_client.zpopmin(ANALYSIS_CACHE_LRU_KEY, size - ANALYSIS_CACHE_MAX_ENTRIES)
+                if evicted:
+                    redis_client.delete(*[member for member, _ in evicted])
+        except Exception as e:
+            logger.error(f"Ошибка при записи кэша анализа: {str(e)}")
+
+    @staticmethod
+    def get_stats():
+        """
+        Статистика кэша: попадания, промахи, доля попаданий и число записей.
+        :return: dict
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hmget(LLM_EVENTS_KEY, HIT_EVENT, NEAR_HIT_EVENT, MISS_EVENT)
+        pipe.zcard(ANALYSIS_CACHE_LRU_KEY)
+        (hits, near_hits, misses), entries = pipe.execute()
+        hits, near_hits, misses = int(hits or 0), int(near_hits or 0), int(misses or 0)
+        total = hits + near_hits + misses
+        return {
+            'mode': ANALYSIS_CACHE_MODE,
+            'hits': hits,
+            'near_hits': near_hits,
+            'misses': misses,
+            'hit_rate': round((hits + near_hits) / total, 4) if total else None,
+            'entries': entries,
+            'max_entries': ANALYSIS_CACHE_MAX_ENTRIES,
+        }
+
+    @staticmethod
+    def clear():
+        """
+        Удаляет все записи кэша анализа (например, после правки встроенного промпта без смены версии).
+        :return: int — количество удалённых ключей
+        """
+        deleted = 0
+        batch = []
+        for key in redis_client.scan_iter(match='analysis_cache:*', count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                deleted += redis_client.delete(*batch)
+                batch = []
+        if batch:
+            deleted += redis_client.delete(*batch)
+        return deleted
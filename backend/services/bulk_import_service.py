@@ -0,0 +1,361 @@
+# Сервис массового импорта сценариев, пользователей организации и достижений из JSON или CSV.
+# Строки проверяются по отдельности (ошибки попадают в отчёт), корректные вставляются пачками
+# одним executemany в одной транзакции; кэши сбрасываются один раз в конце.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import insert, select, update, func
+from werkzeug.security import generate_password_hash
+from models.models import (Scenario, ScenarioType, PromptTemplate, Organization, Users, UserRole,
+                           UserPreferences, UserStatistics, Achievement)
+from models.database import db
+from services.scenario_catalog_service import ScenarioCatalogService
+from utils.auth import invalidate_user_cache
+from utils.redis_client import redis_client
+import csv
+import io
+import json
+import logging
+import os
+import re
+import secrets
+
+# Максимум строк в одном запросе импорта
+MAX_IMPORT_ROWS = int(os.getenv('MAX_IMPORT_ROWS', '10000'))
+# Строк в одном executemany
+INSERT_CHUNK_SIZE = 1000
+# Потоков для хэширования паролей (pbkdf2 в hashlib отпускает GIL)
+PASSWORD_HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+TRUE_VALUES = ('1', 'true', 'yes', 'да')
+
+logger = logging.getLogger(__name__)
+
+
+class BulkImportService:
+    """
+    Класс-сервис для массового импорта:
+    - Разбор тела запроса (JSON-массив, {"items": [...]}, CSV в теле или файлом)
+    - Построчная проверка с отчётом об ошибках
+    - Пакетная вставка корректных строк и однократный сброс кэшей
+    """
+    @staticmethod
+    def parse_rows(req):
+        """
+        Извлекает строки импорта из запроса.
+        :param req: объект запроса Flask
+        :return: список словарей
+        :raises ValueError: при пустом или некорректном теле
+        """
+        upload = req.files.get('file')
+        if upload is not None or req.mimetype == 'text/csv':
+            raw = upload.read() if upload is not None else req.get_data()
+            try:
+                rows = list(csv.DictReader(io.StringIO(raw.decode('utf-8-sig'))))
+            except (UnicodeDecodeError, csv.Error) as e:
+                raise ValueError(f"Не удалось прочитать CSV: {e}")
+        else:
+            data = req.get_json(silent=True)
+            rows = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(rows, list) or not rows:
+            raise ValueError("Ожидается непустой список записей (JSON-массив, поле items или CSV)")
+        if len(rows) > MAX_IMPORT_ROWS:
+            raise ValueError(f"Слишком много записей: {len(rows)}, максимум {MAX_IMPORT_ROWS}")
+        if not all(isinstance(row, dict) for row in rows):
+            raise ValueError("Каждая запись должна быть объектом")
+        return rows
+
+    @staticmethod
+    def _text(row, field, max_length=None, required=False):
+        value = row.get(field)
+        value = value.strip() if isinstance(value, str) else value
+        if value in (None, ''):
+            if required:
+                raise ValueError(f"Поле {field} обязательно")
+            return None
+        value = str(value)
+        if max_length and len(value) > max_length:
+            raise ValueError(f"Поле {field} длиннее {max_length} символов")
+        return value
+
+    @staticmethod
+    def _bool(row, field, default=False):
+        value = row.get(field)
+        if value in (None, ''):
+            return default
+        if isinstance(value, bool):
+            return value
+        return str(value).strip().lower() in TRUE_VALUES
+
+    @staticmethod
+    def _int(row, field, default=None):
+        value = row.get(field)
+        if value in (None, ''):
+            return default
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Поле {field} должно быть целым числом")
+
+    @staticmethod
+    def _report(total, dry_run):
+        return {'total': total, 'created': 0, 'updated': 0, 'failed': 0, 'errors': [], 'dry_run': dry_run}
+
+    @staticmethod
+    def _fail(report, index, error, key=None):
+        report['failed'] += 1
+        item = {'row': index + 1, 'error': error}
+        if key:
+            item['key'] = key
+        report['errors'].append(item)
+
+    @staticmethod
+    def _insert(model, rows, returning=False):
+        """
+        Вставляет строки пачками через executemany.
+        :return: список id (если returning) или None
+        """
+        ids = []
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            chunk = rows[start:start + INSERT_CHUNK_SIZE]
+            if returning:
+                ids.extend(db.session.scalars(insert(model).returning(model.id), chunk).all())
+            else:
+                db.session.execute(insert(model), chunk)
+        return ids if returning else None
+
+    @staticmethod
+    def import_scenarios(rows, dry_run=False):
+        """
+        Импортирует сценарии (поля как у POST /api/scenarios).
+        :param rows: список словарей
+        :param dry_run: bool — только проверить
+        :return: dict — отчёт
+        """
+        from routes.scenarios import build_default_prompt_template
+
+        report = BulkImportService._report(len(rows), dry_run)
+        template_ids = {row.get('prompt_template_id') for row in rows if row.get('prompt_template_id') not in (None, '')}
+        org_ids = {row.get('organization_id') for row in rows if row.get('organization_id') not in (None, '')}
+        known_templates = set(db.session.scalars(select(PromptTemplate.id).where(
+            PromptTemplate.id.in_([int(t) for t in template_ids if str(t).isdigit()])))) if template_ids else set()
+        known_orgs = set(db.session.scalars(select(Organization.id).where(
+            Organization.id.in_([int(o) for o in org_ids if str(o).isdigit()])))) if org_ids else set()
+
+        valid = []
+        now = datetime.utcnow()
+        for index, row in enumerate(rows):
+            try:
+                name = BulkImportService._text(row, 'name', 200, required=True)
+                description = BulkImportService._text(row, 'description', required=True)
+                # Как и в add_scenario: sphere хранится и в category, situation — и в subcategory
+                sphere = BulkImportService._text(row, 'sphere', 50, required=True)
+                situation = BulkImportService._text(row, 'situation', 50, required=True)
+                mood = BulkImportService._text(row, 'mood', 100, required=True)
+                language = BulkImportService._text(row, 'language', 50, required=True)
+                user_role = BulkImportService._text(row, 'user_role', 200, required=True)
+                ai_role = BulkImportService._text(row, 'ai_role', 200, required=True)
+                ai_behavior = BulkImportService._text(row, 'ai_behavior', 200, required=True)
+                prompt_template_id = BulkImportService._int(row, 'prompt_template_id')
+                organization_id = BulkImportService._int(row, 'organization_id')
+                if prompt_template_id is not None and prompt_template_id not in known_templates:
+                    raise ValueError(f"Шаблон промпта {prompt_template_id} не найден")
+                if organization_id is not None and organization_id not in known_orgs:
+                    raise ValueError(f"Организация {organization_id} не найдена")
+            except ValueError as e:
+                BulkImportService._fail(report, index, str(e), row.get('name'))
+                continue
+            valid.append({
+                'name': name,
+                'description': description,
+                'category': sphere,
+                'subcategory': situation,
+                'sphere': sphere,
+                'situation': situation,
+                'mood': mood,
+                'language': language,
+                'user_role': user_role,
+                'ai_role': ai_role,
+                'ai_behavior': ai_behavior,
+                'prompt_template': BulkImportService._text(row, 'prompt_template')
+                                   or build_default_prompt_template(sphere, description, user_role, ai_role, ai_behavior),
+                'prompt_template_id': prompt_template_id,
+                'organization_id': organization_id,
+                'is_template': BulkImportService._bool(row, 'is_template'),
+                'is_active': BulkImportService._bool(row, 'is_active', default=True),
+                'type': ScenarioType.CAFE,
+                'difficulty': 1,
+                'created_at': now,
+            })
+
+        if dry_run or not valid:
+            return report
+
+        ids = BulkImportService._insert(Scenario, valid, returning=True)
+        db.session.commit()
+        report['created'] = len(ids)
+        report['ids'] = ids
+
+        ScenarioCatalogService.bump_version()
+        # Привязки сценариев к шаблонам в Redis обновляются одной записью (как в add_scenario)
+        linked = {str(scenario_id): row['prompt_template_id'] for scenario_id, row in zip(ids, valid) if row['prompt_template_id']}
+        if linked:
+            try:
+                raw = redis_client.get('scenario_prompt_template_map')
+                current_map = json.loads(raw.decode('utf-8')) if raw else {}
+                if not isinstance(current_map, dict):
+                    current_map = {}
+                current_map.update(linked)
+                redis_client.set('scenario_prompt_template_map', json.dumps(current_map, ensure_ascii=False))
+            except Exception as e:
+                logger.error("Ошибка при обновлении привязок шаблонов: %s", e)
+        return report
+
+    @staticmethod
+    def import_users(rows, organization_id, dry_run=False):
+        """
+        Импортирует пользователей в организацию: новых создаёт, существующих (по email) переводит в организацию.
+        Пользователи без пароля получают недействующий пароль и входят через VK/Яндекс или после смены пароля.
+        :param rows: список словарей email, username, password, role, is_active
+        :param organization_id: int
+        :param dry_run: bool — только проверить
+        :return: dict — отчёт
+        """
+        report = BulkImportService._report(len(rows), dry_run)
+        emails = {str(row.get('email', '')).strip().lower() for row in rows}
+        usernames = {str(row.get('username', '')).strip() for row in rows}
+        existing_by_email = {
+            email.lower(): (user_id, org_id)
+            for user_id, email, org_id in db.session.execute(
+                select(Users.id, Users.email, Users.organization_id).where(func.lower(Users.email).in_(emails)))
+        }
+        taken_usernames = set(db.session.scalars(select(Users.username).where(Users.username.in_(usernames))))
+
+        new_users, move_ids = [], []
+        seen_emails, seen_usernames = set(), set()
+        for index, row in enumerate(rows):
+            try:
+                email = BulkImportService._text(row, 'email', 120, required=True).lower()
+                if not EMAIL_RE.match(email):
+                    raise ValueError("Некорректный email")
+                if email in seen_emails:
+                    raise ValueError("Email повторяется в файле")
+                seen_emails.add(email)
+
+                if email in existing_by_email:
+                    user_id, current_org = existing_by_email[email]
+                    if current_org != organization_id:
+                        move_ids.append(user_id)
+                    continue
+
+                username = BulkImportService._text(row, 'username', 50) or email.split('@')[0][:50]
+                if username in taken_usernames or username in seen_usernames:
+                    raise ValueError(f"Имя пользователя {username} уже занято")
+                try:
+                    role = UserRole((BulkImportService._text(row, 'role') or 'user').lower())
+                except ValueError:
+                    raise ValueError("Недопустимая роль")
+                password = BulkImportService._text(row, 'password')
+                if password is not None and len(password) < 6:
+                    raise ValueError("Пароль короче 6 символов")
+            except ValueError as e:
+                BulkImportService._fail(report, index, str(e), row.get('email'))
+                continue
+            seen_usernames.add(username)
+            new_users.append({
+                'email': email,
+                'username': username,
+                'password': password,
+                'role': role,
+                'is_active': BulkImportService._bool(row, 'is_active', default=True),
+            })
+
+        if dry_run:
+            return report
+
+        # Хэширование — самая долгая часть: считаем параллельно, а без пароля используем один общий
+        # хэш случайного секрета, который нигде не сохраняется
+        unusable_hash = generate_password_hash(secrets.token_urlsafe(32))
+        passwords = [user.pop('password') for user in new_users]
+        with ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS) as pool:
+            hashes = list(pool.map(lambda p: generate_password_hash(p) if p else unusable_hash, passwords))
+
+        now = datetime.utcnow()
+        for user, password_hash in zip(new_users, hashes):
+            user.update(password_hash=password_hash, organization_id=organization_id, created_at=now)
+
+        ids = BulkImportService._insert(Users, new_users, returning=True) if new_users else []
+        if ids:
+            BulkImportService._insert(UserPreferences, [{
+                'user_id': user_id, 'language': 'ru', 'difficulty_preference': 'normal', 'theme': 'light', 'created_at': now
+            } for user_id in ids])
+            BulkImportService._insert(UserStatistics, [{
+                'user_id': user_id, 'total_dialogs': 0, 'completed_scenarios': 0, 'total_time_spent': 0, 'average_score': 0.0
+            } for user_id in ids])
+        if move_ids:
+            db.session.execute(update(Users).where(Users.id.in_(move_ids)).values(organization_id=organization_id))
+        db.session.commit()
+        report['created'] = len(ids)
+        report['updated'] = len(move_ids)
+
+        for user_id in move_ids:
+            invalidate_user_cache(user_id)
+        if ids or move_ids:
+            ScenarioCatalogService.bump_version()
+        return report
+
+    @staticmethod
+    def import_achievements(rows, dry_run=False):
+        """
+        Импортирует достижения (поля как у POST /api/achievements); requirements в CSV передаётся строкой JSON.
+        :param rows: список словарей
+        :param dry_run: bool — только проверить
+        :return: dict — отчёт
+        """
+        report = BulkImportService._report(len(rows), dry_run)
+        existing_titles = set(db.session.scalars(select(Achievement.title)))
+
+        valid, seen_titles = [], set()
+        now = datetime.utcnow()
+        for index, row in enumerate(rows):
+            try:
+                title = BulkImportService._text(row, 'title', 100, required=True)
+                description = BulkImportService._text(row, 'description', required=True)
+                if title in existing_titles or title in seen_titles:
+                    raise ValueError("Достижение с таким названием уже существует")
+                points = BulkImportService._int(row, 'points', default=0)
+                if points < 0:
+                    raise ValueError("Поле points не может быть отрицательным")
+                requirements = row.get('requirements')
+                if isinstance(requirements, str) and requirements.strip():
+                    try:
+                        requirements = json.loads(requirements)
+                    except ValueError:
+                        raise ValueError("Поле requirements должно быть JSON")
+                if requirements in ('', None):
+                    requirements = None
+                elif not isinstance(requirements, dict) or 'type' not in requirements:
+                    raise ValueError("Поле requirements должно быть объектом с полем type")
+            except ValueError as e:
+                BulkImportService._fail(report, index, str(e), row.get('title'))
+                continue
+            seen_titles.add(title)
+            valid.append({
+                'title': title,
+                'name': title,
+                'description': description,
+                'icon': BulkImportService._text(row, 'icon', 500),
+                'points': points,
+                'is_repeatable': BulkImportService._bool(row, 'is_repeatable'),
+                'requirements': requirements,
+                'created_at': now,
+            })
+
+        if dry_run or not valid:
+            return report
+
+        ids = BulkImportService._insert(Achievement, valid, returning=True)
+        db.session.commit()
+        report['created'] = len(ids)
+        report['ids'] = ids
+        return report
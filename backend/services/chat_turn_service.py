@@ -0,0 +1,184 @@
+# Сервис для атомарной записи хода диалога (сообщение пользователя + ответ ИИ)
+from datetime import datetime
+from models.models import Message
+from models.database import db
+from utils.redis_client import redis_client
+import json
+import logging
+
+# Ключ Redis для результата хода по ключу идемпотентности
+TURN_IDEMPOTENCY_KEY = "chat:turn:{dialog_id}:{key}"
+# Сколько хранится готовый ответ для повторных запросов клиента (сутки)
+TURN_RESULT_TTL = 24 * 3600
+# Сколько держится отметка «ход в обработке» (больше, чем ретраи GigaChat)
+TURN_IN_PROGRESS_TTL = 120
+TURN_IN_PROGRESS_MARKER = b'__in_progress__'
+# Блокировка создания сессии пользователя по сценарию (держится, пока ждём первую реплику ИИ)
+SESSION_START_LOCK_KEY = "chat:session_start:{user_id}:{scenario_id}"
+SESSION_START_LOCK_TTL = 120
+
+logger = logging.getLogger(__name__)
+
+
+class ChatTurnService:
+    """
+    Класс-сервис для записи одного хода чата единой транзакцией:
+    - Идемпотентность по ключу клиента (повторы не создают дубликатов)
+    - Блокировка параллельного создания сессии по сценарию
+    - Сохранение сообщения пользователя, ответа ИИ и счётчиков диалога одним коммитом
+    """
+    @staticmethod
+    def get_idempotency_key(req, data):
+        """
+        Возвращает ключ идемпотентности из заголовка Idempotency-Key или поля client_message_id.
+        :param req: объект запроса Flask
+        :param data: dict — тело запроса
+        :return: строка или None
+        """
+        key = req.headers.get('Idempotency-Key') or (data or {}).get('client_message_id')
+        if not key:
+            return None
+        key = str(key).strip()
+        return key[:128] if key else None
+
+    @staticmethod
+    def begin(dialog_id, key):
+        """
+        Резервирует ключ идемпотентности перед обработкой хода.
+        :param dialog_id: int — идентификатор диалога
+        :param key: строка или None — ключ идемпотентности
+        :return: кортеж (state, payload), где state — 'new', 'in_progress' или 'done'
+        """
+        if not key:
+            return 'new', None
+        redis_key = TURN_IDEMPOTENCY_KEY.format(dialog_id=dialog_id, key=key)
+        try:
+            if redis_client.set(redis_key, TURN_IN_PROGRESS_MARKER, nx=True, ex=TURN_IN_PROGRESS_TTL):
+                return 'new', None
+            raw = redis_client.get(redis_key)
+            if raw is None:
+                # Ключ успел истечь между SET и GET — обрабатываем как новый ход
+                redis_client.set(redis_key, TURN_IN_PROGRESS_MARKER, ex=TURN_IN_PROGRESS_TTL)
+                return 'new', None
+            if raw == TURN_IN_PROGRESS_MARKER:
+                return 'in_progress', None
+            return 'done', json.loads(raw.decode('utf-8'))
+        except Exception as e:
+            # Redis недоступен — не блокируем чат, просто теряем защиту от дублей
+            logger.error(f"Ошибка при проверке ключа идемпотентности: {str(e)}")
+            return 'new', None
+
+    @staticmethod
+    def finish(dialog_id, key, payload):
+        """
+        Сохраняет итоговый ответ хода, чтобы повторный запрос получил его без записи в БД.
+        :param dialog_id: int — идентификатор диалога
+        :param key: строка или None — ключ идемпотентности
+        :param payload: dict — тело ответа
+        """
+        if not key:
+            return
+        redis_key = TURN_IDEMPOTENCY_KEY.format(dialog_id=dialog_id, key=key)
+        try:
+            redis_client.setex(redis_key, TURN_RESULT_TTL, json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении результата хода: {str(e)}")
+
+    @staticmethod
+    def release(dialog_id, key):
+        """
+        Снимает резерв ключа идемпотентности, если ход завершился ошибкой.
+        :param dialog_id: int — идентификатор диалога
+        :param key: строка или None — ключ идемпотентности
+        """
+        if not key:
+            return
+        try:
+            redis_client.delete(TURN_IDEMPOTENCY_KEY.format(dialog_id=dialog_id, key=key))
+        except Exception as e:
+            logger.error(f"Ошибка при снятии ключа идемпотентности: {str(e)}")
+
+    @staticmethod
+    def acquire_session_start(user_id, scenario_id):
+        """
+        Блокирует создание сессии пользователя по сценарию, чтобы параллельные запросы не создали два диалога.
+        :param user_id: int
+        :param scenario_id: int
+        :return: bool — False, если сессию уже создаёт другой запрос
+        """
+        try:
+            return bool(redis_client.set(SESSION_START_LOCK_KEY.format(user_id=user_id, scenario_id=scenario_id),
+                                         1, nx=True, ex=SESSION_START_LOCK_TTL))
+        except Exception as e:
+            # Redis недоступен — остаётся повторная проверка активного диалога перед коммитом
+            logger.error(f"Ошибка при блокировке создания сессии: {str(e)}")
+            return True
+
+    @staticmethod
+    def release_session_start(user_id, scenario_id):
+        """
+        Снимает блокировку создания сессии.
+        :param user_id: int
+        :param scenario_id: int
+        """
+        try:
+            redis_client.delete(SESSION_START_LOCK_KEY.format(user_id=user_id, scenario_id=scenario_id))
+        except Exception as e:
+            logger.error(f"Ошибка при снятии блокировки создания сессии: {str(e)}")
+
+    @staticmethod
+    def add_message(dialog, sender, text, timestamp=None):
+        """
+        Добавляет сообщение в сессию и обновляет счётчики диалога (без коммита).
+        :param dialog: объект Dialog (может быть ещё не сохранён)
+        :param sender: строка — 'user', 'assistant' или 'system'
+        :param text: строка — текст сообщения
+        :param timestamp: datetime или None
+        :return: объект Message
+        """
+        message = Message(
+            dialog=dialog,
+            sender=sender,
+            text=text,
+            timestamp=timestamp or datetime.utcnow()
+        )
+        db.session.add(message)
+        dialog.total_messages = (dialog.total_messages or 0) + 1
+        if sender == 'user':
+            dialog.user_messages_count = (dialog.user_messages_count or 0) + 1
+        elif sender == 'assistant':
+            dialog.ai_messages_count = (dialog.ai_messages_count or 0) + 1
+        return message
+
+    @staticmethod
+    def persist_turn(dialog, user_text, ai_text, user_timestamp):
+        """
+        Записывает ход диалога одной транзакцией: сообщение пользователя, ответ ИИ и счётчики.
+        :param dialog: объект Dialog
+        :param user_text: строка — сообщение пользователя
+        :param ai_text: строка — ответ ИИ
+        :param user_timestamp: datetime — время получения сообщения пользователя
+        :return: кортеж (user_message, ai_message)
+        """
+        try:
+            user_message = ChatTurnService.add_message(dialog, 'user', user_text, user_timestamp)
+            ai_message = ChatTurnService.add_message(dialog, 'assistant', ai_text)
+            db.session.commit()
+            return user_message, ai_message
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @staticmethod
+    def serialize_message(message):
+        """
+        Преобразует сообщение в словарь для ответа API.
+        :param message: объект Message
+        :return: dict
+        """
+        return {
+            'id': message.id,
+            'sender': message.sender,
+            'text': message.text,
+            'timestamp': message.timestamp.isoformat()
+        }
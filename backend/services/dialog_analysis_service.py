@@ -0,0 +1,526 @@
+# Сервис повторного анализа завершённых диалогов: после правки PromptTemplate.analysis_prompt
+# диалоги переанализируются фоновым заданием пачками, запросы к GigaChat идут параллельно
+# с ограничением частоты, прогресс сохраняется в Redis и задание можно продолжить с места остановки.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import select, case, func
+from sqlalchemy.orm import joinedload
+from models.models import Dialog, Users, Scenario, PromptTemplate, UserStatistics
+from models.database import db
+from services.analysis_cache_service import AnalysisCacheService
+from services.dialog_archive_service import DialogArchiveService
+from services.gigachat_service import gigachat_service
+from utils.redis_client import redis_client
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+# Версия блока оценки (SCORING_INSTRUCTIONS); входит в версию любого промпта анализа, увеличить при его изменении
+ANALYSIS_SCHEMA_VERSION = 's1'
+# Версия встроенного промпта анализа (build_analysis_prompt без шаблона); увеличить при его изменении
+BUILTIN_ANALYSIS_VERSION = f'{ANALYSIS_SCHEMA_VERSION}-builtin-1'
+# Длина хэша шаблона в версии: префикс md5 текста analysis_prompt (так же считается в SQL)
+ANALYSIS_VERSION_LENGTH = 12
+
+# Блок структурированной оценки, который дописывается к любому промпту анализа
+SCORING_INSTRUCTIONS = """
+
+В самом конце ответа, после анализа, добавь оценку диалога строго в формате JSON в блоке ```json:
+```json
+{"score": <общая оценка 0-100>, "is_successful": <true или false — достигнута ли цель сценария>, "criteria": {"communication": <0-100>, "empathy": <0-100>, "problem_solving": <0-100>, "professionalism": <0-100>}}
+```"""
+SCORING_CRITERIA = ('communication', 'empathy', 'problem_solving', 'professionalism')
+# Порог успешности, если модель не вернула is_successful
+SUCCESS_SCORE_THRESHOLD = 60
+SCORING_BLOCK_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.S)
+
+# Одновременных запросов к GigaChat из одного воркера
+REANALYSIS_CONCURRENCY = int(os.getenv('REANALYSIS_CONCURRENCY', '4'))
+# Запросов в секунду к GigaChat от всех воркеров повторного анализа вместе (квота API)
+REANALYSIS_RPS = float(os.getenv('REANALYSIS_RPS', '2'))
+# Диалогов в одной пачке (после каждой пачки — коммит и контрольная точка)
+REANALYSIS_BATCH_SIZE = int(os.getenv('REANALYSIS_BATCH_SIZE', '20'))
+# Через сколько секунд без отметки воркера задание в статусе running считается прерванным
+REANALYSIS_STALE_SECONDS = int(os.getenv('REANALYSIS_STALE_SECONDS', '600'))
+
+REANALYSIS_QUEUE_KEY = "reanalysis:queue"
+REANALYSIS_JOB_KEY = "reanalysis:job:{job_id}"
+REANALYSIS_JOB_TTL = 7 * 24 * 3600
+REANALYSIS_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+# Счётчик запросов текущей секунды (фиксированное окно)
+REANALYSIS_RATE_KEY = "reanalysis:rate:{second}"
+
+MIN_DIALOG_TEXT_LENGTH = 10
+MIN_ANALYSIS_LENGTH = 20
+
+logger = logging.getLogger(__name__)
+
+
+class DialogAnalysisService:
+    """
+    Класс-сервис для повторного анализа диалогов:
+    - Версия промпта анализа (хэш analysis_prompt шаблона), записываемая в Dialog.analysis_version
+    - Разбор структурированной оценки из ответа модели и её запись в диалог и статистику пользователя
+    - Очередь заданий повторного анализа с фильтрами по сценарию, организации и периоду
+    - Выполнение задания с ограниченной параллельностью и контрольными точками (jobs/reanalysis_worker.py)
+    """
+    @staticmethod
+    def prompt_version(analysis_prompt):
+        """
+        Возвращает версию промпта анализа.
+        :param analysis_prompt: строка или None — PromptTemplate.analysis_prompt
+        :return: строка
+        """
+        if not analysis_prompt:
+            return BUILTIN_ANALYSIS_VERSION
+        digest = hashlib.md5(analysis_prompt.encode('utf-8')).hexdigest()[:ANALYSIS_VERSION_LENGTH]
+        return f'{ANALYSIS_SCHEMA_VERSION}-{digest}'
+
+    @staticmethod
+    def _prompt_version_expr():
+        """SQL-выражение текущей версии промпта анализа диалога (совпадает с prompt_version)"""
+        return case(
+            (func.coalesce(PromptTemplate.analysis_prompt, '') == '', BUILTIN_ANALYSIS_VERSION),
+            else_=func.concat(f'{ANALYSIS_SCHEMA_VERSION}-',
+                              func.substr(func.md5(PromptTemplate.analysis_prompt), 1, ANALYSIS_VERSION_LENGTH))
+        )
+
+    @staticmethod
+    def _parse_score_value(value):
+        if isinstance(value, bool) or value is None:
+            return None
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return value if 0 <= value <= 100 else None
+
+    @staticmethod
+    def _find_scoring_block(text):
+        """
+        Находит JSON-блок оценки: последний блок ```json, иначе последний объект с полем score.
+        :return: (dict, начало, конец) или None
+        """
+        for match in reversed(list(SCORING_BLOCK_RE.finditer(text))):
+            try:
+                data = json.loads(match.group(1))
+            except ValueError:
+                continue
+            if isinstance(data, dict) and 'score' in data:
+                return data, match.start(), match.end()
+        decoder = json.JSONDecoder()
+        position = len(text)
+        for _ in range(20):
+            position = text.rfind('{', 0, position)
+            if position < 0:
+                break
+            try:
+                data, end = decoder.raw_decode(text, position)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and 'score' in data:
+                return data, position, end
+        return None
+
+    @staticmethod
+    def parse_scoring(text):
+        """
+        Извлекает из ответа модели блок оценки и проверяет его.
+        :param text: строка — ответ модели на промпт анализа
+        :return: (текст анализа без блока оценки, dict score/is_successful/criteria или None)
+        """
+        found = DialogAnalysisService._find_scoring_block(text or '')
+        if not found:
+            return text, None
+        data, start, end = found
+        score = DialogAnalysisService._parse_score_value(data.get('score'))
+        if score is None:
+            logger.warning("Некорректная оценка в ответе анализа: %.200r", data)
+            return text, None
+        is_successful = data.get('is_successful')
+        if not isinstance(is_successful, bool):
+            is_successful = score >= SUCCESS_SCORE_THRESHOLD
+        criteria = {}
+        if isinstance(data.get('criteria'), dict):
+            for name in SCORING_CRITERIA:
+                value = DialogAnalysisService._parse_score_value(data['criteria'].get(name))
+                if value is not None:
+                    criteria[name] = value
+        cleaned = (text[:start] + text[end:]).strip()
+        return cleaned or text, {'score': score, 'is_successful': is_successful, 'criteria': criteria}
+
+    @staticmethod
+    def apply_scoring(dialog, user_stats, scoring, update_streak=True):
+        """
+        Записывает оценку в диалог и инкрементально обновляет статистику пользователя (без коммита):
+        среднюю оценку, число успешных диалогов, уникальные успешные сценарии и серию успешных диалогов.
+        Повторная оценка уже оценённого диалога заменяет его вклад в среднее и не меняет серию.
+        :param dialog: объект Dialog
+        :param user_stats: объект UserStatistics или None
+        :param scoring: dict из parse_scoring
+        :param update_streak: bool — учитывать диалог в серии (только при завершении диалога: серия зависит от порядка)
+        """
+        previous_score, previous_success = dialog.score, bool(dialog.is_successful)
+        score, is_successful = scoring['score'], scoring['is_successful']
+        dialog.score = score
+        dialog.user_score = score
+        dialog.is_successful = is_successful
+        if user_stats is None:
+            return
+
+        scored = user_stats.scored_dialogs or 0
+        average = user_stats.average_score or 0.0
+        first_scoring = previous_score is None or scored == 0
+        if first_scoring:
+            scored += 1
+            average += (score - average) / scored
+            previous_success = False
+        else:
+            average += (score - previous_score) / scored
+        user_stats.scored_dialogs = scored
+        user_stats.average_score = round(average, 4)
+        user_stats.successful_dialogs = max(0, (user_stats.successful_dialogs or 0)
+                                            + int(is_successful) - int(previous_success))
+
+        if is_successful != previous_success:
+            # Сценарий уникален, если у пользователя нет другого успешного диалога по нему (частичный индекс)
+            other_success = db.session.scalar(select(
+                select(Dialog.id).where(Dialog.user_id == dialog.user_id,
+                                        Dialog.scenario_id == dialog.scenario_id,
+                                        Dialog.is_successful.is_(True),
+                                        Dialog.id != dialog.id).exists()
+            ))
+            if not other_success:
+                user_stats.unique_successful_scenarios = max(
+                    0, (user_stats.unique_successful_scenarios or 0) + (1 if is_successful else -1))
+
+        if first_scoring and update_streak:
+            if is_successful:
+                user_stats.current_streak = (user_stats.current_streak or 0) + 1
+                user_stats.best_streak = max(user_stats.best_streak or 0, user_stats.current_streak)
+            else:
+                user_stats.current_streak = 0
+
+    @staticmethod
+    def parse_filters(data):
+        """
+        Разбирает фильтры задания из тела запроса.
+        :param data: dict с полями scenario_id, organization_id, from, to, only_stale
+        :return: dict
+        :raises ValueError: при некорректных значениях
+        """
+        filters = {'only_stale': str(data.get('only_stale', 'true')).lower() in ('1', 'true')}
+        for name in ('scenario_id', 'organization_id'):
+            value = data.get(name)
+            if value not in (None, ''):
+                try:
+                    filters[name] = int(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Некорректный {name}")
+        for name, param in (('date_from', 'from'), ('date_to', 'to')):
+            value = data.get(param)
+            if value:
+                try:
+                    filters[name] = datetime.fromisoformat(value).isoformat()
+                except ValueError:
+                    raise ValueError(f"Некорректная дата в параметре {param}: ожидается ISO 8601")
+        return filters
+
+    @staticmethod
+    def _base_query(filters):
+        query = (
+            select(Dialog.id)
+            .join(Scenario, Scenario.id == Dialog.scenario_id)
+            .outerjoin(PromptTemplate, PromptTemplate.id == Scenario.prompt_template_id)
+            .where(Dialog.status == 'completed')
+        )
+        if filters.get('scenario_id'):
+            query = query.where(Dialog.scenario_id == filters['scenario_id'])
+        if filters.get('organization_id'):
+            query = query.join(Users, Users.id == Dialog.user_id).where(Users.organization_id == filters['organization_id'])
+        if filters.get('date_from'):
+            query = query.where(Dialog.completed_at >= datetime.fromisoformat(filters['date_from']))
+        if filters.get('date_to'):
+            query = query.where(Dialog.completed_at < datetime.fromisoformat(filters['date_to']))
+        if filters.get('only_stale'):
+            query = query.where(Dialog.analysis_version.is_distinct_from(DialogAnalysisService._prompt_version_expr()))
+        return query
+
+    @staticmethod
+    def count_dialogs(filters):
+        """
+        Считает диалоги, попадающие в задание.
+        :param filters: dict из parse_filters
+        :return: int
+        """
+        query = DialogAnalysisService._base_query(filters).with_only_columns(func.count(Dialog.id))
+        return db.session.execute(query).scalar()
+
+    @staticmethod
+    def enqueue_job(filters, requested_by):
+        """
+        Ставит задание повторного анализа в очередь.
+        :param filters: dict из parse_filters
+        :param requested_by: int — id администратора
+        :return: dict — состояние задания
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'scenario_id': filters.get('scenario_id') or '',
+            'organization_id': filters.get('organization_id') or '',
+            'date_from': filters.get('date_from') or '',
+            'date_to': filters.get('date_to') or '',
+            'only_stale': int(filters['only_stale']),
+            'total': DialogAnalysisService.count_dialogs(filters),
+            'processed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'skipped': 0,
+            'last_dialog_id': 0,
+            'requested_by': requested_by,
+            'status': 'queued',
+            'created_at': datetime.utcnow().isoformat(),
+        }
+        key = REANALYSIS_JOB_KEY.format(job_id=job_id)
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping=job)
+        pipe.expire(key, REANALYSIS_JOB_TTL)
+        pipe.rpush(REANALYSIS_QUEUE_KEY, job_id)
+        pipe.execute()
+        return {k: str(v) for k, v in job.items()}
+
+    @staticmethod
+    def get_job(job_id):
+        """
+        Возвращает состояние задания.
+        :param job_id: строка
+        :return: dict или None
+        """
+        if not REANALYSIS_JOB_ID_RE.match(job_id or ''):
+            return None
+        raw = redis_client.hgetall(REANALYSIS_JOB_KEY.format(job_id=job_id))
+        if not raw:
+            return None
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in raw.items()}
+
+    @staticmethod
+    def _is_stale(job):
+        heartbeat = job.get('heartbeat_at') or job.get('started_at')
+        if not heartbeat:
+            return True
+        return (datetime.utcnow() - datetime.fromisoformat(heartbeat)).total_seconds() > REANALYSIS_STALE_SECONDS
+
+    @staticmethod
+    def resume_job(job_id):
+        """
+        Возвращает прерванное, упавшее или отменённое задание в очередь; оно продолжится с контрольной точки.
+        :param job_id: строка
+        :return: dict — состояние задания или None, если задание не найдено
+        :raises ValueError: если задание завершено или ещё выполняется
+        """
+        job = DialogAnalysisService.get_job(job_id)
+        if not job:
+            return None
+        status = job.get('status')
+        if status in ('done', 'queued'):
+            raise ValueError(f"Задание в статусе {status} не требует продолжения")
+        if status == 'running' and not DialogAnalysisService._is_stale(job):
+            raise ValueError("Задание ещё выполняется")
+        key = REANALYSIS_JOB_KEY.format(job_id=job_id)
+        pipe = redis_client.pipeline()
+        pipe.hset(key, 'status', 'queued')
+        pipe.hdel(key, 'cancel_requested')
+        pipe.expire(key, REANALYSIS_JOB_TTL)
+        pipe.rpush(REANALYSIS_QUEUE_KEY, job_id)
+        pipe.execute()
+        job['status'] = 'queued'
+        return job
+
+    @staticmethod
+    def cancel_job(job_id):
+        """
+        Просит воркер остановить задание после текущей пачки.
+        :param job_id: строка
+        :return: dict — состояние задания или None, если задание не найдено
+        """
+        job = DialogAnalysisService.get_job(job_id)
+        if not job:
+            return None
+        if job.get('status') in ('queued', 'running'):
+            redis_client.hset(REANALYSIS_JOB_KEY.format(job_id=job_id), 'cancel_requested', 1)
+            job['cancel_requested'] = '1'
+        return job
+
+    @staticmethod
+    def _acquire_rate_slot():
+        """
+        Ждёт свободного слота в общем для всех воркеров лимите запросов в секунду.
+        При недоступном Redis лимит соблюдается только в пределах процесса (паузой между запросами).
+        """
+        while True:
+            now = time.time()
+            second = int(now)
+            try:
+                key = REANALYSIS_RATE_KEY.format(second=second)
+                pipe = redis_client.pipeline()
+                pipe.incr(key)
+                pipe.expire(key, 2)
+                count = pipe.execute()[0]
+            except Exception as e:
+                logger.warning("Лимит запросов повторного анализа недоступен: %s", e)
+                time.sleep(1.0 / REANALYSIS_RPS)
+                return
+            if count <= REANALYSIS_RPS:
+                return
+            time.sleep(second + 1 - now)
+
+    @staticmethod
+    def request_analysis(prompt, attempts=3):
+        """
+        Запрашивает анализ у GigaChat с учётом лимита частоты и паузами между попытками.
+        Вызывается из потоков пула, к базе данных не обращается.
+        :param prompt: строка — промпт анализа
+        :param attempts: int — число попыток
+        :return: строка анализа или None
+        """
+        for attempt in range(attempts):
+            DialogAnalysisService._acquire_rate_slot()
+            try:
+                response = gigachat_service.send({
+                    'model': 'GigaChat',
+                    'messages': [{'role': 'user', 'content': prompt}],
+                    'temperature': 0.3,
+                    'max_tokens': 800
+                }, retries=0)
+                if response and response.get('choices'):
+                    content = response['choices'][0]['message']['content'].strip()
+                    if len(content) > MIN_ANALYSIS_LENGTH:
+                        return content
+            except Exception as e:
+                logger.warning("Ошибка GigaChat при повторном анализе (попытка %d): %s", attempt + 1, e)
+            if attempt < attempts - 1:
+                time.sleep(2 ** attempt)
+        return None
+
+    @staticmethod
+    def run_job(job_id, pool=None):
+        """
+        Выполняет задание повторного анализа с контрольной точки: пачки диалогов по возрастанию id,
+        запросы пачки идут параллельно в пуле потоков, результаты пишутся и коммитятся в основном потоке.
+        :param job_id: строка
+        :param pool: ThreadPoolExecutor или None — пул запросов к GigaChat (по умолчанию создаётся на задание)
+        :return: dict — итоговое состояние задания или None, если задание не найдено
+        """
+        from routes.chat import build_analysis_prompt, build_dialog_text, filter_ai_response
+
+        job = DialogAnalysisService.get_job(job_id)
+        if not job:
+            return None
+        key = REANALYSIS_JOB_KEY.format(job_id=job_id)
+        filters = {
+            'scenario_id': int(job['scenario_id']) if job.get('scenario_id') else None,
+            'organization_id': int(job['organization_id']) if job.get('organization_id') else None,
+            'date_from': job.get('date_from') or None,
+            'date_to': job.get('date_to') or None,
+            'only_stale': job.get('only_stale') == '1',
+        }
+        counters = {name: int(job.get(name) or 0) for name in ('processed', 'succeeded', 'failed', 'skipped')}
+        last_id = int(job.get('last_dialog_id') or 0)
+        now = datetime.utcnow().isoformat()
+        redis_client.hset(key, mapping={'status': 'running', 'started_at': job.get('started_at') or now, 'heartbeat_at': now})
+
+        own_pool = pool is None
+        pool = pool or ThreadPoolExecutor(max_workers=REANALYSIS_CONCURRENCY)
+        status = 'done'
+        try:
+            while True:
+                if redis_client.hget(key, 'cancel_requested'):
+                    status = 'cancelled'
+                    break
+                ids = db.session.scalars(
+                    DialogAnalysisService._base_query(filters)
+                    .where(Dialog.id > last_id)
+                    .order_by(Dialog.id)
+                    .limit(REANALYSIS_BATCH_SIZE)
+                ).all()
+                if not ids:
+                    break
+                dialogs = db.session.scalars(
+                    select(Dialog).options(joinedload(Dialog.scenario).joinedload(Scenario.prompt_template_obj))
+                    .where(Dialog.id.in_(ids)).order_by(Dialog.id)
+                ).unique().all()
+
+                # Промпты собираются в основном потоке (нужна сессия), в пул уходят только HTTP-запросы;
+                # диалоги с анализом в кэше (по той же версии промпта) запроса не требуют
+                prepared = []
+                for dialog in dialogs:
+                    template = dialog.scenario.prompt_template_obj if dialog.scenario else None
+                    analysis_prompt = template.analysis_prompt if template else None
+                    dialog_text = build_dialog_text(DialogArchiveService.get_messages(dialog))
+                    if len(dialog_text) <= MIN_DIALOG_TEXT_LENGTH:
+                        counters['skipped'] += 1
+                        continue
+                    version = DialogAnalysisService.prompt_version(analysis_prompt)
+                    cache_key = AnalysisCacheService.make_key(version, dialog.scenario, dialog_text)
+                    prepared.append((dialog, version, cache_key, AnalysisCacheService.lookup(cache_key),
+                                     build_analysis_prompt(dialog.scenario, analysis_prompt, dialog_text)))
+
+                results = pool.map(DialogAnalysisService.request_analysis,
+                                   [prompt for _, _, _, cached, prompt in prepared if cached is None])
+                user_stats = {stats.user_id: stats for stats in db.session.scalars(
+                    select(UserStatistics).where(UserStatistics.user_id.in_({d.user_id for d, *_ in prepared})))}
+                analyzed_at = datetime.utcnow()
+                for dialog, version, cache_key, content, _ in prepared:
+                    cached = content is not None
+                    if not cached:
+                        content = next(results)
+                        if content is None:
+                            counters['failed'] += 1
+                            continue
+                    analysis, scoring = DialogAnalysisService.parse_scoring(content)
+                    # В кэш (общий с завершением диалога) попадают только ответы, прошедшие фильтр
+                    if not cached and filter_ai_response(analysis, dialog.scenario) != '__ROLE_BREAK__':
+                        AnalysisCacheService.store(cache_key, content)
+                    # Серии пересчитывает jobs/backfill_user_stats.py: переанализ идёт не в порядке завершения
+                    if scoring:
+                        DialogAnalysisService.apply_scoring(dialog, user_stats.get(dialog.user_id), scoring,
+                                                           update_streak=False)
+                    DialogArchiveService.replace_analysis(dialog, analysis)
+                    dialog.analysis_version = version
+                    dialog.analyzed_at = analyzed_at
+                    counters['succeeded'] += 1
+                db.session.commit()
+
+                # Контрольная точка: продолжение задания начнётся после последнего обработанного диалога
+                last_id = ids[-1]
+                counters['processed'] += len(ids)
+                redis_client.hset(key, mapping=dict(counters, last_dialog_id=last_id,
+                                                    heartbeat_at=datetime.utcnow().isoformat()))
+                db.session.expunge_all()
+        except BaseException as e:
+            db.session.rollback()
+            # Остановка воркера (Ctrl+C, SIGTERM) оставляет задание продолжаемым
+            status = 'interrupted' if isinstance(e, (KeyboardInterrupt, SystemExit)) else 'failed'
+            logger.error("Повторный анализ %s остановлен: %s", job_id, e, exc_info=status == 'failed')
+            redis_client.hset(key, mapping={'status': status, 'error': str(e)[:500],
+                                            'finished_at': datetime.utcnow().isoformat()})
+            if status == 'interrupted':
+                raise
+            job.update({'status': status, 'error': str(e)[:500]})
+            return job
+        finally:
+            if own_pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        update = {'status': status, 'finished_at': datetime.utcnow().isoformat()}
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping=update)
+        pipe.hdel(key, 'cancel_requested', 'error')
+        pipe.execute()
+        job.update(dict({k: str(v) for k, v in counters.items()}, last_dialog_id=str(last_id), **update))
+        return job
@@ -0,0 +1,286 @@
+# Сервис хранения сообщений завершённых диалогов вне горячей таблицы messages:
+# компактная стенограмма (Dialog.transcript), записываемая при завершении, и архив старых диалогов
+# в сжатом JSON (Dialog.messages). Оба формата прозрачно читаются при открытии диалога.
+# Стенограмма заменяет JSON-архив для новых диалогов: их строки уходят из messages уже при завершении,
+# поэтому архиватор и восстановление касаются только диалогов, завершённых до появления стенограмм.
+from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, null, select, text
+from models.models import Dialog, Message
+from models.database import db
+from utils.transcript_codec import StoredMessage, encode_transcript, decode_transcript
+import base64
+import json
+import logging
+import zlib
+
+# Формат сжатого архива в Dialog.messages
+ARCHIVE_FORMAT = 'zlib-json/1'
+# Сколько символов последнего сообщения хранится в превью (список диалогов не распаковывает архив)
+PREVIEW_LENGTH = 200
+
+logger = logging.getLogger(__name__)
+
+
+class DialogArchiveService:
+    """
+    Класс-сервис для холодного хранения сообщений диалогов:
+    - Компактная стенограмма завершённого диалога одним блобом
+    - Упаковка сообщений завершённых архивных диалогов в сжатый JSON
+    - Чтение сообщений из архива без восстановления строк
+    - Восстановление строк в messages при разархивации диалога
+    """
+    @staticmethod
+    def pack_messages(messages):
+        """
+        Упаковывает сообщения в сжатый архив.
+        :param messages: список объектов Message (в хронологическом порядке)
+        :return: dict для колонки Dialog.messages
+        """
+        rows = [[m.id, m.sender, m.text, m.timestamp.isoformat() if m.timestamp else None] for m in messages]
+        raw = json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        last = messages[-1] if messages else None
+        return {
+            'format': ARCHIVE_FORMAT,
+            'count': len(rows),
+            'last': {
+                'sender': last.sender,
+                'text': last.text[:PREVIEW_LENGTH],
+                'timestamp': last.timestamp.isoformat() if last.timestamp else None
+            } if last else None,
+            'data': base64.b64encode(zlib.compress(raw, 6)).decode('ascii')
+        }
+
+    @staticmethod
+    def is_archived_payload(payload):
+        """
+        Проверяет, что в Dialog.messages лежит архив сообщений.
+        :param payload: значение колонки Dialog.messages
+        :return: bool
+        """
+        return isinstance(payload, dict) and payload.get('format') == ARCHIVE_FORMAT
+
+    @staticmethod
+    def unpack_messages(payload):
+        """
+        Распаковывает архив сообщений.
+        :param payload: dict из Dialog.messages
+        :return: список StoredMessage
+        """
+        rows = json.loads(zlib.decompress(base64.b64decode(payload['data'])))
+        return [StoredMessage(message_id, sender, text, datetime.fromisoformat(timestamp) if timestamp else None)
+                for message_id, sender, text, timestamp in rows]
+
+    @staticmethod
+    def get_messages(dialog):
+        """
+        Возвращает сообщения диалога в хронологическом порядке: из стенограммы или архива, если они есть,
+        иначе из таблицы messages.
+        :param dialog: объект Dialog
+        :return: список StoredMessage
+        """
+        if dialog.transcript:
+            return decode_transcript(dialog.transcript)
+        if DialogArchiveService.is_archived_payload(dialog.messages):
+            return DialogArchiveService.unpack_messages(dialog.messages)
+        messages = Message.query.filter_by(dialog_id=dialog.id).order_by(Message.timestamp).all()
+        return [StoredMessage(m.id, m.sender, m.text, m.timestamp) for m in messages]
+
+    @staticmethod
+    def get_last_message_preview(dialog):
+        """
+        Возвращает превью последнего сообщения диалога из стенограммы или архива (архив не распаковывается).
+        :param dialog: объект Dialog
+        :return: dict или None, если сообщения диалога в таблице messages или их нет
+        """
+        if dialog.transcript:
+            messages = decode_transcript(dialog.transcript)
+            if not messages:
+                return None
+            last = messages[-1]
+            return {'sender': last.sender, 'text': last.text, 'timestamp': last.timestamp}
+        if not DialogArchiveService.is_archived_payload(dialog.messages):
+            return None
+        last = dialog.messages.get('last')
+        if not last:
+            return None
+        # Время возвращаем datetime, чтобы формат в ответе совпадал с превью из таблицы messages
+        return dict(last, timestamp=datetime.fromisoformat(last['timestamp']) if last.get('timestamp') else None)
+
+    @staticmethod
+    def replace_analysis(dialog, analysis):
+        """
+        Заменяет текст анализа (последнее системное сообщение) там, где хранятся сообщения диалога, без коммита.
+        Если системного сообщения нет, анализ добавляется последним сообщением.
+        :param dialog: объект Dialog
+        :param analysis: строка — новый текст анализа
+        """
+        now = datetime.utcnow()
+        if not dialog.transcript and not DialogArchiveService.is_archived_payload(dialog.messages):
+            message = Message.query.filter_by(dialog_id=dialog.id, sender='system').order_by(
+                Message.timestamp.desc(), Message.id.desc()).first()
+            if message:
+                message.text = analysis
+            else:
+                db.session.add(Message(dialog_id=dialog.id, sender='system', text=analysis, timestamp=now))
+            return
+
+        messages = DialogArchiveService.get_messages(dialog)
+        for index in range(len(messages) - 1, -1, -1):
+            if messages[index].sender == 'system':
+                messages[index] = messages[index]._replace(text=analysis)
+                break
+        else:
+            # id берётся из последовательности messages, чтобы сообщение можно было восстановить в таблицу
+            message_id = db.session.execute(text("SELECT nextval(pg_get_serial_sequence('messages', 'id'))")).scalar()
+            messages.append(StoredMessage(message_id, 'system', analysis, now))
+        if dialog.transcript:
+            dialog.transcript = encode_transcript(messages)
+        else:
+            dialog.messages = DialogArchiveService.pack_messages(messages)
+
+    @staticmethod
+    def compact_transcript(dialog):
+        """
+        Записывает стенограмму завершённого диалога и удаляет его строки из messages (без коммита).
+        Выполняется в точке сохранения: при ошибке строки остаются на месте.
+        :param dialog: объект Dialog
+        :return: int — количество сообщений в стенограмме
+        """
+        if dialog.transcript:
+            return 0
+        with db.session.begin_nested():
+            messages = Message.query.filter_by(dialog_id=dialog.id).order_by(Message.timestamp, Message.id).all()
+            if not messages:
+                return 0
+            dialog.transcript = encode_transcript(messages)
+            db.session.execute(delete(Message).where(Message.dialog_id == dialog.id))
+        return len(messages)
+
+    @staticmethod
+    def compact_completed_dialogs(batch_size=500, max_batches=None):
+        """
+        Переводит завершённые диалоги без стенограммы в компактный формат пачками (каждая пачка — своя транзакция).
+        :param batch_size: int — диалогов в пачке
+        :param max_batches: int или None — ограничение на число пачек за запуск
+        :return: dict с количеством диалогов и сообщений
+        """
+        totals = {'dialogs': 0, 'messages': 0}
+        batches = 0
+        last_id = 0
+        while max_batches is None or batches < max_batches:
+            dialogs = db.session.scalars(
+                select(Dialog)
+                .where(Dialog.status == 'completed',
+                       Dialog.transcript.is_(None),
+                       Dialog.messages.is_(None),
+                       Dialog.id > last_id)
+                .order_by(Dialog.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not dialogs:
+                break
+            last_id = dialogs[-1].id
+            dialog_ids = [dialog.id for dialog in dialogs]
+            by_dialog = {}
+            for message in db.session.scalars(
+                select(Message).where(Message.dialog_id.in_(dialog_ids)).order_by(Message.timestamp, Message.id)
+            ):
+                by_dialog.setdefault(message.dialog_id, []).append(message)
+            for dialog in dialogs:
+                if dialog.id in by_dialog:
+                    dialog.transcript = encode_transcript(by_dialog[dialog.id])
+            db.session.execute(delete(Message).where(Message.dialog_id.in_(list(by_dialog))))
+            db.session.commit()
+            totals['dialogs'] += len(by_dialog)
+            totals['messages'] += sum(len(messages) for messages in by_dialog.values())
+            batches += 1
+            logger.info("Стенограммы записаны для диалогов: %d, сообщений: %d", totals['dialogs'], totals['messages'])
+        return totals
+
+    @staticmethod
+    def archive_dialog(dialog):
+        """
+        Переносит сообщения диалога в архив (без коммита).
+        :param dialog: объект Dialog
+        :return: int — количество перенесённых сообщений
+        """
+        if dialog.transcript or DialogArchiveService.is_archived_payload(dialog.messages):
+            return 0
+        messages = Message.query.filter_by(dialog_id=dialog.id).order_by(Message.timestamp, Message.id).all()
+        if not messages:
+            return 0
+        dialog.messages = DialogArchiveService.pack_messages(messages)
+        db.session.execute(delete(Message).where(Message.dialog_id == dialog.id))
+        return len(messages)
+
+    @staticmethod
+    def restore_dialog(dialog):
+        """
+        Возвращает сообщения из архива в таблицу messages с исходными id и временем (без коммита).
+        Диалоги со стенограммой не восстанавливаются: они читаются из стенограммы и в архиве не бывают.
+        :param dialog: объект Dialog
+        :return: int — количество восстановленных сообщений
+        """
+        if not DialogArchiveService.is_archived_payload(dialog.messages):
+            return 0
+        rows = DialogArchiveService.unpack_messages(dialog.messages)
+        if rows:
+            db.session.execute(insert(Message), [dict(row._asdict(), dialog_id=dialog.id) for row in rows])
+        # SQL NULL, а не JSON null: по нему архиватор отбирает ещё не упакованные диалоги
+        dialog.messages = null()
+        return len(rows)
+
+    @staticmethod
+    def archive_old_dialogs(older_than_days, batch_size=200, max_batches=None):
+        """
+        Архивирует завершённые архивные диалоги старше older_than_days пачками (каждая пачка — своя транзакция).
+        Диалоги со стенограммой уже хранятся компактно и не трогаются: стенограмма заменяет JSON-архив,
+        и с её появлением (compact_transcript при завершении) сюда попадают только старые диалоги,
+        ещё не переведённые jobs/compact_transcripts.py.
+        Несколько запущенных архиваторов не мешают друг другу: строки берутся с SKIP LOCKED.
+        :param older_than_days: int — возраст диалога по completed_at, дней
+        :param batch_size: int — диалогов в пачке
+        :param max_batches: int или None — ограничение на число пачек за запуск
+        :return: dict с количеством диалогов и сообщений
+        """
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        totals = {'dialogs': 0, 'messages': 0}
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            dialogs = db.session.scalars(
+                select(Dialog)
+                .where(Dialog.status == 'completed',
+                       Dialog.is_archived.is_(True),
+                       Dialog.completed_at < cutoff,
+                       Dialog.messages.is_(None),
+                       Dialog.transcript.is_(None))
+                .order_by(Dialog.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not dialogs:
+                break
+            try:
+                # Сообщения всей пачки читаются и удаляются одним запросом
+                dialog_ids = [dialog.id for dialog in dialogs]
+                by_dialog = {}
+                for message in db.session.scalars(
+                    select(Message).where(Message.dialog_id.in_(dialog_ids)).order_by(Message.timestamp, Message.id)
+                ):
+                    by_dialog.setdefault(message.dialog_id, []).append(message)
+                # Диалоги без сообщений получают пустой архив, чтобы не выбирать их повторно
+                for dialog in dialogs:
+                    dialog.messages = DialogArchiveService.pack_messages(by_dialog.get(dialog.id, []))
+                db.session.execute(delete(Message).where(Message.dialog_id.in_(dialog_ids)))
+                db.session.commit()
+                moved = sum(len(messages) for messages in by_dialog.values())
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Ошибка при архивации пачки диалогов: %s", e)
+                raise
+            totals['dialogs'] += len(dialogs)
+            totals['messages'] += moved
+            batches += 1
+            logger.info("Архивировано диалогов: %d, сообщений: %d", totals['dialogs'], totals['messages'])
+        return totals
@@ -0,0 +1,316 @@
+# Сервис выгрузки диалогов организации: потоковые NDJSON/CSV и фоновая выгрузка в Parquet.
+# Строки читаются серверным курсором (yield_per) пачками, поэтому память не зависит от объёма выгрузки.
+from datetime import datetime
+from sqlalchemy import select
+from models.models import Dialog, Message, Users, Scenario
+from models.database import db
+from services.dialog_archive_service import DialogArchiveService
+from utils.redis_client import redis_client
+from utils.transcript_codec import decode_transcript
+from utils.json_provider import dumps_bytes
+import csv
+import io
+import logging
+import os
+import re
+import time
+import uuid
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow нужен только воркеру фоновых выгрузок
+    pyarrow = None
+
+# Строк в пачке серверного курсора
+EXPORT_CHUNK_SIZE = 1000
+# Потоковая выгрузка ограничена по числу диалогов, чтобы уложиться в таймаут воркера gunicorn;
+# большие организации выгружаются фоновым заданием в Parquet
+EXPORT_STREAM_MAX_ROWS = int(os.getenv('EXPORT_STREAM_MAX_ROWS', '100000'))
+# Каталог готовых файлов фоновых выгрузок (общий для API и воркера)
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'exports'))
+# Очередь и состояние фоновых выгрузок
+EXPORT_QUEUE_KEY = "export:queue"
+EXPORT_JOB_KEY = "export:job:{job_id}"
+EXPORT_JOB_TTL = 7 * 24 * 3600
+EXPORT_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+EXPORT_FIELDS = [
+    'dialog_id', 'user_id', 'username', 'email', 'scenario_id', 'scenario_name', 'status',
+    'started_at', 'completed_at', 'duration', 'total_messages', 'score', 'user_score',
+    'is_successful', 'ai_feedback', 'analysis'
+]
+
+logger = logging.getLogger(__name__)
+
+
+class DialogExportService:
+    """
+    Класс-сервис для выгрузки диалогов организации:
+    - Чтение диалогов серверным курсором с догрузкой анализа пачками
+    - Потоковые NDJSON и CSV
+    - Очередь фоновых выгрузок в Parquet (jobs/export_worker.py)
+    """
+    @staticmethod
+    def parse_filters(args):
+        """
+        Разбирает фильтры выгрузки из параметров запроса.
+        :param args: MultiDict параметров запроса или dict тела запроса
+        :return: dict date_from, date_to, include_messages
+        :raises ValueError: при некорректной дате
+        """
+        filters = {'date_from': None, 'date_to': None,
+                   'include_messages': str(args.get('include_messages', 'false')).lower() in ('1', 'true')}
+        for name, param in (('date_from', 'from'), ('date_to', 'to')):
+            value = args.get(param)
+            if value:
+                try:
+                    filters[name] = datetime.fromisoformat(value)
+                except ValueError:
+                    raise ValueError(f"Некорректная дата в параметре {param}: ожидается ISO 8601")
+        return filters
+
+    @staticmethod
+    def _base_query(org_id, date_from=None, date_to=None):
+        query = (
+            select(Dialog, Users.username, Users.email, Scenario.name)
+            .join(Users, Users.id == Dialog.user_id)
+            .join(Scenario, Scenario.id == Dialog.scenario_id)
+            .where(Users.organization_id == org_id)
+        )
+        if date_from:
+            query = query.where(Dialog.started_at >= date_from)
+        if date_to:
+            query = query.where(Dialog.started_at < date_to)
+        return query
+
+    @staticmethod
+    def count_dialogs(org_id, date_from=None, date_to=None, **_):
+        """
+        Считает диалоги, попадающие в выгрузку.
+        :return: int
+        """
+        query = DialogExportService._base_query(org_id, date_from, date_to).with_only_columns(db.func.count(Dialog.id))
+        return db.session.execute(query).scalar()
+
+    @staticmethod
+    def _load_live_messages(dialogs):
+        """
+        Догружает сообщения диалогов, у которых нет стенограммы и архива, одним запросом на пачку.
+        :return: dict dialog_id -> список Message
+        """
+        ids = [d.id for d in dialogs if not d.transcript and not isinstance(d.messages, dict)]
+        by_dialog = {}
+        if ids:
+            for message in db.session.scalars(
+                select(Message).where(Message.dialog_id.in_(ids)).order_by(Message.timestamp, Message.id)
+            ):
+                by_dialog.setdefault(message.dialog_id, []).append(message)
+        return by_dialog
+
+    @staticmethod
+    def iter_rows(org_id, date_from=None, date_to=None, include_messages=False):
+        """
+        Генератор строк выгрузки (словарей) в порядке id диалога.
+        :param org_id: int — организация
+        :param date_from: datetime или None — начало периода по started_at
+        :param date_to: datetime или None — конец периода (не включительно)
+        :param include_messages: bool — добавить полную стенограмму в поле messages
+        """
+        query = DialogExportService._base_query(org_id, date_from, date_to).order_by(Dialog.id)
+        result = db.session.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        for partition in result.partitions():
+            dialogs = [row[0] for row in partition]
+            live = DialogExportService._load_live_messages(dialogs)
+            for dialog, username, email, scenario_name in partition:
+                if dialog.id in live:
+                    messages = live[dialog.id]
+                elif dialog.transcript:
+                    messages = decode_transcript(dialog.transcript)
+                elif DialogArchiveService.is_archived_payload(dialog.messages):
+                    messages = DialogArchiveService.unpack_messages(dialog.messages)
+                else:
+                    messages = []
+                # Анализ ИИ хранится последним системным сообщением диалога
+                analysis = next((m.text for m in reversed(messages) if m.sender == 'system'), None)
+                row = {
+                    'dialog_id': dialog.id,
+                    'user_id': dialog.user_id,
+                    'username': username,
+                    'email': email,
+                    'scenario_id': dialog.scenario_id,
+                    'scenario_name': scenario_name,
+                    'status': dialog.status,
+                    'started_at': dialog.started_at,
+                    'completed_at': dialog.completed_at,
+                    'duration': dialog.duration,
+                    'total_messages': len(messages) or dialog.total_messages,
+                    'score': dialog.score,
+                    'user_score': dialog.user_score,
+                    'is_successful': dialog.is_successful,
+                    'ai_feedback': dialog.ai_feedback,
+                    'analysis': analysis,
+                }
+                if include_messages:
+                    row['messages'] = [{'sender': m.sender, 'text': m.text, 'timestamp': m.timestamp} for m in messages]
+                yield row
+            # Объекты пачки больше не нужны: не даём identity map расти вместе с выгрузкой
+            db.session.expunge_all()
+
+    @staticmethod
+    def stream_ndjson(rows, buffer_size=64 * 1024):
+        """
+        Сериализует строки в NDJSON кусками примерно по buffer_size байт.
+        :param rows: итератор словарей
+        """
+        buffer = bytearray()
+        for row in rows:
+            buffer += dumps_bytes(row)
+            buffer += b'\n'
+            if len(buffer) >= buffer_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+    @staticmethod
+    def stream_csv(rows, buffer_size=64 * 1024):
+        """
+        Сериализует строки в CSV (с BOM для Excel) кусками примерно по buffer_size байт.
+        Стенограмма в CSV не выгружается.
+        :param rows: итератор словарей
+        """
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        out.write('\ufeff')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: value.isoformat() if isinstance(value, datetime) else value for key, value in row.items()})
+            if out.tell() >= buffer_size:
+                yield out.getvalue().encode('utf-8')
+                out.seek(0)
+                out.truncate()
+        if out.tell():
+            yield out.getvalue().encode('utf-8')
+
+    @staticmethod
+    def write_parquet(path, rows, row_group_size=10000):
+        """
+        Записывает строки в Parquet группами строк, не держа всю выгрузку в памяти.
+        :param path: строка — путь к файлу
+        :param rows: итератор словарей
+        :return: int — количество строк
+        """
+        if pyarrow is None:
+            raise RuntimeError("Для выгрузки в Parquet нужен пакет pyarrow")
+        fields = [
+            ('dialog_id', pyarrow.int64()), ('user_id', pyarrow.int64()), ('username', pyarrow.string()),
+            ('email', pyarrow.string()), ('scenario_id', pyarrow.int64()), ('scenario_name', pyarrow.string()),
+            ('status', pyarrow.string()), ('started_at', pyarrow.timestamp('us')),
+            ('completed_at', pyarrow.timestamp('us')), ('duration', pyarrow.int64()),
+            ('total_messages', pyarrow.int64()), ('score', pyarrow.float64()), ('user_score', pyarrow.float64()),
+            ('is_successful', pyarrow.bool_()), ('ai_feedback', pyarrow.string()), ('analysis', pyarrow.string()),
+        ]
+        schema = pyarrow.schema(fields)
+        total = 0
+        batch = []
+        with pyarrow.parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= row_group_size:
+                    writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                    total += len(batch)
+                    batch = []
+            if batch:
+                writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                total += len(batch)
+        return total
+
+    @staticmethod
+    def enqueue_export(org_id, filters, requested_by):
+        """
+        Ставит фоновую выгрузку в Parquet в очередь.
+        :param org_id: int
+        :param filters: dict из parse_filters
+        :param requested_by: int — id администратора
+        :return: строка — id задания
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'org_id': org_id,
+            'date_from': filters['date_from'].isoformat() if filters.get('date_from') else '',
+            'date_to': filters['date_to'].isoformat() if filters.get('date_to') else '',
+            'requested_by': requested_by,
+            'status': 'queued',
+            'created_at': datetime.utcnow().isoformat(),
+        }
+        key = EXPORT_JOB_KEY.format(job_id=job_id)
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping=job)
+        pipe.expire(key, EXPORT_JOB_TTL)
+        pipe.rpush(EXPORT_QUEUE_KEY, job_id)
+        pipe.execute()
+        return job_id
+
+    @staticmethod
+    def get_job(job_id):
+        """
+        Возвращает состояние фоновой выгрузки.
+        :param job_id: строка
+        :return: dict или None
+        """
+        if not EXPORT_JOB_ID_RE.match(job_id or ''):
+            return None
+        raw = redis_client.hgetall(EXPORT_JOB_KEY.format(job_id=job_id))
+        if not raw:
+            return None
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in raw.items()}
+
+    @staticmethod
+    def get_job_file(job_id):
+        """
+        Возвращает путь к готовому файлу выгрузки или None.
+        :param job_id: строка
+        :return: строка или None
+        """
+        job = DialogExportService.get_job(job_id)
+        if not job or job.get('status') != 'done':
+            return None
+        path = os.path.join(EXPORT_DIR, f"{job_id}.parquet")
+        return path if os.path.isfile(path) else None
+
+    @staticmethod
+    def run_job(job_id):
+        """
+        Выполняет фоновую выгрузку: пишет Parquet во временный файл и переименовывает по готовности.
+        :param job_id: строка
+        :return: dict — итоговое состояние задания
+        """
+        job = DialogExportService.get_job(job_id)
+        if not job:
+            return None
+        key = EXPORT_JOB_KEY.format(job_id=job_id)
+        redis_client.hset(key, mapping={'status': 'running', 'started_at': datetime.utcnow().isoformat()})
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        path = os.path.join(EXPORT_DIR, f"{job_id}.parquet")
+        started = time.perf_counter()
+        try:
+            rows = DialogExportService.iter_rows(
+                int(job['org_id']),
+                datetime.fromisoformat(job['date_from']) if job.get('date_from') else None,
+                datetime.fromisoformat(job['date_to']) if job.get('date_to') else None,
+            )
+            total = DialogExportService.write_parquet(path + '.tmp', rows)
+            os.replace(path + '.tmp', path)
+            update = {'status': 'done', 'rows': total, 'seconds': round(time.perf_counter() - started, 1),
+                      'finished_at': datetime.utcnow().isoformat()}
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Ошибка фоновой выгрузки %s: %s", job_id, e, exc_info=True)
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            update = {'status': 'failed', 'error': str(e)[:500], 'finished_at': datetime.utcnow().isoformat()}
+        redis_client.hset(key, mapping=update)
+        job.update({k: str(v) for k, v in update.items()})
+        return job
@@ -6,6 +6,8 @@ import base64
 import uuid  # ← ДОБАВИТЬ
 from datetime import datetime, timedelta
 from flask import current_app
+from utils.metrics import llm_phase, count_llm_event
+from utils.tracing import start_span, current_span
 
 class GigaChatService:
     """
@@ -30,8 +32,8 @@ class GigaChatService:
             return self.token
             
         try:
-            # ⚠️ ПРАВИЛЬНЫЙ URL АВТОРИЗАЦИИ
-            auth_url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+            # ⚠️ ПРАВИЛЬНЫЙ URL АВТОРИЗАЦИИ (переопределяется для нагрузочных тестов с заглушкой)
+            auth_url = os.getenv('GIGACHAT_AUTH_URL', "https://ngw.devices.sberbank.ru:9443/api/v2/oauth")
             
             # Получаем учетные данные из переменных окружения
             client_id = os.getenv('GIGACHAT_CLIENT_ID')
@@ -59,30 +61,31 @@ class GigaChatService:
                 'scope': scope  # GIGACHAT_API_PERS, GIGACHAT_API_CORP или GIGACHAT_API_B2B
             }
             
-            self.logger.info(f"Запрос токена GigaChat, RqUID: {rquid}")
+            self.logger.info("Запрос токена GigaChat, RqUID: %s", rquid)
             
             # Отправляем запрос на получение токена
-            response = requests.post(
-                auth_url,
-                headers=headers,
-                data=data,
-                verify=False,
-                timeout=10
-            )
+            with llm_phase('auth'), start_span('gigachat.auth', 'client', 'upstream', {'gigachat.rquid': rquid}) as span:
+                response = requests.post(
+                    auth_url,
+                    headers=headers,
+                    data=data,
+                    verify=False,
+                    timeout=10
+                )
+                span.set_attribute('http.status_code', response.status_code)
             
             # Логируем ответ для отладки
-            self.logger.info(f"Статус ответа: {response.status_code}")
+            self.logger.debug("Статус ответа: %s", response.status_code)
             
             if response.status_code != 200:
-                self.logger.error(f"Ошибка авторизации: {response.status_code}")
-                self.logger.error(f"Тело ответа: {response.text[:200]}")
+                self.logger.error("Ошибка авторизации: %s, тело ответа: %.200s", response.status_code, response.text)
                 raise Exception(f"Auth failed: {response.status_code}")
             
             response.raise_for_status()
             token_data = response.json()
             
             if 'access_token' not in token_data:
-                self.logger.error(f"Нет access_token в ответе: {token_data}")
+                self.logger.error("Нет access_token в ответе, поля: %s", list(token_data))
                 raise ValueError("Не удалось получить токен доступа из ответа API")
             
             # Сохраняем токен и время его истечения
@@ -90,18 +93,19 @@ class GigaChatService:
             expires_in = token_data.get('expires_in', 1800)
             self.token_expires = datetime.utcnow() + timedelta(seconds=expires_in - 300)
             
-            self.logger.info(f"Токен получен, действует {expires_in} секунд")
+            self.logger.info("Токен получен, действует %s секунд", expires_in)
             return self.token
             
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка сети при получении токена: {str(e)}")
+            self.logger.error("Ошибка сети при получении токена: %s", e)
             if hasattr(e, 'response') and e.response is not None:
-                self.logger.error(f"Статус: {e.response.status_code}, Ответ: {e.response.text[:500]}")
+                self.logger.error("Статус: %s, Ответ: %.500s", e.response.status_code, e.response.text)
             raise Exception(f"Ошибка аутентификации: {str(e)}")
         except Exception as e:
-            self.logger.error(f"Ошибка при получении токена: {str(e)}", exc_info=True)
+            self.logger.error("Ошибка при получении токена: %s", e, exc_info=True)
             raise Exception(f"Ошибка при получении токена: {str(e)}")
 
+    @start_span('gigachat.send', 'client')
     def send(self, params, retries=3):
         """
         Отправка сообщения в GigaChat API.
@@ -114,8 +118,8 @@ class GigaChatService:
             # Получаем токен доступа
             token = self._get_auth_token()
             
-            # ⚠️ ПРАВИЛЬНЫЙ URL API
-            api_url = "https://gigachat.devices.sberbank.ru/api/v1"
+            # ⚠️ ПРАВИЛЬНЫЙ URL API (переопределяется для нагрузочных тестов с заглушкой)
+            api_url = os.getenv('GIGACHAT_API_URL', "https://gigachat.devices.sberbank.ru/api/v1")
             url = f"{api_url}/chat/completions"
             
             # Параметры запроса
@@ -144,59 +148,70 @@ class GigaChatService:
                 'presence_penalty': float(params.get('presence_penalty', 0.1))
             }
             
-            self.logger.info(f"Отправка запроса в GigaChat, модель: {model}, RqUID: {rquid}")
+            self.logger.info("Отправка запроса в GigaChat, модель: %s, RqUID: %s", model, rquid, extra={'sampled': True})
+            attempt = current_span()
+            attempt.set_attribute('gigachat.model', model)
+            attempt.set_attribute('gigachat.rquid', rquid)
+            attempt.set_attribute('gigachat.retries_left', retries)
             
-            response = requests.post(
-                url, 
-                headers=headers, 
-                json=data, 
-                verify=False,
-                timeout=30
-            )
+            with llm_phase('network'), start_span('gigachat.request', 'client', 'upstream', {'gigachat.rquid': rquid}) as span:
+                response = requests.post(
+                    url, 
+                    headers=headers, 
+                    json=data, 
+                    verify=False,
+                    timeout=30
+                )
+                span.set_attribute('http.status_code', response.status_code)
             
-            self.logger.info(f"Статус ответа чата: {response.status_code}")
+            self.logger.debug("Статус ответа чата: %s", response.status_code)
             
             if response.status_code == 401:  # Не авторизован
                 self.logger.warning("Токен недействителен, сбрасываю...")
                 self.token = None
+                count_llm_event('token_reset')
                 if retries > 0:
-                    time.sleep(1)
+                    count_llm_event('retry')
+                    with start_span('gigachat.retry_sleep', category='sleep', attributes={'sleep.seconds': 1}):
+                        time.sleep(1)
                     return self.send(params, retries=retries-1)
             
             if response.status_code != 200:
-                self.logger.error(f"Ошибка API: {response.status_code}")
-                self.logger.error(f"Тело ответа: {response.text[:200]}")
+                self.logger.error("Ошибка API: %s, тело ответа: %.200s", response.status_code, response.text)
                 response.raise_for_status()
             
             response.raise_for_status()
             result = response.json()
             
             if 'choices' not in result:
-                self.logger.error(f"Некорректный ответ: {result}")
+                self.logger.error("Некорректный ответ: %.500r", result)
                 raise ValueError("Некорректный формат ответа")
             
-            self.logger.info(f"Успешный ответ, выборок: {len(result.get('choices', []))}")
+            self.logger.info("Успешный ответ, выборок: %d", len(result.get('choices', [])), extra={'sampled': True})
             return result
             
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка запроса к GigaChat: {str(e)}")
+            self.logger.error("Ошибка запроса к GigaChat: %s", e)
             
             if retries > 0:
-                self.logger.info(f"Повторная попытка... ({retries-1} осталось)")
-                time.sleep(2)
+                self.logger.info("Повторная попытка... (%d осталось)", retries - 1)
+                count_llm_event('retry')
+                with start_span('gigachat.retry_sleep', category='sleep', attributes={'sleep.seconds': 2}):
+                    time.sleep(2)
                 return self.send(params, retries=retries-1)
             
             if hasattr(e, 'response') and e.response is not None:
-                self.logger.error(f"Статус: {e.response.status_code}")
+                self.logger.error("Статус: %s", e.response.status_code)
                 try:
-                    self.logger.error(f"Тело: {e.response.text[:500]}")
+                    self.logger.error("Тело: %.500s", e.response.text)
                 except:
                     pass
             
+            count_llm_event('error')
             raise Exception(f"Ошибка GigaChat API: {str(e)}")
             
         except Exception as e:
-            self.logger.error(f"Неожиданная ошибка: {str(e)}", exc_info=True)
+            self.logger.error("Неожиданная ошибка: %s", e, exc_info=True)
             raise Exception(f"Ошибка обработки: {str(e)}")
 
 # Создаем глобальный экземпляр сервиса
@@ -0,0 +1,307 @@
+# Сервис фильтра ответов ИИ: глобальные признаки выхода из роли и запрещённые слова организации,
+# шаблона промпта и сценария компилируются в одно регулярное выражение с границами слов
+# и окончаниями русских словоформ. Скомпилированный фильтр кэшируется в процессе по версии списков,
+# сама версия — на FILTER_VERSION_TTL секунд, поэтому проверка ответа обычно обходится без Redis.
+from collections import OrderedDict
+from models.models import Organization, PromptTemplate
+from models.database import db
+from utils.redis_client import redis_client
+import logging
+import os
+import re
+import threading
+import time
+
+# Признаки самораскрытия ИИ и форматирования
+FORBIDDEN_KEYWORDS = [
+    # Существенно сокращено: оставляем только признаки самораскрытия ИИ и форматирование
+    'чат-бот', 'бот', 'искусственный интеллект',
+    'markdown', 'я ассистент', 'я бот', 'я искусственный интеллект', 'нейросеть'
+]
+
+# Фразы, которые указывают на выход из роли (переход к роли помощника)
+ROLE_BREAK_PHRASES = [
+    "я здесь, чтобы поддерживать уважительное и конструктивное общение",
+    "давайте обсудим",
+    "я всегда готов к уважительному диалогу",
+    "если вас что-то беспокоит или раздражает, давайте обсудим это без оскорблений",
+    "чем могу помочь",
+    "я всегда готов помочь",
+    "давайте обсудим спокойно",
+    "я здесь, чтобы помочь",
+    "я всегда готов к диалогу",
+    "извиняюсь", "извините", "помогу", "помочь", "решим", "решение проблемы",
+    # Ниже сохранены сервисные фразы персонала; их наличие значит выход из роли клиента
+    "скидка", "заменим", "компенсация", "предлагаю", "предложить",
+    "мы всё исправим", "как вам будет удобнее",
+    "мы вам заменим", "мы вам почистим", "мы вам компенсируем", "мы вам организуем",
+    "я сейчас всё поменяю", "я сейчас всё решу", "я сейчас всё исправлю", "я сейчас всё организую", "я сейчас всё улажу",
+    "давайте решим вопрос", "давайте решим ситуацию", "давайте решим проблему", "давайте уладим ситуацию",
+    "организуем замену", "организуем чистку", "организуем возврат", "организуем компенсацию", "организуем решение",
+    "приношу извинения", "приносим извинения", "приношу свои извинения", "приносим свои извинения",
+    "всё за наш счёт", "всё за мой счёт", "мы всё оплатим", "мы всё компенсируем", "мы всё уладим", "мы всё решим",
+    "могу вызвать курьера", "могу организовать курьера", "могу организовать замену", "могу организовать чистку",
+    "могу организовать возврат", "могу организовать компенсацию",
+]
+
+# Фразы, которыми ИИ выдаёт себя за роль пользователя ({role} — первое слово роли пользователя)
+WRONG_ROLE_PATTERNS = ['я {role}', 'я как {role}', 'в качестве {role}']
+WRONG_ROLE = 'wrong_role'
+
+# Счётчик версии списков запрещённых слов организаций и шаблонов: увеличивается при их изменении
+FILTER_VERSION_KEY = "response_filter:version"
+# Сколько секунд процесс использует прочитанную версию, не обращаясь к Redis
+FILTER_VERSION_TTL = float(os.getenv('RESPONSE_FILTER_VERSION_TTL', '5'))
+# Сколько скомпилированных фильтров хранится в процессе
+MATCHER_CACHE_SIZE = 512
+
+# Окончания русских словоформ: слово списка (и его основа без окончания) сопоставляется с любым из них
+RUSSIAN_ENDINGS = sorted(set("""
+    а я о е ы и у ю ь ей ой ом ем ам ям ах ях ов ев ую юю ая яя ое ее ые ие ый ий ия ию ием иям иях иями ами ями
+    ого его ому ему ым им ых их ыми ими ть ать ять еть ить ешь ишь ет ит ете ите ут ют ат ят ал ял ил ла ло ли л ся сь
+""".split()), key=len, reverse=True)
+# Короче основа не отделяется: слишком короткая основа совпадает с посторонними словами
+MIN_STEM_LENGTH = 4
+# Более короткие слова («я», «не») сопоставляются только точно
+MIN_WORD_LENGTH = 3
+_ENDINGS_PATTERN = '(?:' + '|'.join(RUSSIAN_ENDINGS) + ')?'
+_CYRILLIC_WORD = re.compile(r'[а-я]+(?:-[а-я]+)*')
+_WORD = re.compile(r'\w+')
+_LIST_SEPARATORS = re.compile(r'[,;\n]+')
+
+logger = logging.getLogger(__name__)
+
+_matchers = OrderedDict()
+_lists = {}
+_version = {'value': None, 'checked': None}
+_lock = threading.Lock()
+
+
+def _normalize(text):
+    return text.lower().replace('ё', 'е')
+
+
+class ForbiddenWordMatcher:
+    """
+    Скомпилированный фильтр: все правила — одно регулярное выражение для поиска.
+    Именованные группы отключают оптимизации поиска в re, поэтому совпавшее правило
+    определяется отдельно и только при срабатывании фильтра.
+    """
+    def __init__(self, rules):
+        """
+        :param rules: список (метка, шаблон регулярного выражения)
+        """
+        # Длинные фразы раньше коротких: при совпадении в одной позиции метка будет точнее
+        rules = sorted(rules, key=lambda rule: len(rule[1]), reverse=True)
+        self.size = len(rules)
+        self.rules = [(label, re.compile(pattern)) for label, pattern in rules]
+        # Граница слова слева вынесена за скобки: альтернативы проверяются только с начала слова
+        self.regex = re.compile(r'(?<!\w)(?:' + '|'.join(pattern for _, pattern in rules) + ')') if rules else None
+
+    def find(self, text):
+        """
+        Возвращает метку первого совпавшего правила.
+        :param text: строка
+        :return: строка или None
+        """
+        if self.regex is None:
+            return None
+        text = _normalize(text)
+        match = self.regex.search(text)
+        if not match:
+            return None
+        # Альтернативы проверяются по порядку, поэтому первое правило, совпавшее в этой позиции, и сработало
+        return next(label for label, rule in self.rules if rule.match(text, match.start()))
+
+
+class ResponseFilterService:
+    """
+    Класс-сервис фильтра ответов ИИ:
+    - Разбор списков запрещённых слов (через запятую, точку с запятой или с новой строки)
+    - Сопоставление по границам слов и по основе с окончаниями русских словоформ
+    - Фильтр сценария из глобальных списков, списков организации, шаблона и сценария
+    - Кэш скомпилированных фильтров в процессе по версии списков в Redis
+    """
+    @staticmethod
+    def parse_words(raw):
+        """
+        Разбирает список запрещённых слов.
+        Синтаксис элемента: «слово» — любая словоформа, «=слово» — только эта форма, «слово*» — любое продолжение.
+        :param raw: строка или None
+        :return: список строк
+        """
+        if not raw:
+            return []
+        return [item.strip() for item in _LIST_SEPARATORS.split(_normalize(raw)) if item.strip()]
+
+    @staticmethod
+    def word_pattern(word, morphology=True):
+        """
+        Шаблон одного слова для русских слов: слово целиком или одна из его основ и необязательное окончание.
+        Слово целиком остаётся вариантом основы: окончание может оказаться частью основы
+        («кредит» — не глагол на «-ит»), и тогда формы «кредита», «кредитом» строятся от полного слова.
+        Основы отделяются по всем подходящим окончаниям: «нейросеть» — «нейросет-и», а не «нейросе-ти».
+        :param word: строка в нижнем регистре
+        :param morphology: bool — сопоставлять словоформы
+        :return: строка
+        """
+        if not morphology or not _CYRILLIC_WORD.fullmatch(word) or len(word) < MIN_WORD_LENGTH:
+            return re.escape(word)
+        stems = [word] + [word[:-len(ending)] for ending in RUSSIAN_ENDINGS
+                          if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH]
+        if len(stems) == 1:
+            return re.escape(word) + _ENDINGS_PATTERN
+        return '(?:' + '|'.join(map(re.escape, stems)) + ')' + _ENDINGS_PATTERN
+
+    @staticmethod
+    def entry_pattern(entry, morphology=True):
+        """
+        Шаблон элемента списка (слова или фразы) с границей слова справа.
+        :param entry: строка из parse_words
+        :param morphology: bool — сопоставлять словоформы (элементы с «=» всегда точные)
+        :return: строка
+        """
+        if entry.startswith('='):
+            entry, morphology = entry[1:], False
+        prefix = entry.endswith('*')
+        words = entry.rstrip('*').split()
+        if not words:
+            return None
+        pattern = r'\s+'.join(ResponseFilterService.word_pattern(word, morphology) for word in words)
+        return pattern + (r'\w*' if prefix else r'(?!\w)')
+
+    @staticmethod
+    def build_rules(configured_words, user_role=None):
+        """
+        Правила фильтра: признаки самораскрытия ИИ (словоформы: «бота», «нейросети»), фразы выхода из роли
+        (фраза и любое продолжение последнего слова, как прежняя проверка подстрокой, но с начала слова),
+        настроенные списки (словоформы) и фразы, которыми ИИ выдаёт себя за роль пользователя.
+        :param configured_words: список элементов из parse_words
+        :param user_role: строка — роль пользователя в сценарии
+        :return: список (метка, шаблон)
+        """
+        rules = {}
+        for entry in ROLE_BREAK_PHRASES:
+            entry = _normalize(entry)
+            rules.setdefault(entry, ResponseFilterService.entry_pattern(entry + '*', morphology=False))
+        for entry in FORBIDDEN_KEYWORDS:
+            entry = _normalize(entry)
+            rules.setdefault(entry, ResponseFilterService.entry_pattern(entry))
+        for entry in configured_words:
+            pattern = ResponseFilterService.entry_pattern(entry)
+            if pattern:
+                rules.setdefault(entry.lstrip('=').rstrip('*'), pattern)
+        result = list(rules.items())
+        role_word = next((word for word in _WORD.findall(_normalize(user_role or '')) if len(word) >= MIN_STEM_LENGTH), None)
+        if role_word:
+            result.extend((WRONG_ROLE, ResponseFilterService.entry_pattern(phrase.format(role=role_word)))
+                          for phrase in WRONG_ROLE_PATTERNS)
+        return result
+
+    @staticmethod
+    def get_version():
+        """
+        Возвращает текущую версию списков организаций и шаблонов.
+        :return: int или None, если Redis недоступен
+        """
+        try:
+            raw = redis_client.get(FILTER_VERSION_KEY)
+            return int(raw) if raw else 0
+        except Exception as e:
+            logger.error(f"Ошибка при получении версии фильтра ответов: {str(e)}")
+            return None
+
+    @staticmethod
+    def bump_version():
+        """
+        Увеличивает версию списков (вызывать после изменения запрещённых слов организации или шаблона).
+        Текущий процесс перечитывает версию сразу, остальные — в пределах FILTER_VERSION_TTL.
+        """
+        try:
+            redis_client.incr(FILTER_VERSION_KEY)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении версии фильтра ответов: {str(e)}")
+        with _lock:
+            _version['checked'] = None
+
+    @staticmethod
+    def current_version():
+        """
+        Версия списков с кэшем в процессе на FILTER_VERSION_TTL секунд.
+        Если Redis недоступен, остаётся последняя известная версия (и скомпилированные для неё фильтры).
+        :return: int или None, если версия ещё ни разу не была прочитана
+        """
+        now = time.monotonic()
+        with _lock:
+            if _version['checked'] is not None and now - _version['checked'] < FILTER_VERSION_TTL:
+                return _version['value']
+        version = ResponseFilterService.get_version()
+        with _lock:
+            if version is not None:
+                _version['value'] = version
+            # Следующее обращение к Redis — не раньше чем через FILTER_VERSION_TTL, даже после ошибки
+            _version['checked'] = now
+            return _version['value']
+
+    @staticmethod
+    def _get_list(model, object_id, version):
+        """
+        Запрещённые слова организации или шаблона; при неизменной версии — без обращения к БД.
+        :param model: Organization или PromptTemplate
+        :param object_id: int или None
+        :param version: int или None (Redis ни разу не ответил)
+        :return: строка
+        """
+        if not object_id:
+            return ''
+        key = (model.__tablename__, object_id)
+        cached = _lists.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        obj = db.session.get(model, object_id)
+        words = (obj.forbidden_words or '') if obj else ''
+        _lists[key] = (version, words)
+        return words
+
+    @staticmethod
+    def get_matcher(scenario):
+        """
+        Возвращает скомпилированный фильтр сценария. Фильтр компилируется один раз на набор списков
+        и версию, поэтому стоимость проверки ответа не зависит от числа организаций и шаблонов.
+        :param scenario: объект Scenario
+        :return: ForbiddenWordMatcher
+        """
+        version = ResponseFilterService.current_version()
+        organization_id = getattr(scenario, 'organization_id', None)
+        template_id = getattr(scenario, 'prompt_template_id', None)
+        key = (
+            version,
+            organization_id,
+            template_id,
+            getattr(scenario, 'forbidden_words', None) or '',
+            getattr(scenario, 'user_role', None) or '',
+        )
+        with _lock:
+            matcher = _matchers.get(key)
+            if matcher is not None:
+                _matchers.move_to_end(key)
+                return matcher
+
+        words = []
+        for raw in (
+            ResponseFilterService._get_list(Organization, organization_id, version),
+            ResponseFilterService._get_list(PromptTemplate, template_id, version),
+            key[3],
+        ):
+            words.extend(ResponseFilterService.parse_words(raw))
+        try:
+            matcher = ForbiddenWordMatcher(ResponseFilterService.build_rules(words, key[4]))
+        except re.error as e:
+            logger.error(f"Ошибка при компиляции фильтра ответов сценария {getattr(scenario, 'id', None)}: {str(e)}")
+            matcher = ForbiddenWordMatcher(ResponseFilterService.build_rules([], key[4]))
+
+        with _lock:
+            _matchers[key] = matcher
+            while len(_matchers) > MATCHER_CACHE_SIZE:
+                _matchers.popitem(last=False)
+        return matcher
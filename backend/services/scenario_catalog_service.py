@@ -0,0 +1,122 @@
+# Сервис кэширования каталога сценариев (категории, сферы, списки сценариев)
+from flask import request, Response
+from utils.redis_client import redis_client
+from utils.json_provider import dumps_bytes
+import hashlib
+import json
+import logging
+
+# Счётчик версии каталога: увеличивается при любом изменении сценариев
+CATALOG_VERSION_KEY = "scenario_catalog:version"
+# Сериализованный JSON раздела каталога для конкретной версии
+CATALOG_ENTRY_KEY = "scenario_catalog:{version}:{name}"
+# Записи старых версий не удаляются явно и истекают сами
+CATALOG_ENTRY_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class ScenarioCatalogService:
+    """
+    Класс-сервис для версионированного кэша каталога сценариев:
+    - Версия каталога в Redis, увеличивается при изменениях сценариев
+    - Готовый JSON раздела каталога кэшируется на версию
+    - Ответы с ETag/Cache-Control для условных запросов (304)
+    """
+    @staticmethod
+    def get_version():
+        """
+        Возвращает текущую версию каталога.
+        :return: int или None, если Redis недоступен
+        """
+        try:
+            raw = redis_client.get(CATALOG_VERSION_KEY)
+            return int(raw) if raw else 0
+        except Exception as e:
+            logger.error(f"Ошибка при получении версии каталога: {str(e)}")
+            return None
+
+    @staticmethod
+    def bump_version():
+        """
+        Увеличивает версию каталога (вызывать после создания, изменения или удаления сценария).
+        """
+        try:
+            redis_client.incr(CATALOG_VERSION_KEY)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении версии каталога: {str(e)}")
+
+    @staticmethod
+    def make_etag(version, name):
+        """
+        Формирует ETag раздела каталога по версии.
+        :param version: int — версия каталога
+        :param name: строка — имя раздела
+        :return: строка
+        """
+        # Имя раздела может содержать кириллицу, а заголовки HTTP — только latin-1
+        name_hash = hashlib.md5(name.encode('utf-8')).hexdigest()[:12]
+        return f"catalog-{version}-{name_hash}"
+
+    @staticmethod
+    def get_json(name, builder, version=None):
+        """
+        Возвращает сериализованный JSON раздела каталога из кэша или строит его заново.
+        :param name: строка — имя раздела (уникально для набора параметров)
+        :param builder: функция без аргументов, возвращающая данные раздела
+        :param version: int или None — версия каталога (если уже известна)
+        :return: bytes
+        """
+        if version is None:
+            version = ScenarioCatalogService.get_version()
+        if version is None:
+            return dumps_bytes(builder())
+
+        key = CATALOG_ENTRY_KEY.format(version=version, name=name)
+        try:
+            cached = redis_client.get(key)
+            if cached is not None:
+                return cached
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша каталога: {str(e)}")
+
+        body = dumps_bytes(builder())
+        try:
+            redis_client.setex(key, CATALOG_ENTRY_TTL, body)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша каталога: {str(e)}")
+        return body
+
+    @staticmethod
+    def get_data(name, builder):
+        """
+        Возвращает данные раздела каталога (для обработчиков, которые дополняют их своими полями).
+        :param name: строка — имя раздела
+        :param builder: функция без аргументов, возвращающая данные раздела
+        :return: данные раздела (list или dict)
+        """
+        return json.loads(ScenarioCatalogService.get_json(name, builder))
+
+    @staticmethod
+    def catalog_response(name, builder):
+        """
+        Формирует ответ с разделом каталога и поддержкой условного GET.
+        Если клиент прислал актуальный If-None-Match, возвращает 304 без обращения к БД.
+        :param name: строка — имя раздела
+        :param builder: функция без аргументов, возвращающая данные раздела
+        :return: объект Response
+        """
+        version = ScenarioCatalogService.get_version()
+        if version is None:
+            body = dumps_bytes(builder())
+            return Response(body, mimetype='application/json')
+
+        etag = ScenarioCatalogService.make_etag(version, name)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(ScenarioCatalogService.get_json(name, builder, version), mimetype='application/json')
+        response.set_etag(etag)
+        # Ответы зависят от авторизации, поэтому кэшируются только браузером с обязательной ревалидацией
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
@@ -0,0 +1,241 @@
+# Сервис постраничной выдачи пользователей для админ-панели (keyset-пагинация)
+from models.models import Users, UserRole
+from models.database import db
+from utils.redis_client import redis_client
+from sqlalchemy import func, or_, and_, text
+from datetime import datetime
+import base64
+import hashlib
+import json
+import logging
+
+# Размер страницы по умолчанию и максимальный
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Поля сортировки: имя параметра -> (колонка, функция приведения значения из курсора)
+SORT_FIELDS = {
+    'id': (Users.id, int),
+    'username': (Users.username, str),
+    'email': (Users.email, str),
+    'created_at': (Users.created_at, datetime.fromisoformat),
+}
+# Кэш количества пользователей по набору фильтров
+USER_COUNT_CACHE_KEY = "admin:users:count:{filters_hash}"
+USER_COUNT_CACHE_TTL = 60
+# Ниже этого размера таблицы точный COUNT дешевле, а оценка pg_class может быть неточной
+ESTIMATE_MIN_ROWS = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class UserListingService:
+    """
+    Класс-сервис для выдачи пользователей страницами:
+    - Keyset-пагинация по (поле сортировки, id) с непрозрачным курсором
+    - Фильтры по роли, организации и активности, поиск по префиксу username/email
+    - Общее количество — оценка из статистики Postgres или кэшированный COUNT
+    """
+    @staticmethod
+    def is_paginated_request(args):
+        """
+        Проверяет, запрошена ли постраничная выдача (иначе обработчик отдаёт прежний массив).
+        :param args: параметры запроса
+        :return: bool
+        """
+        return 'limit' in args or 'cursor' in args
+
+    @staticmethod
+    def encode_cursor(sort, value, user_id):
+        """
+        Кодирует позицию последней записи страницы в курсор.
+        :param sort: строка — поле сортировки
+        :param value: значение поля сортировки
+        :param user_id: int — id последней записи
+        :return: строка
+        """
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        raw = json.dumps([sort, value, user_id], ensure_ascii=False).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor, sort):
+        """
+        Декодирует курсор.
+        :param cursor: строка
+        :param sort: строка — текущее поле сортировки (курсор от другой сортировки недействителен)
+        :return: кортеж (value, user_id)
+        """
+        try:
+            cursor_sort, value, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except Exception:
+            raise ValueError('Некорректный курсор')
+        if cursor_sort != sort:
+            raise ValueError('Курсор не соответствует сортировке')
+        if value is not None:
+            caster = SORT_FIELDS[sort][1]
+            value = caster(value)
+        return value, int(user_id)
+
+    @staticmethod
+    def parse_filters(args, organization_id=None):
+        """
+        Разбирает фильтры из параметров запроса.
+        :param args: параметры запроса
+        :param organization_id: int или None — фиксированная организация (для списка пользователей организации)
+        :return: dict с ключами role, organization_id, is_active, q
+        """
+        filters = {}
+
+        role = args.get('role')
+        if role:
+            if role.upper() not in UserRole.__members__:
+                raise ValueError('Недопустимая роль')
+            filters['role'] = UserRole[role.upper()].value
+
+        if organization_id is not None:
+            filters['organization_id'] = organization_id
+        elif args.get('organization_id'):
+            try:
+                filters['organization_id'] = int(args.get('organization_id'))
+            except ValueError:
+                raise ValueError('Некорректный organization_id')
+
+        is_active = args.get('is_active')
+        if is_active is not None and is_active != '':
+            filters['is_active'] = is_active.lower() in ('1', 'true', 'yes')
+
+        q = (args.get('q') or '').strip().lower()
+        if q:
+            filters['q'] = q[:120]
+
+        return filters
+
+    @staticmethod
+    def _apply_filters(query, filters):
+        """
+        Применяет фильтры к запросу.
+        :param query: запрос SQLAlchemy
+        :param filters: dict — результат parse_filters
+        :return: запрос SQLAlchemy
+        """
+        if 'role' in filters:
+            query = query.filter(Users.role == UserRole(filters['role']))
+        if 'organization_id' in filters:
+            query = query.filter(Users.organization_id == filters['organization_id'])
+        if 'is_active' in filters:
+            query = query.filter(Users.is_active.is_(filters['is_active']))
+        if 'q' in filters:
+            # Поиск по префиксу: использует индексы lower(...) text_pattern_ops
+            pattern = filters['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            query = query.filter(or_(
+                func.lower(Users.username).like(pattern, escape='\\'),
+                func.lower(Users.email).like(pattern, escape='\\')
+            ))
+        return query
+
+    @staticmethod
+    def _estimated_total():
+        """
+        Возвращает оценку количества строк в таблице users из статистики Postgres.
+        :return: int или None, если таблица небольшая или статистика не собрана
+        """
+        try:
+            row = db.session.execute(text(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = 'users'"
+            )).fetchone()
+            if row and row[0] is not None and row[0] >= ESTIMATE_MIN_ROWS:
+                return int(row[0])
+        except Exception as e:
+            logger.error(f"Ошибка при получении оценки количества пользователей: {str(e)}")
+            db.session.rollback()
+        return None
+
+    @staticmethod
+    def count(filters):
+        """
+        Возвращает количество пользователей для набора фильтров.
+        Без фильтров — оценка из pg_class, с фильтрами — COUNT с кэшем в Redis.
+        :param filters: dict — результат parse_filters
+        :return: кортеж (total, is_estimate)
+        """
+        if not filters:
+            estimate = UserListingService._estimated_total()
+            if estimate is not None:
+                return estimate, True
+
+        filters_hash = hashlib.md5(json.dumps(filters, sort_keys=True).encode('utf-8')).hexdigest()
+        key = USER_COUNT_CACHE_KEY.format(filters_hash=filters_hash)
+        try:
+            cached = redis_client.get(key)
+            if cached is not None:
+                return int(cached), False
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша количества пользователей: {str(e)}")
+
+        total = UserListingService._apply_filters(
+            db.session.query(func.count(Users.id)), filters
+        ).scalar()
+        try:
+            redis_client.setex(key, USER_COUNT_CACHE_TTL, total)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша количества пользователей: {str(e)}")
+        return total, False
+
+    @staticmethod
+    def get_page(args, organization_id=None, serialize=None):
+        """
+        Возвращает страницу пользователей.
+        :param args: параметры запроса (limit, cursor, sort, order, role, organization_id, is_active, q)
+        :param organization_id: int или None — ограничить выдачу организацией
+        :param serialize: функция Users -> dict
+        :return: dict с ключами users, next_cursor, total, total_is_estimate
+        """
+        sort = args.get('sort', 'created_at')
+        if sort not in SORT_FIELDS:
+            raise ValueError('Недопустимое поле сортировки')
+        order = args.get('order', 'desc').lower()
+        if order not in ('asc', 'desc'):
+            raise ValueError('Недопустимый порядок сортировки')
+        try:
+            limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise ValueError('Некорректный limit')
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        filters = UserListingService.parse_filters(args, organization_id)
+        column = SORT_FIELDS[sort][0]
+        query = UserListingService._apply_filters(Users.query, filters)
+
+        cursor = args.get('cursor')
+        if cursor:
+            value, last_id = UserListingService.decode_cursor(cursor, sort)
+            if sort == 'id':
+                query = query.filter(Users.id > last_id if order == 'asc' else Users.id < last_id)
+            elif order == 'asc':
+                query = query.filter(or_(column > value, and_(column == value, Users.id > last_id)))
+            else:
+                query = query.filter(or_(column < value, and_(column == value, Users.id < last_id)))
+
+        if order == 'asc':
+            query = query.order_by(column.asc(), Users.id.asc())
+        else:
+            query = query.order_by(column.desc(), Users.id.desc())
+
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        users = query.limit(limit + 1).all()
+        has_more = len(users) > limit
+        users = users[:limit]
+
+        next_cursor = None
+        if has_more and users:
+            last = users[-1]
+            next_cursor = UserListingService.encode_cursor(sort, getattr(last, column.key), last.id)
+
+        total, is_estimate = UserListingService.count(filters)
+        return {
+            'users': [serialize(user) for user in users],
+            'next_cursor': next_cursor,
+            'total': total,
+            'total_is_estimate': is_estimate
+        }
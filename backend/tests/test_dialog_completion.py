@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models.database import db
+from models.models import Dialog, Message, UserStatistics
+from routes import chat
+
+ANALYSIS = """Сотрудник вёл разговор спокойно и вежливо, выяснил причину недовольства гостя.
+Гость в итоге остался доволен тем, как его выслушали.
+
+```json
+{"score": %d, "is_successful": %s, "criteria": {"communication": 80, "empathy": 75, "problem_solving": 70, "professionalism": 85}}
+```"""
+
+
+@pytest.fixture
+def gigachat(monkeypatch):
+    """
+    Ответы GigaChat на промпт анализа: очередь (score, is_successful).
+    """
+    replies = []
+
+    def send(params, retries=1):
+        score, is_successful = replies.pop(0)
+        content = ANALYSIS % (score, 'true' if is_successful else 'false')
+        return {'choices': [{'message': {'content': content}}]}
+
+    monkeypatch.setattr(chat.gigachat_service, 'send', send)
+    return replies
+
+
+@pytest.fixture
+def start_dialog(user, make_scenario):
+    scenario = make_scenario()
+
+    def start(text):
+        dialog = Dialog(user_id=user.id, scenario_id=scenario.id, status='active',
+                        started_at=datetime.utcnow() - timedelta(minutes=3))
+        db.session.add(dialog)
+        db.session.flush()
+        db.session.add_all([
+            Message(dialog_id=dialog.id, sender='assistant', text='Я жду уже двадцать минут!'),
+            Message(dialog_id=dialog.id, sender='user', text=text),
+        ])
+        db.session.commit()
+        return dialog.id
+    return start
+
+
+def _finish(client, headers, dialog_id, duration=120):
+    return client.post(f'/api/chat/session/{dialog_id}/message', headers=headers,
+                       json={'message': 'ЗАВЕРШИТЬ СИМУЛЯЦИЮ', 'duration': duration})
+
+
+def test_simulation_command_scores_dialog_and_updates_counters(client, auth_headers, user, gigachat, start_dialog):
+    gigachat.extend([(82, True), (90, True), (30, False)])
+
+    first = _finish(client, auth_headers, start_dialog('Понимаю, сейчас всё уточню.'))
+    assert first.status_code == 200
+    assert first.get_json()['score'] == 82
+    assert first.get_json()['is_successful'] is True
+    assert first.get_json()['duration'] == 120
+
+    _finish(client, auth_headers, start_dialog('Сейчас подойдёт администратор.'))
+    stats = db.session.get(UserStatistics, user.statistics.id)
+    db.session.refresh(stats)
+    assert stats.scored_dialogs == 2
+    assert stats.average_score == pytest.approx(86)
+    assert stats.current_streak == 2
+    assert stats.best_streak == 2
+    assert stats.unique_successful_scenarios == 1
+    assert stats.total_time_spent == 240
+
+    _finish(client, auth_headers, start_dialog('Ничего не могу сделать.'))
+    db.session.refresh(stats)
+    assert stats.scored_dialogs == 3
+    assert stats.current_streak == 0
+    assert stats.best_streak == 2
+
+
+def test_simulation_command_without_score_resets_streak(client, auth_headers, user, gigachat, start_dialog,
+                                                       monkeypatch):
+    gigachat.append((75, True))
+    _finish(client, auth_headers, start_dialog('Понимаю, сейчас всё уточню.'))
+    # Анализ не получен: диалог завершается без оценки и прерывает серию
+    monkeypatch.setattr(chat.gigachat_service, 'send', lambda params, retries=1: None)
+    monkeypatch.setattr(chat.time, 'sleep', lambda seconds: None)
+    response = _finish(client, auth_headers, start_dialog('Сейчас подойдёт администратор.'))
+    assert response.status_code == 200
+    assert response.get_json()['score'] is None
+
+    stats = db.session.get(UserStatistics, user.statistics.id)
+    db.session.refresh(stats)
+    assert stats.scored_dialogs == 1
+    assert stats.current_streak == 0
+    assert stats.best_streak == 1
@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    yield engine
+    engine.dispose()
+
+
+def test_budget_exceeded_raises(query_guard, engine):
+    @query_guard.query_budget(2)
+    def handler():
+        with engine.connect() as conn:
+            for user_id in range(3):
+                conn.execute(text('SELECT :id'), {'id': user_id})
+
+    with pytest.raises(AssertionError, match='выполнено 3 SQL-запросов при бюджете 2'):
+        handler()
+
+
+def test_budget_respected(query_guard, engine):
+    @query_guard.query_budget(3)
+    def handler():
+        with engine.connect() as conn:
+            return [conn.execute(text('SELECT :id'), {'id': user_id}).scalar() for user_id in range(3)]
+
+    assert handler() == [0, 1, 2]
+
+
+@pytest.fixture
+def progress_rows(user, make_scenario):
+    from models.database import db
+    from models.models import UserProgress
+    for i in range(6):
+        scenario = make_scenario(name=f'Сценарий {i}')
+        db.session.add(UserProgress(user_id=user.id, scenario_id=scenario.id, status='completed',
+                                    progress_percentage=100))
+    db.session.commit()
+    # Сценарии не должны браться из identity map сессии теста
+    db.session.expunge_all()
+
+
+def test_progress_endpoint_within_budget(query_guard, client, auth_headers, progress_rows):
+    response = client.get('/api/progress/', headers=auth_headers)
+    assert response.status_code == 200
+    assert len(response.get_json()['progress']) == 6
+
+
+def test_progress_endpoint_trips_budget_without_joinedload(query_guard, client, auth_headers, progress_rows,
+                                                           monkeypatch):
+    from sqlalchemy.orm import lazyload
+    from routes import progress
+    # Без joinedload сценарии грузятся по одному (N+1) — бюджет эндпоинта должен это поймать
+    monkeypatch.setattr(progress, 'joinedload', lazyload)
+    with pytest.raises(AssertionError, match='SQL-запросов при бюджете 4'):
+        client.get('/api/progress/', headers=auth_headers)
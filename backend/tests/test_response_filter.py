@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+import pytest
+
+from services import response_filter_service
+from services.response_filter_service import ForbiddenWordMatcher, ResponseFilterService
+
+
+def _matcher(words='', user_role=None):
+    rules = ResponseFilterService.build_rules(ResponseFilterService.parse_words(words), user_role)
+    return ForbiddenWordMatcher(rules)
+
+
+@pytest.mark.parametrize('word, forms', [
+    ('кредит', ['кредит', 'кредита', 'кредиты', 'кредитом']),
+    ('депозит', ['депозит', 'депозита', 'депозиты', 'депозитом']),
+    ('банкомат', ['банкомат', 'банкомата', 'банкоматы', 'банкоматом']),
+    ('материал', ['материал', 'материала', 'материалы', 'материалом']),
+])
+def test_configured_word_matches_noun_forms(word, forms):
+    matcher = _matcher(word)
+    for form in forms:
+        assert matcher.find(f'Клиент спросил про {form} вчера') == word, form
+
+
+def test_configured_word_respects_word_boundaries():
+    matcher = _matcher('кредит')
+    assert matcher.find('Это дискредитация') is None
+    assert matcher.find('Кредитование') is None
+
+
+def test_exact_entry_matches_only_its_form():
+    matcher = _matcher('=кредит')
+    assert matcher.find('Оформим кредит') == 'кредит'
+    assert matcher.find('Оформим кредита') is None
+
+
+@pytest.mark.parametrize('text, label', [
+    ('Работа бота здесь ни при чём', 'бот'),
+    ('Я общаюсь с ботом', 'бот'),
+    ('Это ответ нейросети', 'нейросеть'),
+    ('Это ответ чат-бота', 'чат-бот'),
+    ('Текст сгенерирован искусственным интеллектом', 'искусственный интеллект'),
+])
+def test_builtin_self_disclosure_words_match_word_forms(text, label):
+    assert _matcher().find(text) == label
+
+
+def test_builtin_phrases_match_continuations():
+    matcher = _matcher()
+    assert matcher.find('Мы предложим скидками воспользоваться') == 'скидка'
+    assert matcher.find('Извините, я ошибся') == 'извините'
+    assert matcher.find('Я жду уже двадцать минут, и никто ко мне не подошёл!') is None
+    assert matcher.find('Работа у меня тяжёлая') is None
+
+
+def test_wrong_role():
+    assert _matcher(user_role='Официант ресторана').find('Я официант, поэтому знаю') == 'wrong_role'
+
+
+class _FailingRedis:
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        raise ConnectionError('redis down')
+
+
+class _VersionRedis:
+    def __init__(self, version):
+        self.version = version
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        return str(self.version).encode()
+
+
+@pytest.fixture
+def filter_state(monkeypatch):
+    monkeypatch.setattr(response_filter_service, '_matchers', response_filter_service.OrderedDict())
+    monkeypatch.setattr(response_filter_service, '_version', {'value': None, 'checked': None})
+    return response_filter_service
+
+
+def _scenario(**overrides):
+    fields = {'id': 1, 'organization_id': None, 'prompt_template_id': None,
+              'forbidden_words': 'кредит', 'user_role': 'официант'}
+    fields.update(overrides)
+    return SimpleNamespace(**fields)
+
+
+def test_matcher_reuses_version_within_ttl(filter_state, monkeypatch):
+    redis = _VersionRedis(3)
+    monkeypatch.setattr(filter_state, 'redis_client', redis)
+    scenario = _scenario()
+    first = ResponseFilterService.get_matcher(scenario)
+    assert ResponseFilterService.get_matcher(scenario) is first
+    assert redis.calls == 1
+
+
+def test_matcher_survives_redis_failure(filter_state, monkeypatch):
+    monkeypatch.setattr(filter_state, 'redis_client', _VersionRedis(3))
+    scenario = _scenario()
+    first = ResponseFilterService.get_matcher(scenario)
+
+    failing = _FailingRedis()
+    monkeypatch.setattr(filter_state, 'redis_client', failing)
+    monkeypatch.setattr(filter_state, 'FILTER_VERSION_TTL', 0)
+    assert ResponseFilterService.get_matcher(scenario) is first
+    assert failing.calls == 1
@@ -1,19 +1,134 @@
 from functools import wraps
-from flask import jsonify
-from models.models import Users
+from collections import namedtuple
+from flask import jsonify, g
+from models.models import Users, UserRole
+from models.database import db
 from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from utils.redis_client import redis_client
+import json
+import logging
+
+# Ключ кэша с ролью/активностью/организацией пользователя
+USER_CACHE_KEY = "user:{user_id}"
+# Короткий TTL: изменения админом сбрасывают кэш явно, TTL — страховка
+USER_CACHE_TTL = 60
+
+logger = logging.getLogger(__name__)
+
+# Лёгкий снимок пользователя для проверок доступа (без загрузки ORM-объекта)
+CurrentUser = namedtuple('CurrentUser', ['id', 'role', 'is_active', 'organization_id'])
+
+_MISSING = object()
+
+
+def _read_cached_user(user_id):
+    """
+    Читает снимок пользователя из Redis.
+    :param user_id: int — идентификатор пользователя
+    :return: CurrentUser или None
+    """
+    try:
+        raw = redis_client.get(USER_CACHE_KEY.format(user_id=user_id))
+        if not raw:
+            return None
+        data = json.loads(raw.decode('utf-8'))
+        return CurrentUser(
+            id=data['id'],
+            role=UserRole(data['role']) if data.get('role') else None,
+            is_active=data.get('is_active'),
+            organization_id=data.get('organization_id')
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при чтении кэша пользователя: {str(e)}")
+        return None
+
+
+def _write_cached_user(user):
+    """
+    Сохраняет снимок пользователя в Redis.
+    :param user: CurrentUser
+    """
+    try:
+        redis_client.setex(
+            USER_CACHE_KEY.format(user_id=user.id),
+            USER_CACHE_TTL,
+            json.dumps({
+                'id': user.id,
+                'role': user.role.value if user.role else None,
+                'is_active': user.is_active,
+                'organization_id': user.organization_id
+            }).encode('utf-8')
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении кэша пользователя: {str(e)}")
+
+
+def invalidate_user_cache(user_id):
+    """
+    Сбрасывает кэш пользователя (вызывать после изменения роли, активности или организации).
+    :param user_id: int — идентификатор пользователя
+    """
+    try:
+        redis_client.delete(USER_CACHE_KEY.format(user_id=user_id))
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе кэша пользователя: {str(e)}")
+    current = g.get('_current_user')
+    if current is not None and current.id == user_id:
+        g.pop('_current_user', None)
+        g.pop('_current_user_model', None)
+
+
+def load_current_user():
+    """
+    Возвращает снимок текущего пользователя по JWT.
+    Загружается не более одного раза за запрос: сначала из g, затем из Redis, затем из БД.
+    :return: CurrentUser или None, если пользователь не найден
+    """
+    cached = g.get('_current_user', _MISSING)
+    if cached is not _MISSING:
+        return cached
+
+    user_id = get_jwt_identity()
+    user = None
+    if user_id is not None:
+        user = _read_cached_user(user_id)
+        if user is None:
+            row = db.session.query(
+                Users.id, Users.role, Users.is_active, Users.organization_id
+            ).filter(Users.id == user_id).first()
+            if row:
+                user = CurrentUser(id=row.id, role=row.role, is_active=row.is_active, organization_id=row.organization_id)
+                _write_cached_user(user)
+
+    g._current_user = user
+    return user
+
+
+def get_current_user_model():
+    """
+    Возвращает ORM-объект текущего пользователя (для обработчиков, которым нужны связи и изменение данных).
+    Загружается не более одного раза за запрос.
+    :return: объект Users или None
+    """
+    cached = g.get('_current_user_model', _MISSING)
+    if cached is not _MISSING:
+        return cached
+    user_id = get_jwt_identity()
+    user = Users.query.get(user_id) if user_id is not None else None
+    g._current_user_model = user
+    return user
+
 
 def role_required(role_name):
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
             verify_jwt_in_request()
-            user_id = get_jwt_identity()
-            user = Users.query.get(user_id)
+            user = load_current_user()
 
             if not user or not user.is_active:
                 return jsonify({'error': 'Неавторизованный доступ'}), 401
-            
+
             if user.role.value != role_name:
                 return jsonify({'error': 'Недостаточно прав'}), 403
 
@@ -23,4 +138,4 @@ def role_required(role_name):
 
 # Декораторы для проверки конкретных ролей
 admin_required = role_required("admin")
-moderator_required = role_required("manager") 
\ No newline at end of file
+moderator_required = role_required("manager")
@@ -0,0 +1,87 @@
+# Модуль быстрой JSON-сериализации ответов API (orjson с откатом на стандартный json)
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from dataclasses import asdict, is_dataclass
+from datetime import date, datetime
+from decimal import Decimal
+import enum
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работает стандартный json
+    orjson = None
+
+
+def _default(obj):
+    """
+    Преобразует типы, которые не сериализуются напрямую.
+    Формат совпадает с тем, что раньше делали обработчики вручную (isoformat, .value).
+    :param obj: объект для сериализации
+    :return: сериализуемое значение
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if is_dataclass(obj) and not isinstance(obj, type):
+        return asdict(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# Разрешаем нестроковые ключи словарей (int id сценариев и т.п.), как и стандартный json
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else None
+
+
+def dumps_bytes(obj):
+    """
+    Сериализует объект в JSON (bytes, UTF-8).
+    :param obj: объект для сериализации
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON-провайдер Flask на базе orjson.
+    Нативно поддерживает datetime/date, Enum (UserRole, ScenarioType) и dataclass.
+    """
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode('utf-8')
+        kwargs.setdefault('default', _default)
+        kwargs.setdefault('ensure_ascii', False)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
+
+
+class ApiFlask(Flask):
+    """
+    Приложение Flask, обработчики которого могут возвращать типизированные объекты (dataclass).
+    Такие объекты сериализуются так же, как dict, в том числе в кортежах (объект, код).
+    """
+    json_provider_class = FastJSONProvider
+
+    def make_response(self, rv):
+        if isinstance(rv, tuple) and rv and is_dataclass(rv[0]) and not isinstance(rv[0], type):
+            rv = (self.json.response(rv[0]),) + rv[1:]
+        elif is_dataclass(rv) and not isinstance(rv, type):
+            rv = self.json.response(rv)
+        return super().make_response(rv)
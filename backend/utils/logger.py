@@ -1,5 +1,165 @@
-# Данный модуль содержит функцию для получения логгера приложения Flask.
-# Используется для унификации доступа к логгеру во всём проекте.
+# Данный модуль содержит настройку логирования приложения и функцию для получения логгера Flask.
+# Логи пишутся в stdout в виде JSON через очередь: запись и форматирование выполняются
+# в отдельном потоке и не блокируют поток запроса.
+from flask import g, request, has_request_context
+from logging.handlers import QueueHandler, QueueListener
+from utils.json_provider import dumps_bytes
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+
+# Уровень и формат логов: json (по умолчанию) или text для локальной отладки
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Доля сохраняемых INFO-записей, помеченных extra={'sampled': True} (массовые события)
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+# Размер очереди; при переполнении записи отбрасываются, а не блокируют запрос
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id', 'sampled'}
+
+_PLAIN_TYPES = (str, int, float, bool, type(None))
+
+_listener = None
+
+
+def _iter_args(args):
+    return args.values() if isinstance(args, dict) else args
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись в одну строку JSON.
+    Поля из extra попадают в документ как есть.
+    """
+    def format(self, record):
+        document = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'where': f'{record.module}:{record.lineno}',
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            document['request_id'] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                document[key] = value
+        if record.exc_text:
+            document['exc'] = record.exc_text
+        elif record.exc_info:
+            document['exc'] = self.formatException(record.exc_info)
+        try:
+            return dumps_bytes(document).decode('utf-8')
+        except TypeError:
+            document = {k: (v if isinstance(v, (str, int, float, bool, type(None))) else repr(v)) for k, v in document.items()}
+            return dumps_bytes(document).decode('utf-8')
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Добавляет к записи идентификатор запроса (выполняется в потоке запроса).
+    """
+    def filter(self, record):
+        record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Прореживает массовые INFO/DEBUG-записи, помеченные extra={'sampled': True}.
+    Предупреждения и ошибки не прореживаются никогда.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self.rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не форматирует сообщение в потоке запроса и не ждёт при полной очереди.
+    """
+    dropped = 0
+
+    def prepare(self, record):
+        # Трассировку сохраняем текстом сразу: объекты исключения не должны жить в очереди
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        # Примитивные аргументы форматируются в потоке записи; объекты (например, ORM-модели)
+        # подставляем сразу, пока они принадлежат текущему потоку и сессии
+        if record.args and not all(isinstance(a, _PLAIN_TYPES) for a in _iter_args(record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+def _assign_request_id():
+    g.request_id = (request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex)[:64]
+
+
+def _return_request_id(response):
+    request_id = g.get('request_id')
+    if request_id:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+def configure_logging(app):
+    """
+    Настраивает логирование приложения: JSON в stdout через очередь, идентификатор запроса, прореживание.
+    :param app: экземпляр Flask-приложения
+    """
+    global _listener
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+        ))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    # Логгер Flask пишет через корневой, чтобы все записи шли одной очередью
+    app.logger.handlers.clear()
+    app.logger.setLevel(LOG_LEVEL)
+    app.logger.propagate = True
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    app.before_request(_assign_request_id)
+    app.after_request(_return_request_id)
+
 
 def setup_logger(app):
     """
@@ -8,4 +168,4 @@ def setup_logger(app):
     :param app: экземпляр Flask-приложения
     :return: объект логгера
     """
-    return app.logger 
\ No newline at end of file
+    return app.logger
@@ -0,0 +1,330 @@
+# Модуль метрик производительности: задержки эндпоинтов, запросы к БД и Redis, фазы GigaChat.
+# Метрики хранятся в Redis, поэтому /metrics отдаёт сумму по всем воркерам gunicorn.
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils.redis_client import redis_client
+import atexit
+import logging
+import os
+import threading
+import time
+
+# Хэш с гистограммой и счётчиками эндпоинта (ключ совпадает с config/database.py: RedisKeys.API_LATENCY)
+API_LATENCY_KEY = "metrics:api_latency:{endpoint}"
+# Хэш с гистограммой фазы обращения к GigaChat (auth, network, filter)
+LLM_PHASE_KEY = "metrics:llm_phase:{phase}"
+# Хэш со счётчиками событий GigaChat (повторы, ошибки, сброс токена)
+LLM_EVENTS_KEY = "metrics:llm_events"
+# Множества известных эндпоинтов и фаз (для вывода без SCAN)
+ENDPOINTS_SET_KEY = "metrics:endpoints"
+LLM_PHASES_SET_KEY = "metrics:llm_phases"
+
+# Фазы, которые не относятся к ожиданию GigaChat и не входят в llm_seconds запроса (проверка ответа — работа CPU)
+LOCAL_LLM_PHASES = {'filter'}
+# Вне запроса (задания, фоновые потоки) фазы и события копятся в процессе и записываются пачкой:
+# после LLM_BUFFER_SIZE наблюдений или через LLM_BUFFER_INTERVAL секунд после первого из них
+LLM_BUFFER_SIZE = int(os.getenv('METRICS_LLM_BUFFER_SIZE', '100'))
+LLM_BUFFER_INTERVAL = float(os.getenv('METRICS_LLM_BUFFER_INTERVAL', '10'))
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+_llm_buffer = {'phases': [], 'events': {}, 'started': None}
+_llm_buffer_lock = threading.Lock()
+
+
+def _bucket_field(seconds):
+    """
+    Возвращает поле хэша корзины гистограммы для значения (корзины хранятся некумулятивно).
+    :param seconds: float — длительность
+    :return: строка
+    """
+    for bound in LATENCY_BUCKETS:
+        if seconds <= bound:
+            return f"bucket:{bound}"
+    return "bucket:+Inf"
+
+
+def _observe(pipe, key, seconds):
+    """
+    Добавляет наблюдение в гистограмму (в составе pipeline).
+    :param pipe: pipeline Redis
+    :param key: строка — ключ хэша
+    :param seconds: float — длительность
+    """
+    pipe.hincrby(key, 'count', 1)
+    pipe.hincrbyfloat(key, 'sum', seconds)
+    pipe.hincrby(key, _bucket_field(seconds), 1)
+
+
+def _flush_llm(pipe, phases, events):
+    """
+    Записывает накопленные фазы и события GigaChat (в составе pipeline).
+    :param pipe: pipeline Redis
+    :param phases: список (phase, seconds)
+    :param events: dict event -> количество
+    """
+    for phase, seconds in phases:
+        pipe.sadd(LLM_PHASES_SET_KEY, phase)
+        _observe(pipe, LLM_PHASE_KEY.format(phase=phase), seconds)
+    for name, amount in events.items():
+        pipe.hincrby(LLM_EVENTS_KEY, name, amount)
+
+
+def _buffer_llm(phase=None, seconds=0.0, event=None, amount=0):
+    """
+    Добавляет фазу или событие GigaChat в буфер процесса и записывает буфер, если он заполнен или устарел.
+    :param phase: строка или None
+    :param seconds: float — длительность фазы
+    :param event: строка или None
+    :param amount: int — приращение события
+    """
+    with _llm_buffer_lock:
+        if phase is not None:
+            _llm_buffer['phases'].append((phase, seconds))
+        if event is not None:
+            _llm_buffer['events'][event] = _llm_buffer['events'].get(event, 0) + amount
+        if _llm_buffer['started'] is None:
+            _llm_buffer['started'] = time.monotonic()
+        size = len(_llm_buffer['phases']) + len(_llm_buffer['events'])
+        due = size >= LLM_BUFFER_SIZE or time.monotonic() - _llm_buffer['started'] >= LLM_BUFFER_INTERVAL
+    if due:
+        flush_llm_buffer()
+
+
+def flush_llm_buffer():
+    """
+    Записывает накопленные вне запроса фазы и события GigaChat одним pipeline.
+    Вызывается при заполнении буфера и при завершении процесса.
+    """
+    with _llm_buffer_lock:
+        phases, events = _llm_buffer['phases'], _llm_buffer['events']
+        _llm_buffer.update(phases=[], events={}, started=None)
+    if not phases and not events:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        _flush_llm(pipe, phases, events)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка при записи метрик GigaChat: {str(e)}")
+
+
+atexit.register(flush_llm_buffer)
+
+
+def record_llm_phase(phase, seconds):
+    """
+    Регистрирует длительность фазы обращения к GigaChat.
+    Внутри запроса значение копится в g и записывается вместе с метриками запроса,
+    вне запроса — в буфере процесса (см. LLM_BUFFER_SIZE).
+    :param phase: строка — 'auth', 'network', 'filter'
+    :param seconds: float — длительность
+    """
+    if has_request_context():
+        g._metrics_llm_phases = g.get('_metrics_llm_phases', []) + [(phase, seconds)]
+        if phase not in LOCAL_LLM_PHASES:
+            g._metrics_llm_seconds = g.get('_metrics_llm_seconds', 0.0) + seconds
+        return
+    _buffer_llm(phase=phase, seconds=seconds)
+
+
+def count_llm_event(name, amount=1):
+    """
+    Увеличивает счётчик события GigaChat.
+    :param name: строка — 'retry', 'error', 'token_reset'
+    :param amount: int
+    """
+    if has_request_context():
+        events = g.get('_metrics_llm_events', {})
+        events[name] = events.get(name, 0) + amount
+        g._metrics_llm_events = events
+        return
+    _buffer_llm(event=name, amount=amount)
+
+
+@contextmanager
+def llm_phase(phase):
+    """
+    Контекстный менеджер (и декоратор) для замера фазы обращения к GigaChat.
+    :param phase: строка — имя фазы
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_llm_phase(phase, time.perf_counter() - started)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+    started = getattr(context, '_metrics_query_start', None)
+    g._metrics_db_count = g.get('_metrics_db_count', 0) + 1
+    if started is not None:
+        g._metrics_db_time = g.get('_metrics_db_time', 0.0) + (time.perf_counter() - started)
+
+
+def _instrument_redis():
+    """
+    Оборачивает execute_command клиента Redis для подсчёта обращений за запрос.
+    Запись самих метрик идёт через pipeline и в подсчёт не попадает.
+    """
+    original = redis_client.execute_command
+
+    def execute_command(*args, **options):
+        if has_request_context():
+            g._metrics_redis_calls = g.get('_metrics_redis_calls', 0) + 1
+        return original(*args, **options)
+
+    redis_client.execute_command = execute_command
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.get('_metrics_start')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # Неизвестные URL (404 без эндпоинта) собираем в одну метку, чтобы не раздувать число серий
+    endpoint = request.endpoint or 'unmatched'
+    key = API_LATENCY_KEY.format(endpoint=endpoint)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.sadd(ENDPOINTS_SET_KEY, endpoint)
+        _observe(pipe, key, elapsed)
+        pipe.hincrby(key, f"status:{response.status_code // 100}xx", 1)
+        pipe.hincrby(key, 'db_queries', g.get('_metrics_db_count', 0))
+        pipe.hincrbyfloat(key, 'db_seconds', g.get('_metrics_db_time', 0.0))
+        pipe.hincrby(key, 'redis_calls', g.get('_metrics_redis_calls', 0))
+        pipe.hincrbyfloat(key, 'llm_seconds', g.get('_metrics_llm_seconds', 0.0))
+        _flush_llm(pipe, g.get('_metrics_llm_phases', []), g.get('_metrics_llm_events', {}))
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка при записи метрик запроса: {str(e)}")
+    return response
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _decode_hash(raw):
+    return {k.decode('utf-8'): float(v) for k, v in raw.items()}
+
+
+def _render_histogram(lines, name, labels, data):
+    """
+    Добавляет строки гистограммы в формате Prometheus (корзины накапливаются при выводе).
+    :param lines: list — строки вывода
+    :param name: строка — имя метрики
+    :param labels: строка — метки вида key="value"
+    :param data: dict — поля хэша
+    """
+    cumulative = 0
+    for bound in LATENCY_BUCKETS:
+        cumulative += data.get(f"bucket:{bound}", 0)
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {int(cumulative)}')
+    cumulative += data.get("bucket:+Inf", 0)
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {int(cumulative)}')
+    lines.append(f'{name}_sum{{{labels}}} {data.get("sum", 0.0)}')
+    lines.append(f'{name}_count{{{labels}}} {int(data.get("count", 0))}')
+
+
+def render_metrics():
+    """
+    Формирует текст метрик в формате Prometheus по данным всех воркеров.
+    :return: строка
+    """
+    endpoints = sorted(e.decode('utf-8') for e in redis_client.smembers(ENDPOINTS_SET_KEY))
+    phases = sorted(p.decode('utf-8') for p in redis_client.smembers(LLM_PHASES_SET_KEY))
+
+    pipe = redis_client.pipeline(transaction=False)
+    for endpoint in endpoints:
+        pipe.hgetall(API_LATENCY_KEY.format(endpoint=endpoint))
+    for phase in phases:
+        pipe.hgetall(LLM_PHASE_KEY.format(phase=phase))
+    pipe.hgetall(LLM_EVENTS_KEY)
+    results = pipe.execute()
+
+    endpoint_data = [_decode_hash(raw) for raw in results[:len(endpoints)]]
+    phase_data = [_decode_hash(raw) for raw in results[len(endpoints):len(endpoints) + len(phases)]]
+    events = _decode_hash(results[-1])
+
+    lines = [
+        '# HELP http_request_duration_seconds Длительность обработки запроса',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for endpoint, data in zip(endpoints, endpoint_data):
+        _render_histogram(lines, 'http_request_duration_seconds', f'endpoint="{_escape_label(endpoint)}"', data)
+
+    lines.append('# HELP http_requests_total Количество запросов по классу статуса')
+    lines.append('# TYPE http_requests_total counter')
+    for endpoint, data in zip(endpoints, endpoint_data):
+        for field, value in sorted(data.items()):
+            if field.startswith('status:'):
+                lines.append(f'http_requests_total{{endpoint="{_escape_label(endpoint)}",status="{field[7:]}"}} {int(value)}')
+
+    per_request = (
+        ('http_request_db_queries_total', 'db_queries', 'Количество SQL-запросов', int),
+        ('http_request_db_seconds_total', 'db_seconds', 'Суммарное время SQL-запросов', float),
+        ('http_request_redis_calls_total', 'redis_calls', 'Количество обращений к Redis', int),
+        ('http_request_llm_seconds_total', 'llm_seconds', 'Суммарное время обращений к GigaChat', float),
+    )
+    for name, field, help_text, cast in per_request:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for endpoint, data in zip(endpoints, endpoint_data):
+            lines.append(f'{name}{{endpoint="{_escape_label(endpoint)}"}} {cast(data.get(field, 0))}')
+
+    lines.append('# HELP gigachat_phase_duration_seconds Длительность фаз обращения к GigaChat')
+    lines.append('# TYPE gigachat_phase_duration_seconds histogram')
+    for phase, data in zip(phases, phase_data):
+        _render_histogram(lines, 'gigachat_phase_duration_seconds', f'phase="{_escape_label(phase)}"', data)
+
+    lines.append('# HELP gigachat_events_total События обращения к GigaChat (повторы, ошибки)')
+    lines.append('# TYPE gigachat_events_total counter')
+    for name, value in sorted(events.items()):
+        lines.append(f'gigachat_events_total{{event="{_escape_label(name)}"}} {int(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_endpoint():
+    """
+    Отдаёт метрики в формате Prometheus.
+    Если задан METRICS_TOKEN, требуется заголовок Authorization: Bearer <токен>.
+    """
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    try:
+        body = render_metrics()
+    except Exception as e:
+        logger.error(f"Ошибка при формировании метрик: {str(e)}")
+        return Response('Metrics unavailable\n', status=503, mimetype='text/plain')
+    return Response(body, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_metrics(app):
+    """
+    Подключает сбор метрик к Flask-приложению и регистрирует эндпоинт /metrics.
+    :param app: экземпляр Flask-приложения
+    """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _instrument_redis()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -0,0 +1,287 @@
+# Модуль выборочного профилирования запросов: стек-сэмплы и спаны SQL/Redis/HTTP в формате speedscope.
+# Включается заголовком X-Profile: 1 (только для администратора) или для доли запросов PROFILE_SAMPLE_RATE.
+from flask import g, request, has_request_context
+from flask_jwt_extended import verify_jwt_in_request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils.redis_client import redis_client
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+# Каталог с файлами профилей (общий для всех воркеров gunicorn)
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'profiles'))
+# Доля запросов, профилируемых без заголовка (0 — только по заголовку)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# Интервал между стек-сэмплами, секунды
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000
+# Сколько последних профилей хранить
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '200'))
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_RE = re.compile(r'^[\w.-]+$')
+
+logger = logging.getLogger(__name__)
+
+
+class _StackSampler(threading.Thread):
+    """
+    Фоновый поток, периодически снимающий стек потока запроса.
+    """
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = []  # список (время снятия, кортеж кадров от корня к листу)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append((time.perf_counter(), tuple(stack)))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=1)
+
+
+def _is_active():
+    return g.get('_profile') is not None
+
+
+def _add_span(kind, name, started, finished):
+    """
+    Добавляет спан к профилю текущего запроса.
+    :param kind: строка — 'sql', 'redis' или 'http'
+    :param name: строка — описание операции
+    :param started: float — perf_counter начала
+    :param finished: float — perf_counter окончания
+    """
+    g._profile['spans'].append((kind, name, started, finished))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or not _is_active():
+        return
+    started = getattr(context, '_profile_started', None)
+    if started is not None:
+        _add_span('sql', ' '.join(statement.split())[:200], started, time.perf_counter())
+
+
+def _instrument_redis():
+    original = redis_client.execute_command
+
+    def execute_command(*args, **options):
+        if not has_request_context() or not _is_active():
+            return original(*args, **options)
+        started = time.perf_counter()
+        try:
+            return original(*args, **options)
+        finally:
+            _add_span('redis', str(args[0]) if args else 'redis', started, time.perf_counter())
+
+    redis_client.execute_command = execute_command
+
+
+def _instrument_http():
+    original = requests.Session.send
+
+    def send(self, prepared, **kwargs):
+        if not has_request_context() or not _is_active():
+            return original(self, prepared, **kwargs)
+        started = time.perf_counter()
+        try:
+            return original(self, prepared, **kwargs)
+        finally:
+            # Только метод и путь: query-строка может содержать секреты
+            url = prepared.url.split('?', 1)[0]
+            _add_span('http', f"{prepared.method} {url}", started, time.perf_counter())
+
+    requests.Session.send = send
+
+
+def _requested_by_admin():
+    """
+    Проверяет, что заголовок профилирования прислал администратор.
+    :return: bool
+    """
+    try:
+        verify_jwt_in_request(optional=True)
+        from utils.auth import load_current_user
+        user = load_current_user()
+        return bool(user and user.role and user.role.value == 'admin')
+    except Exception:
+        return False
+
+
+def _before_request():
+    if request.headers.get(PROFILE_HEADER) == '1':
+        if not _requested_by_admin():
+            return
+    elif not (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        return
+
+    sampler = _StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+    g._profile = {'started': time.perf_counter(), 'sampler': sampler, 'spans': []}
+    sampler.start()
+
+
+def _stop_sampler():
+    profile = g.get('_profile')
+    if profile is None or profile.get('finished') is not None:
+        return profile
+    profile['finished'] = time.perf_counter()
+    profile['sampler'].stop()
+    return profile
+
+
+def build_speedscope(profile, name):
+    """
+    Формирует документ speedscope: профиль стек-сэмплов и профиль спанов SQL/Redis/HTTP.
+    :param profile: dict — данные профиля запроса
+    :param name: строка — название профиля
+    :return: dict
+    """
+    frames = []
+    frame_index = {}
+
+    def index_of(key, frame):
+        if key not in frame_index:
+            frame_index[key] = len(frames)
+            frames.append(frame)
+        return frame_index[key]
+
+    started = profile['started']
+    finished = profile['finished']
+
+    def to_ms(t):
+        return (t - started) * 1000
+
+    samples, weights = [], []
+    previous = started
+    for taken_at, stack in profile['sampler'].samples:
+        samples.append([index_of(f, {'name': f[0], 'file': f[1], 'line': f[2]}) for f in stack])
+        weights.append((taken_at - previous) * 1000)
+        previous = taken_at
+
+    events = []
+    for kind, span_name, span_start, span_end in sorted(profile['spans'], key=lambda s: s[2]):
+        idx = index_of(('span', kind, span_name), {'name': f"{kind}: {span_name}"})
+        events.append({'type': 'O', 'frame': idx, 'at': to_ms(span_start)})
+        events.append({'type': 'C', 'frame': idx, 'at': to_ms(span_end)})
+
+    end_value = to_ms(finished)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'buzzila-profiler',
+        'shared': {'frames': frames},
+        'profiles': [
+            {
+                'type': 'sampled', 'name': f"{name} — стек", 'unit': 'milliseconds',
+                'startValue': 0, 'endValue': end_value, 'samples': samples, 'weights': weights
+            },
+            {
+                'type': 'evented', 'name': f"{name} — SQL/Redis/HTTP", 'unit': 'milliseconds',
+                'startValue': 0, 'endValue': end_value, 'events': events
+            }
+        ]
+    }
+
+
+def _prune_profiles():
+    files = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith('.speedscope.json'))
+    for old in files[:-PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError:
+            pass
+
+
+def _after_request(response):
+    profile = _stop_sampler()
+    if profile is None:
+        return response
+    try:
+        endpoint = request.endpoint or 'unmatched'
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}_{endpoint}_{uuid.uuid4().hex[:8]}"
+        document = build_speedscope(profile, f"{request.method} {request.path}")
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.speedscope.json"), 'w', encoding='utf-8') as f:
+            json.dump(document, f, ensure_ascii=False)
+        _prune_profiles()
+        response.headers['X-Profile-Id'] = profile_id
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении профиля запроса: {str(e)}")
+    return response
+
+
+def _teardown_request(exc):
+    # Поток-сэмплер не должен пережить запрос, даже если after_request не выполнился
+    _stop_sampler()
+
+
+def list_profiles():
+    """
+    Возвращает сохранённые профили (новые первыми).
+    :return: список словарей id, size, created_at
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    result = []
+    for filename in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not filename.endswith('.speedscope.json'):
+            continue
+        path = os.path.join(PROFILE_DIR, filename)
+        stat = os.stat(path)
+        result.append({
+            'id': filename[:-len('.speedscope.json')],
+            'size': stat.st_size,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(stat.st_mtime))
+        })
+    return result
+
+
+def get_profile_path(profile_id):
+    """
+    Возвращает путь к файлу профиля или None (id проверяется, чтобы не выйти за пределы каталога).
+    :param profile_id: строка
+    :return: строка или None
+    """
+    if not PROFILE_ID_RE.match(profile_id or ''):
+        return None
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.speedscope.json")
+    return path if os.path.isfile(path) else None
+
+
+def init_profiler(app):
+    """
+    Подключает выборочное профилирование запросов к Flask-приложению.
+    :param app: экземпляр Flask-приложения
+    """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _instrument_redis()
+    _instrument_http()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,126 @@
+# Модуль контроля количества SQL-запросов: бюджет запросов на обработчик и поиск N+1.
+# Режим задаётся переменной окружения QUERY_GUARD: off (по умолчанию), log или raise (для тестов).
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+import os
+import re
+import threading
+
+QUERY_GUARD_MODE = os.getenv('QUERY_GUARD', 'off').lower()
+# Сколько одинаковых (с точностью до параметров) запросов считается признаком N+1
+REPEAT_THRESHOLD = int(os.getenv('QUERY_GUARD_REPEAT', 5))
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_NUMBER_RE = re.compile(r'\b\d+\b')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_IN_LIST_RE = re.compile(r'\bIN\s*\((?:[^()]*)\)', re.IGNORECASE)
+
+
+def normalize_statement(statement):
+    """
+    Приводит SQL к шаблону: литералы и списки IN заменяются на '?'.
+    Запросы ORM уже параметризованы, нормализация нужна для сырого SQL.
+    :param statement: строка SQL
+    :return: строка
+    """
+    statement = _STRING_RE.sub('?', statement)
+    statement = _IN_LIST_RE.sub('IN (?)', statement)
+    statement = _NUMBER_RE.sub('?', statement)
+    return _WHITESPACE_RE.sub(' ', statement).strip()
+
+
+class QueryRecorder:
+    """
+    Журнал SQL-запросов, выполненных внутри record_queries().
+    """
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """
+        Возвращает запросы, повторившиеся не менее threshold раз (вероятный N+1).
+        :param threshold: int — порог повторов
+        :return: список кортежей (шаблон запроса, количество)
+        """
+        counts = Counter(normalize_statement(s) for s in self.statements)
+        return [(statement, n) for statement, n in counts.most_common() if n >= threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for recorder in getattr(_local, 'recorders', ()):
+        recorder.statements.append(statement)
+
+
+event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+
+
+@contextmanager
+def record_queries():
+    """
+    Записывает SQL-запросы текущего потока. Подходит и для тестов:
+        with record_queries() as queries:
+            client.get('/api/profile/')
+        assert queries.count <= 10
+    """
+    recorder = QueryRecorder()
+    recorders = getattr(_local, 'recorders', None)
+    if recorders is None:
+        recorders = _local.recorders = []
+    recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        recorders.remove(recorder)
+
+
+def check_budget(name, recorder, max_queries):
+    """
+    Проверяет журнал запросов на превышение бюджета и повторы.
+    В режиме raise нарушение бюджета вызывает AssertionError, в режиме log — предупреждение.
+    :param name: строка — имя обработчика
+    :param recorder: QueryRecorder
+    :param max_queries: int — допустимое количество запросов
+    """
+    repeated = recorder.repeated()
+    for statement, n in repeated:
+        logger.warning("Возможный N+1 в %s: запрос выполнен %d раз: %s", name, n, statement[:300])
+
+    if recorder.count <= max_queries:
+        return
+    if QUERY_GUARD_MODE == 'raise':
+        raise AssertionError(f"{name}: выполнено {recorder.count} SQL-запросов при бюджете {max_queries}")
+    logger.warning("%s: выполнено %d SQL-запросов при бюджете %d", name, recorder.count, max_queries)
+
+
+def query_budget(max_queries):
+    """
+    Декоратор обработчика с объявленным бюджетом SQL-запросов.
+    При QUERY_GUARD=off не добавляет накладных расходов, кроме одного сравнения.
+    :param max_queries: int — допустимое количество запросов за вызов
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if QUERY_GUARD_MODE not in ('log', 'raise'):
+                return fn(*args, **kwargs)
+            with record_queries() as recorder:
+                result = fn(*args, **kwargs)
+            name = request.endpoint if has_request_context() and request.endpoint else fn.__name__
+            check_budget(name, recorder, max_queries)
+            return result
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
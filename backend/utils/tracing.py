@@ -0,0 +1,423 @@
+# Модуль трассировки в стиле OpenTelemetry: спаны обработчиков, SQL, Redis и обращений к GigaChat.
+# Спаны выгружаются пачками в фоне — в файл (JSON Lines в формате OTLP/JSON) или в локальный коллектор по OTLP/HTTP.
+# Корневой спан запроса получает сводку: сколько времени ушло на БД, Redis, GigaChat и паузы между повторами.
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils.redis_client import redis_client
+from utils.json_provider import dumps_bytes
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+import requests
+
+# Куда выгружать спаны: off (по умолчанию), file или otlp
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'off').lower()
+TRACING_FILE = os.getenv('TRACING_FILE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'traces.jsonl'))
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+# Доля трассируемых запросов (входящий traceparent с флагом sampled трассируется всегда)
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', '1.0'))
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'buzzila-backend')
+# Параметры пакетной выгрузки
+TRACING_BATCH_SIZE = 512
+TRACING_FLUSH_INTERVAL = 2.0
+TRACING_QUEUE_SIZE = 20000
+
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# Коды видов спанов и статусов OTLP
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+STATUS_OK, STATUS_ERROR = 1, 2
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_exporter = None
+
+
+class Span:
+    """
+    Спан трассировки: операция с началом, концом, атрибутами и событиями.
+    category — к какой статье сводки корневого спана относится длительность (db, redis, upstream, sleep).
+    """
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'category',
+                 'start_ns', 'end_ns', 'attributes', 'events', 'status', 'status_message', 'totals')
+
+    def __init__(self, trace_id, parent_id, name, kind='internal', category=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.category = category
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = None
+        self.status_message = None
+        self.totals = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, attributes=None):
+        self.events.append((time.time_ns(), name, attributes or {}))
+
+    def record_exception(self, exc):
+        self.status = STATUS_ERROR
+        self.status_message = str(exc)[:500]
+        self.add_event('exception', {'exception.type': type(exc).__name__, 'exception.message': str(exc)[:500]})
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+class _NoopSpan:
+    """
+    Заглушка, когда трассировка выключена или запрос не попал в выборку.
+    """
+    trace_id = None
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current_span():
+    """
+    Возвращает активный спан текущего потока (или заглушку).
+    :return: Span или _NoopSpan
+    """
+    stack = _stack()
+    return stack[-1] if stack else NOOP_SPAN
+
+
+def capture_context():
+    """
+    Снимок активных спанов текущего потока для передачи в задачу пула потоков.
+    :return: список Span
+    """
+    return list(_stack())
+
+
+@contextmanager
+def attach_context(spans):
+    """
+    Делает спаны другого потока активными в текущем: спаны задачи пула становятся дочерними к спану запроса.
+    :param spans: список Span из capture_context()
+    """
+    stack = _stack()
+    saved = stack[:]
+    stack[:] = spans
+    try:
+        yield
+    finally:
+        stack[:] = saved
+
+
+def _open(name, kind='internal', category=None, attributes=None, root=True):
+    """
+    Открывает спан и делает его активным.
+    :param root: можно ли начать новую трассу, если активной нет
+    :return: Span или None
+    """
+    if _exporter is None:
+        return None
+    stack = _stack()
+    if stack:
+        parent = stack[-1]
+        span = Span(parent.trace_id, parent.span_id, name, kind, category, attributes)
+    elif root and random.random() < TRACING_SAMPLE_RATE:
+        span = Span(os.urandom(16).hex(), None, name, kind, category, attributes)
+        span.totals = {}
+    else:
+        return None
+    stack.append(span)
+    return span
+
+
+def _close(span, exc=None):
+    """
+    Завершает спан, добавляет его длительность в сводку корневого спана и отправляет на выгрузку.
+    """
+    span.end_ns = time.time_ns()
+    if exc is not None:
+        span.record_exception(exc)
+    stack = _stack()
+    if stack and stack[-1] is span:
+        stack.pop()
+    elif span in stack:
+        stack.remove(span)
+    if span.category and stack:
+        totals = stack[0].totals
+        if totals is not None:
+            totals[span.category] = totals.get(span.category, 0) + (span.end_ns - span.start_ns)
+    if span.totals is not None:
+        for category, nanos in span.totals.items():
+            span.attributes[f'summary.{category}_ms'] = round(nanos / 1e6, 3)
+    _exporter.submit(span)
+
+
+@contextmanager
+def start_span(name, kind='internal', category=None, attributes=None):
+    """
+    Контекстный менеджер (и декоратор) для спана. Внутри запроса становится дочерним к активному спану.
+    :param name: строка — имя операции
+    :param kind: строка — 'internal', 'server' или 'client'
+    :param category: строка — статья сводки корневого спана (db, redis, upstream, sleep) или None
+    :param attributes: dict — атрибуты спана
+    """
+    span = _open(name, kind, category, attributes)
+    if span is None:
+        yield NOOP_SPAN
+        return
+    try:
+        yield span
+    except BaseException as e:
+        _close(span, e)
+        raise
+    _close(span)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items()]
+
+
+def to_otlp(spans):
+    """
+    Преобразует спаны в документ OTLP/JSON (ExportTraceServiceRequest).
+    :param spans: список Span
+    :return: dict
+    """
+    otlp_spans = []
+    for span in spans:
+        item = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': SPAN_KINDS.get(span.kind, 1),
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': _otlp_attributes(span.attributes),
+        }
+        if span.parent_id:
+            item['parentSpanId'] = span.parent_id
+        if span.events:
+            item['events'] = [{'timeUnixNano': str(ts), 'name': name, 'attributes': _otlp_attributes(attrs)}
+                              for ts, name, attrs in span.events]
+        if span.status:
+            item['status'] = {'code': span.status, 'message': span.status_message or ''}
+        otlp_spans.append(item)
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': TRACING_SERVICE_NAME, 'process.pid': os.getpid()})},
+            'scopeSpans': [{'scope': {'name': 'buzzila.tracing'}, 'spans': otlp_spans}]
+        }]
+    }
+
+
+class _BatchExporter(threading.Thread):
+    """
+    Фоновый поток, выгружающий спаны пачками; при переполнении очереди спаны отбрасываются.
+    """
+    def __init__(self, mode):
+        super().__init__(daemon=True)
+        self.mode = mode
+        self.queue = queue.Queue(maxsize=TRACING_QUEUE_SIZE)
+        self.dropped = 0
+        self._stop_event = threading.Event()
+
+    def submit(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self):
+        batch = []
+        while len(batch) < TRACING_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch):
+        document = to_otlp(batch)
+        if self.mode == 'file':
+            os.makedirs(os.path.dirname(TRACING_FILE) or '.', exist_ok=True)
+            with open(TRACING_FILE, 'ab') as f:
+                f.write(dumps_bytes(document) + b'\n')
+        else:
+            requests.post(TRACING_OTLP_ENDPOINT, data=dumps_bytes(document),
+                          headers={'Content-Type': 'application/json'}, timeout=5)
+
+    def flush(self):
+        batch = self._drain()
+        while batch:
+            try:
+                self._export(batch)
+            except Exception as e:
+                logger.warning("Не удалось выгрузить %d спанов: %s", len(batch), e)
+            batch = self._drain()
+
+    def run(self):
+        while not self._stop_event.wait(TRACING_FLUSH_INTERVAL):
+            self.flush()
+
+    def stop(self):
+        self._stop_event.set()
+        self.flush()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _stack():
+        return
+    context._trace_span = _open('db.query', 'client', 'db', {
+        'db.system': conn.dialect.name,
+        'db.statement': ' '.join(statement.split())[:500],
+    }, root=False)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, '_trace_span', None)
+    if span is not None:
+        context._trace_span = None
+        _close(span)
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    span = getattr(context, '_trace_span', None) if context is not None else None
+    if span is not None:
+        context._trace_span = None
+        _close(span, exception_context.original_exception)
+
+
+def _instrument_redis():
+    original = redis_client.execute_command
+
+    def execute_command(*args, **options):
+        if not _stack():
+            return original(*args, **options)
+        command = str(args[0]) if args else 'redis'
+        span = _open(f"redis {command}", 'client', 'redis', {'db.system': 'redis', 'db.operation': command}, root=False)
+        try:
+            result = original(*args, **options)
+        except Exception as e:
+            _close(span, e)
+            raise
+        _close(span)
+        return result
+
+    redis_client.execute_command = execute_command
+
+
+def _parse_traceparent(value):
+    match = TRACEPARENT_RE.match(value or '')
+    if not match:
+        return None
+    return match.group(1), match.group(2), int(match.group(3), 16) & 1
+
+
+def _before_request():
+    stack = _stack()
+    if stack:
+        # Остатки прошлого запроса в этом потоке (teardown не выполнился) не должны стать родителями
+        stack.clear()
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    attributes = {
+        'http.method': request.method,
+        'http.route': rule,
+        'http.target': request.path,
+        'flask.endpoint': request.endpoint or 'unmatched',
+        'flask.blueprint': request.blueprint or '',
+    }
+    if g.get('request_id'):
+        attributes['request.id'] = g.request_id
+    incoming = _parse_traceparent(request.headers.get('traceparent'))
+    if incoming and incoming[2]:
+        span = Span(incoming[0], incoming[1], f"{request.method} {rule}", 'server', attributes=attributes)
+        span.totals = {}
+        stack.append(span)
+    else:
+        span = _open(f"{request.method} {rule}", 'server', attributes=attributes)
+    if span is not None:
+        g._trace_span = span
+
+
+def _after_request(response):
+    span = g.get('_trace_span')
+    if span is not None:
+        span.set_attribute('http.status_code', response.status_code)
+        if response.status_code >= 500:
+            span.status = STATUS_ERROR
+        response.headers['traceparent'] = span.traceparent
+    return response
+
+
+def _teardown_request(exc):
+    span = g.pop('_trace_span', None)
+    if span is not None:
+        # Незакрытые дочерние спаны (например, при исключении внутри) закрываем вместе с корнем
+        stack = _stack()
+        while stack and stack[-1] is not span:
+            _close(stack[-1])
+        _close(span, exc)
+    _stack().clear()
+
+
+def init_tracing(app):
+    """
+    Подключает трассировку к Flask-приложению, если задан TRACING_EXPORTER (file или otlp).
+    :param app: экземпляр Flask-приложения
+    """
+    global _exporter
+    if TRACING_EXPORTER not in ('file', 'otlp'):
+        return
+    _exporter = _BatchExporter(TRACING_EXPORTER)
+    _exporter.start()
+    atexit.register(_exporter.stop)
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    _instrument_redis()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,135 @@
+# Компактный формат стенограммы завершённого диалога: один сжатый двоичный блоб вместо строк messages.
+# Внутри: число сообщений и для каждого — код отправителя, дельта времени и id (varint), текст с префиксом длины.
+from collections import namedtuple
+from datetime import datetime, timedelta
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstandard необязателен: без него блоб сжимается zlib
+    zstandard = None
+
+MAGIC = b'BZT1'
+CODEC_ZSTD = b'z'
+CODEC_ZLIB = b'd'
+ZSTD_LEVEL = 9
+
+# Коды отправителей; прочие значения хранятся строкой после кода SENDER_OTHER
+SENDER_CODES = {'user': 0, 'assistant': 1, 'ai': 2, 'system': 3}
+SENDER_NAMES = {code: name for name, code in SENDER_CODES.items()}
+SENDER_OTHER = 0x0F
+FLAG_NO_TIMESTAMP = 0x80
+
+EPOCH = datetime(1970, 1, 1)
+
+# Сообщение, прочитанное из стенограммы или архива (атрибуты совпадают с моделью Message)
+StoredMessage = namedtuple('StoredMessage', 'id sender text timestamp')
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_signed(out, value):
+    _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_signed(data, pos):
+    value, pos = _read_varint(data, pos)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+
+def _to_micros(ts):
+    delta = ts - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode_transcript(messages):
+    """
+    Кодирует сообщения диалога в сжатый блоб.
+    :param messages: последовательность объектов с атрибутами id, sender, text, timestamp (в хронологическом порядке)
+    :return: bytes
+    """
+    out = bytearray()
+    _write_varint(out, len(messages))
+    previous_id = previous_ts = 0
+    for m in messages:
+        code = SENDER_CODES.get(m.sender, SENDER_OTHER)
+        out.append(code | (FLAG_NO_TIMESTAMP if m.timestamp is None else 0))
+        if code == SENDER_OTHER:
+            sender = (m.sender or '').encode('utf-8')
+            _write_varint(out, len(sender))
+            out += sender
+        if m.timestamp is not None:
+            micros = _to_micros(m.timestamp)
+            _write_signed(out, micros - previous_ts)
+            previous_ts = micros
+        _write_signed(out, (m.id or 0) - previous_id)
+        previous_id = m.id or 0
+        text = (m.text or '').encode('utf-8')
+        _write_varint(out, len(text))
+        out += text
+
+    if zstandard is not None:
+        return MAGIC + CODEC_ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(bytes(out))
+    return MAGIC + CODEC_ZLIB + zlib.compress(bytes(out), 9)
+
+
+def decode_transcript(blob):
+    """
+    Декодирует блоб стенограммы.
+    :param blob: bytes
+    :return: список StoredMessage
+    """
+    blob = bytes(blob)
+    if blob[:4] != MAGIC:
+        raise ValueError("Неизвестный формат стенограммы")
+    codec, payload = blob[4:5], blob[5:]
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Для чтения стенограммы нужен пакет zstandard")
+        data = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == CODEC_ZLIB:
+        data = zlib.decompress(payload)
+    else:
+        raise ValueError("Неизвестный кодек стенограммы")
+
+    count, pos = _read_varint(data, 0)
+    messages = []
+    previous_id = previous_ts = 0
+    for _ in range(count):
+        flags = data[pos]
+        pos += 1
+        code = flags & 0x7F
+        if code == SENDER_OTHER:
+            length, pos = _read_varint(data, pos)
+            sender = data[pos:pos + length].decode('utf-8')
+            pos += length
+        else:
+            sender = SENDER_NAMES.get(code, 'unknown')
+        timestamp = None
+        if not flags & FLAG_NO_TIMESTAMP:
+            delta, pos = _read_signed(data, pos)
+            previous_ts += delta
+            timestamp = EPOCH + timedelta(microseconds=previous_ts)
+        delta, pos = _read_signed(data, pos)
+        previous_id += delta
+        length, pos = _read_varint(data, pos)
+        text = data[pos:pos + length].decode('utf-8')
+        pos += length
+        messages.append(StoredMessage(previous_id, sender, text, timestamp))
+    return messages